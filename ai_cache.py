@@ -0,0 +1,333 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Знаки препинания и пробелы, которые не меняют смысл вопроса
+_PUNCTUATION_RE = re.compile(r'[\s.,!?;:…"\'«»()\-]+')
+
+
+def normalize_question(question: str) -> str:
+    """Приведение вопроса к каноничному виду: регистр, ё, пробелы и пунктуация"""
+    text = question.lower().replace('ё', 'е')
+    return _PUNCTUATION_RE.sub(' ', text).strip()
+
+
+def _hash(data) -> str:
+    """SHA-256 от JSON-представления данных"""
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def settings_fingerprint(payload: dict) -> str:
+    """
+    Отпечаток настроек запроса: системный промпт, модель и параметры генерации
+
+    Args:
+        payload: Тело запроса к Grok
+
+    Returns:
+        Хэш, который меняется при любом изменении настроек в Google Sheets
+    """
+    system_prompts = [m['content'] for m in payload['messages'] if m['role'] == 'system']
+    params = {k: v for k, v in payload.items() if k not in ('messages', 'stream')}
+    return _hash([system_prompts, params])
+
+
+def make_cache_key(question: str, payload: dict) -> str:
+    """
+    Ключ кэша ответа
+
+    Args:
+        question: Вопрос пользователя
+        payload: Тело запроса к Grok (промпт, история, параметры)
+
+    Returns:
+        Хэш нормализованного вопроса, настроек и контекста диалога
+    """
+    context = [m for m in payload['messages'][:-1] if m['role'] != 'system']
+    return _hash([settings_fingerprint(payload), context, normalize_question(question)])
+
+
+class AnswerCache:
+    """LRU-кэш ответов AI с ограничением по количеству, объему и времени жизни"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 5 * 1024 * 1024,
+                 ttl: float = 3600.0, persist_path: str = None):
+        """
+        Инициализация кэша ответов
+
+        Args:
+            max_entries: Максимальное количество ответов
+            max_bytes: Максимальный суммарный размер ответов (байт)
+            ttl: Время жизни ответа (сек)
+            persist_path: Путь к SQLite файлу для сохранения между перезапусками
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_path = persist_path
+
+        # key -> (ответ, отпечаток настроек, время создания, размер)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._fingerprint = None
+
+        self._conn = None
+        self._conn_lock = threading.Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expired': 0,
+            'invalidated': 0
+        }
+
+    def load(self):
+        """Открытие файла кэша и загрузка неистекших ответов (блокирующий вызов)"""
+        if not self.persist_path:
+            return
+
+        with self._conn_lock:
+            self._conn = sqlite3.connect(self.persist_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    fingerprint TEXT,
+                    answer TEXT,
+                    created_at REAL
+                )
+            ''')
+            self._conn.execute('DELETE FROM answers WHERE created_at < ?', (time.time() - self.ttl,))
+            self._conn.commit()
+            rows = self._conn.execute('''
+                SELECT key, fingerprint, answer, created_at
+                FROM answers
+                ORDER BY created_at DESC
+                LIMIT ?
+            ''', (self.max_entries,)).fetchall()
+
+        # Самые свежие ответы должны оказаться в конце LRU
+        for key, fingerprint, answer, created_at in reversed(rows):
+            self._store(key, answer, fingerprint, created_at)
+        logger.info(f"Кэш ответов AI: загружено {len(rows)} записей из {self.persist_path}")
+
+    def close(self):
+        """Закрытие файла кэша"""
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: str):
+        """Ответ из кэша или None"""
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[2] > self.ttl:
+            self._remove(key)
+            self.stats['expired'] += 1
+            entry = None
+
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[0]
+
+    async def put(self, key: str, answer: str, fingerprint: str):
+        """
+        Сохранение ответа в кэше
+
+        Args:
+            key: Ключ из make_cache_key
+            answer: Текст ответа
+            fingerprint: Отпечаток настроек из settings_fingerprint
+        """
+        # Настройки в таблице изменились - ответы на старый промпт больше не нужны
+        invalidated = False
+        if fingerprint != self._fingerprint:
+            if self._fingerprint is not None:
+                self._invalidate_except(fingerprint)
+                invalidated = True
+            self._fingerprint = fingerprint
+
+        created_at = time.time()
+        self._store(key, answer, fingerprint, created_at)
+
+        if self._conn is not None:
+            if invalidated:
+                await asyncio.to_thread(self._delete_stale, fingerprint)
+            await asyncio.to_thread(self._persist, key, fingerprint, answer, created_at)
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков кэша
+
+        Returns:
+            Словарь с попаданиями, промахами, размером и объемом
+        """
+        cache_stats = dict(self.stats)
+        cache_stats['size'] = len(self._entries)
+        cache_stats['bytes'] = self._bytes
+        return cache_stats
+
+    def _store(self, key, answer, fingerprint, created_at):
+        """Добавление ответа в память с вытеснением самых старых"""
+        if key in self._entries:
+            self._remove(key)
+
+        size = len(answer.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint
+        self._entries[key] = (answer, fingerprint, created_at, size)
+        self._bytes += size
+
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        """Удаление ответа из памяти"""
+        entry = self._entries.pop(key)
+        self._bytes -= entry[3]
+
+    def _invalidate_except(self, fingerprint):
+        """Удаление из памяти ответов, полученных с другими настройками"""
+        stale_keys = [key for key, entry in self._entries.items() if entry[1] != fingerprint]
+        for key in stale_keys:
+            self._remove(key)
+        self.stats['invalidated'] += len(stale_keys)
+        logger.info(f"Настройки AI изменились, из кэша удалено ответов: {len(stale_keys)}")
+
+    def _delete_stale(self, fingerprint):
+        """Удаление из файла кэша ответов с другими настройками (выполняется в отдельном потоке)"""
+        with self._conn_lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute('DELETE FROM answers WHERE fingerprint != ?', (fingerprint,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка очистки файла кэша ответов: {e}")
+
+    def _persist(self, key, fingerprint, answer, created_at):
+        """Запись ответа в файл кэша (выполняется в отдельном потоке)"""
+        with self._conn_lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute('''
+                    INSERT OR REPLACE INTO answers (key, fingerprint, answer, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', (key, fingerprint, answer, created_at))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка записи в файл кэша ответов: {e}")
+
+
+# Глобальный кэш ответов
+_answer_cache = None
+
+def init_answer_cache(**options) -> AnswerCache:
+    """Инициализация глобального кэша ответов (без загрузки из файла)"""
+    global _answer_cache
+    _answer_cache = AnswerCache(**options)
+    return _answer_cache
+
+def close_answer_cache():
+    """Закрытие глобального кэша ответов"""
+    global _answer_cache
+    if _answer_cache is not None:
+        _answer_cache.close()
+        _answer_cache = None
+
+def get_answer_cache() -> AnswerCache:
+    """Получение глобального кэша ответов"""
+    return _answer_cache
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов в один запрос к API"""
+
+    class _Call:
+        """Выполняющийся запрос и количество ожидающих его"""
+        __slots__ = ('task', 'waiters')
+
+        def __init__(self, task):
+            self.task = task
+            self.waiters = 0
+
+    def __init__(self):
+        self._calls = {}
+        self.stats = {
+            'leaders': 0,
+            'coalesced': 0
+        }
+
+    async def do(self, key: str, func):
+        """
+        Выполнение запроса с объединением одинаковых
+
+        Args:
+            key: Ключ запроса (из make_cache_key)
+            func: Функция без аргументов, возвращающая корутину запроса
+
+        Returns:
+            Результат общего запроса; его исключение получат все ожидающие
+        """
+        call = self._calls.get(key)
+        if call is None:
+            # Запрос выполняется отдельной задачей, чтобы отмена одного
+            # ожидающего не прерывала ответ для остальных
+            call = self._Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.stats['leaders'] += 1
+        else:
+            self.stats['coalesced'] += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            # Ответ больше никому не нужен - отменяем запрос
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков объединения запросов
+
+        Returns:
+            Словарь с количеством исходных и объединенных запросов
+        """
+        flight_stats = dict(self.stats)
+        flight_stats['in_flight'] = len(self._calls)
+        return flight_stats
+
+    def _forget(self, key, call):
+        """Удаление завершенного запроса"""
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+# Глобальный объединитель запросов к Grok
+_single_flight = SingleFlight()
+
+def get_single_flight() -> SingleFlight:
+    """Получение глобального объединителя запросов"""
+    return _single_flight
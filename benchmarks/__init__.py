@@ -0,0 +1 @@
+"""Нагрузочные тесты и бенчмарки бота (запуск: python -m benchmarks.bench_bot)"""
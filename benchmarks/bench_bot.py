@@ -0,0 +1,524 @@
+"""
+Нагрузочный тест бота без Telegram и x.ai
+
+Синтетический поток обновлений (кнопки меню, вопросы AI, оформление заявки)
+подается в Application бота. Bot API и Grok заменены локальными заглушками
+с настраиваемой задержкой и долей ошибок, Google Sheets - FakeSheetsManager.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_bot --updates 2000 --users 200 --output result.json
+
+Сравнение двух прогонов: python -m benchmarks.compare before.json after.json
+
+Режим кластера (главный процесс ClusterFront и рабочие процессы), масштабирование
+по количеству процессов:
+    python -m benchmarks.bench_bot --workers 1,2,4 --mix buttons=0.8,application=0.2
+"""
+import argparse
+import asyncio
+import functools
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_servers import FakeSheetsManager, LatencyModel, MockGrokServer, MockTelegramServer
+
+# Группа обработчика, который отмечает завершение обработки обновления
+DONE_GROUP = 1000
+
+# Пользователь сценария flood (обычные пользователи - от 1000)
+FLOOD_USER_ID = 999
+
+BUTTONS = ['О нас', 'Кейсы', '👤 Руководитель', '📞 Номер телефона', '⬅️ Назад в меню']
+QUESTIONS = [
+    'Сколько стоит разработка мобильного приложения?',
+    'Какие сроки у проекта CRM?',
+    'Вы работаете с малым бизнесом?',
+    'Как внедрить AI-чатбота в поддержку?',
+    'Есть ли у вас гарантия на разработку?'
+]
+
+
+def parse_args(argv=None):
+    """Параметры прогона"""
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Telegram и Grok")
+    parser.add_argument('--updates', type=int, default=2000, help="Количество обновлений")
+    parser.add_argument('--users', type=int, default=200, help="Количество пользователей")
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help="Обновлений в секунду (0 - так быстро, как принимает очередь)")
+    parser.add_argument('--mix', default='buttons=0.6,ai=0.3,application=0.1',
+                        help="Доли сценариев: buttons, ai, application")
+    parser.add_argument('--unique-questions', type=float, default=0.5,
+                        help="Доля уникальных вопросов AI (остальные повторяются)")
+    parser.add_argument('--queue-size', type=int, default=1000, help="Размер очереди обновлений")
+    parser.add_argument('--concurrent-updates', type=int, default=64,
+                        help="Обновлений в обработке одновременно (CONCURRENT_UPDATES)")
+    parser.add_argument('--flood', type=int, default=0,
+                        help="Один пользователь в начале прогона присылает столько вопросов AI подряд "
+                             "(сценарий flood); задержка остальных сценариев показывает, мешает ли он другим")
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help="Медиана задержки Bot API (сек)")
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0, help="Доля ошибок Bot API")
+    parser.add_argument('--grok-latency', type=float, default=0.5, help="Медиана задержки Grok (сек)")
+    parser.add_argument('--grok-error-rate', type=float, default=0.0, help="Доля ошибок Grok")
+    parser.add_argument('--grok-error-status', type=int, default=503, help="HTTP код ошибки Grok")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="Разброс задержек заглушек")
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help="Задержка чтения Google Sheets (сек)")
+    parser.add_argument('--streaming', action='store_true', help="Потоковые ответы Grok")
+    parser.add_argument('--timeout', type=float, default=300.0, help="Максимальная длительность прогона (сек)")
+    parser.add_argument('--seed', type=int, default=1, help="Зерно генератора")
+    parser.add_argument('--workers', default='',
+                        help="Прогнать через кластер с таким количеством рабочих процессов "
+                             "(можно несколько через запятую: 1,2,4)")
+    parser.add_argument('--output', help="Файл для результата в JSON (по умолчанию - stdout)")
+    return parser.parse_args(argv)
+
+
+def _parse_mix(mix: str) -> dict:
+    """Доли сценариев из строки buttons=0.6,ai=0.3,application=0.1"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def _message(update_id: int, user_id: int, text: str) -> dict:
+    """Обновление с текстовым сообщением в формате Bot API"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def generate_updates(args) -> list:
+    """
+    Синтетический поток обновлений
+
+    Returns:
+        Список (сценарий, обновление); сообщения одного сценария идут подряд
+    """
+    rng = random.Random(args.seed)
+    weights = _parse_mix(args.mix)
+    scenarios = list(weights)
+    update_ids = iter(range(1, 10 ** 9))
+    question_ids = iter(range(10 ** 9))
+    updates = []
+
+    while len(updates) < args.updates:
+        user_id = 1000 + rng.randrange(args.users)
+        scenario = rng.choices(scenarios, [weights[name] for name in scenarios])[0]
+        if scenario == 'buttons':
+            texts = [rng.choice(BUTTONS)]
+        elif scenario == 'ai':
+            if rng.random() < args.unique_questions:
+                texts = [f'{rng.choice(QUESTIONS)} Вариант {next(question_ids)}']
+            else:
+                texts = [rng.choice(QUESTIONS)]
+        elif scenario == 'application':
+            texts = ['/start', '📞 Оставить заявку', f'+7999{rng.randrange(10 ** 7):07d}']
+        else:
+            raise ValueError(f"Неизвестный сценарий: {scenario}")
+        for text in texts:
+            updates.append((scenario, _message(next(update_ids), user_id, text)))
+    updates = updates[:args.updates]
+
+    if args.flood:
+        # Вопросы flood-пользователя идут впереди и вперемешку с обычным потоком
+        flood = [
+            ('flood', _message(next(update_ids), FLOOD_USER_ID, f'{rng.choice(QUESTIONS)} Флуд {index}'))
+            for index in range(args.flood)
+        ]
+        head = flood[:len(flood) // 2]
+        tail = flood[len(flood) // 2:]
+        updates = head + [item for pair in itertools.zip_longest(updates, tail) for item in pair if item]
+    return updates
+
+
+def _quantile(sorted_values: list, q: float) -> float:
+    """Квантиль отсортированного списка"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def latency_summary(values) -> dict:
+    """Сводка задержек в миллисекундах"""
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000 if values else 0.0,
+        'p50_ms': _quantile(values, 0.5) * 1000,
+        'p90_ms': _quantile(values, 0.9) * 1000,
+        'p99_ms': _quantile(values, 0.99) * 1000,
+        'max_ms': values[-1] * 1000 if values else 0.0
+    }
+
+
+def _latency_by_scenario(updates: list, latencies: dict) -> dict:
+    """Сводка задержек по сценариям"""
+    by_scenario = {}
+    for scenario, data in updates:
+        latency = latencies.get(data['update_id'])
+        if latency is not None:
+            by_scenario.setdefault(scenario, []).append(latency)
+    return {name: latency_summary(values) for name, values in sorted(by_scenario.items())}
+
+
+def _git_commit() -> str:
+    """Текущий коммит (если доступен git)"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _configure_environment(args, workdir: str, telegram_url: str):
+    """Переменные окружения бота до его импорта (перекрывают .env)"""
+    os.environ.update({
+        'BOT_TOKEN': '123456:BENCHMARK',
+        'GROK_API_KEY': 'benchmark',
+        'ADMIN_ID': '1',
+        'TELEGRAM_BASE_URL': telegram_url,
+        'GOOGLE_SPREADSHEET_ID': '',
+        'GROK_STREAMING': 'true' if args.streaming else 'false',
+        'GROK_STREAM_EDIT_INTERVAL': '0.2',
+        'AI_CACHE_FILE': '',
+        'DIALOGUE_FILE': '',
+        'METRICS_PORT': '0',
+        'CONCURRENT_UPDATES': str(args.concurrent_updates)
+    })
+    # Синтетические пользователи спрашивают чаще живых - лимиты можно задать через окружение
+    os.environ.setdefault('GROK_USER_RATE', '100')
+    os.environ.setdefault('GROK_USER_BURST', '100')
+    os.environ.setdefault('GROK_MAX_QUEUE', '10000')
+    os.environ.setdefault('GROK_MAX_WAIT', '60')
+
+
+def _count_rows(db_file: str) -> dict:
+    """Количество строк в таблицах, в которые пишет бот"""
+    conn = sqlite3.connect(db_file)
+    try:
+        return {
+            table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in ('users', 'actions', 'applications', 'notifications')
+        }
+    finally:
+        conn.close()
+
+
+async def run_benchmark(args) -> dict:
+    """Прогон нагрузочного теста"""
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    os.chdir(workdir)
+    # Фото руководителя, чтобы проверить загрузку и повторное использование file_id
+    with open('director.jpg', 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+
+    telegram = MockTelegramServer(LatencyModel(
+        args.telegram_latency, args.latency_sigma, args.telegram_error_rate, 500, args.seed))
+    grok = MockGrokServer(LatencyModel(
+        args.grok_latency, args.latency_sigma, args.grok_error_rate, args.grok_error_status, args.seed + 1))
+    await telegram.start()
+    await grok.start()
+
+    _configure_environment(args, workdir, telegram.base_url)
+    bot = importlib.import_module('bot')
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    import database
+    import google_sheets
+    import grok_client
+    import metrics
+
+    # Логи каждого запроса исказят измерения
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    database.DB_FILE = os.path.join(workdir, 'bench.db')
+    database.init_database()
+    database.init_user_cache(bot.USER_CACHE_SIZE, bot.USER_SEEN_DEBOUNCE)
+    sheets = FakeSheetsManager(latency=LatencyModel(args.sheets_latency, args.latency_sigma, seed=args.seed))
+    google_sheets._sheets_manager = sheets
+    grok_client.GROK_API_URL = grok.url
+
+    updates = generate_updates(args)
+    enqueued = {}
+    latencies = {}
+    finished = asyncio.Event()
+
+    async def mark_done(update, context):
+        update_id = update.update_id
+        latencies[update_id] = time.perf_counter() - enqueued[update_id]
+        if len(latencies) == len(updates):
+            finished.set()
+
+    application = bot.build_application(update_queue_size=args.queue_size)
+    application.add_handler(TypeHandler(Update, mark_done), group=DONE_GROUP)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    started = time.perf_counter()
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    for index, (_, data) in enumerate(updates):
+        if interval:
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(data, application.bot)
+        enqueued[update.update_id] = time.perf_counter()
+        # Очередь ограничена - при переполнении ждем, как вебхук ждал бы повтора от Telegram
+        await application.update_queue.put(update)
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(finished.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+    duration = time.perf_counter() - started
+
+    await application.stop()
+    await application.shutdown()
+    # post_shutdown дописывает буфер действий и закрывает БД
+    await application.post_shutdown(application)
+    await telegram.stop()
+    await grok.stop()
+
+    rows = _count_rows(database.DB_FILE)
+    rows_written = sum(rows.values())
+
+    db_statements = sum(row['count'] for row in metrics.DB_QUERY_SECONDS.summary())
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss_kb //= 1024
+
+    return {
+        'benchmark': 'bot',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'timed_out': timed_out,
+        'updates': len(updates),
+        'processed': len(latencies),
+        'duration_seconds': duration,
+        'updates_per_second': len(latencies) / duration if duration else 0.0,
+        'latency': latency_summary(latencies.values()),
+        'latency_by_scenario': _latency_by_scenario(updates, latencies),
+        'db': {
+            'rows': rows,
+            'rows_written': rows_written,
+            'rows_per_second': rows_written / duration if duration else 0.0,
+            'statements': db_statements
+        },
+        'telegram': {'calls': telegram.calls, 'errors': telegram.errors},
+        'grok': {'requests': grok.requests, 'errors': grok.errors},
+        'sheets_reads': sheets.reads,
+        'peak_rss_mb': peak_rss_kb / 1024
+    }
+
+
+def _cluster_worker(index: int, update_queue, done_queue, db_file: str, grok_url: str,
+                    sheets_latency: LatencyModel, queue_size: int):
+    """Рабочий процесс кластера с заглушками; о каждом обработанном обновлении сообщает в done_queue"""
+    bot = importlib.import_module('bot')
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    import cluster
+    import database
+    import google_sheets
+    import grok_client
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+    database.DB_FILE = db_file
+    bot.configure_cluster_worker(index, bot.CLUSTER_WORKERS)
+    google_sheets._sheets_manager = FakeSheetsManager(latency=sheets_latency)
+    grok_client.GROK_API_URL = grok_url
+
+    async def mark_done(update, context):
+        done_queue.put((update.update_id, time.monotonic()))
+
+    application = bot.build_application(update_queue_size=queue_size)
+    application.add_handler(TypeHandler(Update, mark_done), group=DONE_GROUP)
+    asyncio.run(cluster.serve_worker(application, update_queue))
+
+
+async def run_cluster_benchmark(args, workers: int) -> dict:
+    """Прогон через главный процесс кластера и workers рабочих процессов"""
+    import multiprocessing
+    import queue
+
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    os.chdir(workdir)
+    with open('director.jpg', 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+
+    telegram = MockTelegramServer(LatencyModel(
+        args.telegram_latency, args.latency_sigma, args.telegram_error_rate, 500, args.seed))
+    grok = MockGrokServer(LatencyModel(
+        args.grok_latency, args.latency_sigma, args.grok_error_rate, args.grok_error_status, args.seed + 1))
+    await telegram.start()
+    await grok.start()
+
+    # Рабочие процессы (spawn) получают копию окружения главного
+    _configure_environment(args, workdir, telegram.base_url)
+    os.environ['CLUSTER_WORKERS'] = str(workers)
+    import cluster
+    import database
+
+    logging.getLogger().setLevel(logging.WARNING)
+    db_file = os.path.join(workdir, 'bench.db')
+    database.DB_FILE = db_file
+    database.init_database()
+    database.close_database()
+
+    done_queue = multiprocessing.get_context('spawn').Queue()
+    front = cluster.ClusterFront(workers, functools.partial(
+        _cluster_worker,
+        done_queue=done_queue,
+        db_file=db_file,
+        grok_url=grok.url,
+        sheets_latency=LatencyModel(args.sheets_latency, args.latency_sigma, seed=args.seed),
+        queue_size=args.queue_size
+    ), queue_size=args.queue_size)
+    front.start()
+
+    loop = asyncio.get_running_loop()
+    enqueued = {}
+    latencies = {}
+
+    def next_done():
+        try:
+            return done_queue.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    async def collect(expected: int, deadline: float):
+        """Ожидание отметок об обработке до deadline (time.monotonic)"""
+        while len(latencies) < expected and time.monotonic() < deadline:
+            done = await loop.run_in_executor(None, next_done)
+            if done is not None and done[0] in enqueued:
+                latencies[done[0]] = done[1] - enqueued[done[0]]
+
+    async def dispatch(data: dict):
+        enqueued[data['update_id']] = time.monotonic()
+        # Очередь процесса заполнена - ждем, как главный процесс при long polling
+        while not front.dispatch(data):
+            await asyncio.sleep(0.01)
+
+    try:
+        # Прогрев: по одному /start на процесс - замер начинается, когда все процессы готовы
+        warmup = [_message(10 ** 9 + index, workers * 10 ** 6 + index, '/start') for index in range(workers)]
+        for data in warmup:
+            await dispatch(data)
+        await collect(len(warmup), time.monotonic() + 120)
+        if len(latencies) < len(warmup):
+            raise RuntimeError("Рабочие процессы не запустились за 120 с")
+        enqueued.clear()
+        latencies.clear()
+
+        updates = generate_updates(args)
+        started = time.monotonic()
+        collector = asyncio.create_task(collect(len(updates), started + args.timeout))
+        interval = 1.0 / args.rate if args.rate > 0 else 0.0
+        for index, (_, data) in enumerate(updates):
+            if interval:
+                delay = started + index * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await dispatch(data)
+        await collector
+        duration = time.monotonic() - started
+    finally:
+        await asyncio.to_thread(front.stop)
+        await telegram.stop()
+        await grok.stop()
+
+    rows = _count_rows(db_file)
+    return {
+        'workers': workers,
+        'timed_out': len(latencies) < len(updates),
+        'updates': len(updates),
+        'processed': len(latencies),
+        'duration_seconds': duration,
+        'updates_per_second': len(latencies) / duration if duration else 0.0,
+        'latency': latency_summary(latencies.values()),
+        'latency_by_scenario': _latency_by_scenario(updates, latencies),
+        'db': {'rows': rows, 'rows_written': sum(rows.values())},
+        'telegram': {'calls': telegram.calls, 'errors': telegram.errors},
+        'grok': {'requests': grok.requests, 'errors': grok.errors}
+    }
+
+
+async def run_cluster_benchmarks(args) -> dict:
+    """Прогоны кластера для каждого количества процессов и ускорение относительно первого"""
+    counts = [int(count) for count in args.workers.split(',') if count.strip()]
+    runs = [await run_cluster_benchmark(args, workers) for workers in counts]
+    base = runs[0]['updates_per_second'] / runs[0]['workers'] if runs[0]['updates_per_second'] else 0.0
+    for run in runs:
+        run['speedup'] = run['updates_per_second'] / runs[0]['updates_per_second'] if base else 0.0
+        # 1.0 - рост точно пропорционален количеству процессов
+        run['efficiency'] = run['updates_per_second'] / (base * run['workers']) if base else 0.0
+    return {
+        'benchmark': 'bot-cluster',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'timed_out': any(run['timed_out'] for run in runs),
+        'runs': runs
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    if args.workers:
+        result = asyncio.run(run_cluster_benchmarks(args))
+        summary = '\n'.join(
+            f"workers {run['workers']}: updates/s {run['updates_per_second']:.1f} "
+            f"(x{run['speedup']:.2f}, эффективность {run['efficiency']:.0%}), "
+            f"p50 {run['latency']['p50_ms']:.1f} мс, p99 {run['latency']['p99_ms']:.1f} мс"
+            for run in result['runs']
+        )
+    else:
+        result = asyncio.run(run_benchmark(args))
+        summary = (
+            f"updates/s: {result['updates_per_second']:.1f}, "
+            f"p50: {result['latency']['p50_ms']:.1f} мс, p99: {result['latency']['p99_ms']:.1f} мс, "
+            f"peak RSS: {result['peak_rss_mb']:.1f} МБ"
+        )
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f"{summary} -> {output}")
+    else:
+        print(text)
+    return 1 if result['timed_out'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
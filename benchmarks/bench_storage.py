@@ -0,0 +1,313 @@
+"""
+Проверка совместимости и нагрузочный тест хранилищ (STORAGE_BACKEND)
+
+Одни и те же проверки и замеры выполняются для SQLite (временный файл) и, если
+задан --postgres-dsn или POSTGRES_DSN, для PostgreSQL. Таблицы хранилища
+в базе PostgreSQL удаляются перед прогоном - используйте отдельную базу:
+
+    createdb bot_bench
+    python -m benchmarks.bench_storage --postgres-dsn postgresql://localhost/bot_bench
+
+Только проверки, без замеров: --check-only. Код возврата 1, если проверка не прошла.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from benchmarks.bench_bot import _git_commit, _quantile
+
+# Таблицы хранилища (без таблиц, которые остаются в SQLite)
+STORAGE_TABLES = (
+    'actions', 'action_types', 'action_counts', 'user_action_counts',
+    'daily_action_counts', 'applications', 'users', 'export_state'
+)
+
+
+def parse_args(argv=None):
+    """Параметры прогона"""
+    parser = argparse.ArgumentParser(description="Проверка и нагрузочный тест хранилищ SQLite и PostgreSQL")
+    parser.add_argument('--postgres-dsn', default=os.getenv('POSTGRES_DSN', ''),
+                        help="База PostgreSQL для прогона (ее таблицы хранилища удаляются)")
+    parser.add_argument('--backends', default='sqlite,postgres', help="Какие хранилища проверять")
+    parser.add_argument('--check-only', action='store_true', help="Только проверки совместимости")
+    parser.add_argument('--users', type=int, default=1000, help="Количество пользователей")
+    parser.add_argument('--actions', type=int, default=50000, help="Количество действий")
+    parser.add_argument('--batch', type=int, default=100, help="Действий в пакете (как ACTION_BATCH_SIZE)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Одновременных операций")
+    parser.add_argument('--pool-size', type=int, default=10, help="Размер пула соединений PostgreSQL")
+    parser.add_argument('--seed', type=int, default=1, help="Зерно генератора")
+    parser.add_argument('--output', help="Файл для результата в JSON (по умолчанию - stdout)")
+    return parser.parse_args(argv)
+
+
+async def _drop_postgres_tables(dsn: str):
+    """Удаление таблиц хранилища в базе PostgreSQL"""
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"DROP TABLE IF EXISTS {', '.join(STORAGE_TABLES)} CASCADE")
+    finally:
+        await conn.close()
+
+
+async def open_backend(name: str, args, workdir: str):
+    """Чистое хранилище для проверки или замера"""
+    import database
+
+    if name == 'sqlite':
+        database.close_database()
+        database.DB_FILE = os.path.join(workdir, f'storage-{time.monotonic_ns()}.db')
+        database.init_database()
+        return await database.open_storage('sqlite')
+    await _drop_postgres_tables(args.postgres_dsn)
+    return await database.open_storage(
+        'postgres', dsn=args.postgres_dsn, min_size=1, max_size=args.pool_size)
+
+
+async def close_backend():
+    """Закрытие хранилища и соединений SQLite"""
+    import database
+
+    await database.close_storage()
+    database.close_database()
+
+
+def _expect(actual, expected, what: str):
+    """Сравнение с ожидаемым значением"""
+    if actual != expected:
+        raise AssertionError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+async def check_users(storage):
+    """Вставка, обновление профиля и постраничное чтение пользователей"""
+    await storage.save_user(3, 'c', 'Cee', None)
+    await storage.save_user(1, 'a', 'Ay', 'One')
+    await storage.save_user(2, None, 'Bee', None)
+    await storage.save_user(1, 'a2', 'Ay', 'Uno')
+    _expect(await storage.get_user_info(1), (1, 'a2', 'Ay', 'Uno'), "обновленный профиль")
+    _expect(await storage.get_user_info(404), None, "неизвестный пользователь")
+    _expect(await storage.count_users(), 3, "количество пользователей")
+    _expect(await storage.get_user_ids_after(0, 2), [1, 2], "первая страница")
+    _expect(await storage.get_user_ids_after(2, 2), [3], "вторая страница")
+    _expect(await storage.get_user_ids_after(3, 2), [], "после последнего")
+
+
+async def check_actions(storage):
+    """Пакетная запись действий, агрегаты и статистика"""
+    now = datetime.now().replace(microsecond=0)
+    three_days_ago = now - timedelta(days=3)
+    for user_id in (1, 2, 3):
+        await storage.save_user(user_id, f'u{user_id}', f'User {user_id}', None)
+    await storage.log_actions([])
+    await storage.log_actions([
+        (1, 'start', three_days_ago),
+        (1, 'ai_question', now),
+        (1, 'ai_question', now),
+        (2, 'start', now)
+    ])
+    await storage.log_action(2, 'button_about')
+
+    stats = await storage.get_statistics()
+    _expect(stats['total_users'], 3, "total_users")
+    _expect(sorted(stats['actions_stats'], key=lambda row: (-row[1], row[0])),
+            [('ai_question', 2), ('start', 2), ('button_about', 1)], "actions_stats")
+    _expect(stats['top_users'][:2], [(1, 'User 1', 'u1', 3), (2, 'User 2', 'u2', 2)], "активные пользователи")
+    _expect(stats['top_users'][2:], [(3, 'User 3', 'u3', 0)], "пользователи без действий")
+    _expect(stats['daily_stats'],
+            [(three_days_ago.date().isoformat(), 1), (now.date().isoformat(), 4)], "daily_stats")
+
+    rollups = await storage.get_daily_rollups_between('', now.date().isoformat(), 10)
+    _expect(rollups, [(three_days_ago.date().isoformat(), 'start', 1)], "агрегаты до сегодняшнего дня")
+    rollups = await storage.get_daily_rollups_between(
+        three_days_ago.date().isoformat(), (now + timedelta(days=1)).date().isoformat(), 2)
+    _expect(rollups, [(now.date().isoformat(), 'ai_question', 2), (now.date().isoformat(), 'button_about', 1)],
+            "агрегаты с лимитом")
+
+    # Большой пакет (в PostgreSQL - через COPY) дает те же агрегаты
+    await storage.log_actions([(3, 'start', now)] * 120)
+    stats = await storage.get_statistics()
+    _expect(dict(stats['actions_stats'])['start'], 122, "агрегат после большого пакета")
+    _expect(stats['top_users'][0], (3, 'User 3', 'u3', 120), "лидер после большого пакета")
+
+
+async def check_applications(storage):
+    """Запись заявок с уведомлением и чтение для выгрузки"""
+    import database
+
+    await storage.save_user(1, 'a', 'Ay', 'One')
+    await storage.save_application(1, '+79990000001', (100, 'application', {'phone': '+79990000001'}))
+    _expect(await database.count_pending_notifications_async(), 1, "уведомление о заявке в очереди")
+    await storage.save_application(404, '+79990000002')
+    await storage.save_application(1, '+79990000003')
+
+    rows = await storage.get_applications_after(0, 10)
+    _expect(len(rows), 3, "количество заявок")
+    _expect([len(row) for row in rows], [8, 8, 8], "поля заявки")
+    _expect(rows[0][2:], (1, 'a', 'Ay', 'One', '+79990000001', 'new'), "заявка с профилем")
+    _expect(rows[1][2:], (404, None, None, None, '+79990000002', 'new'), "заявка без профиля")
+    datetime.strptime(str(rows[0][1])[:19], '%Y-%m-%d %H:%M:%S')
+    _expect([row[2:] for row in await storage.get_applications_after(rows[0][0], 1)],
+            [rows[1][2:]], "заявки после id")
+    _expect(await storage.get_applications_after(rows[-1][0], 10), [], "после последней заявки")
+
+
+async def check_export_state(storage):
+    """Отметки выгрузки и аренда выгрузки одним экземпляром"""
+    _expect(await storage.get_export_state('applications'), None, "отметка до выгрузки")
+    await storage.set_export_state('applications', 5)
+    await storage.set_export_state('applications', 7)
+    _expect(await storage.get_export_state('applications'), '7', "отметка выгрузки")
+
+    _expect(await storage.claim_export('exporter', 'a', 60), True, "захват свободной аренды")
+    _expect(await storage.claim_export('exporter', 'b', 60), False, "захват чужой аренды")
+    _expect(await storage.claim_export('exporter', 'a', 60), True, "продление своей аренды")
+    _expect(await storage.claim_export('exporter', 'b', -1), True, "захват истекшей аренды")
+
+
+CHECKS = (check_users, check_actions, check_applications, check_export_state)
+
+
+async def run_checks(name: str, args, workdir: str) -> dict:
+    """
+    Проверки совместимости; каждая - на пустом хранилище
+
+    Returns:
+        Словарь проверка -> ok или текст ошибки
+    """
+    results = {}
+    for check in CHECKS:
+        storage = await open_backend(name, args, workdir)
+        try:
+            await check(storage)
+            results[check.__name__] = 'ok'
+        except Exception as e:
+            results[check.__name__] = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        finally:
+            await close_backend()
+    return results
+
+
+async def _timed(operations, concurrency: int) -> dict:
+    """Выполнение операций не более чем concurrency одновременно, с задержками каждой"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(operation):
+        async with semaphore:
+            started = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    duration = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'operations': len(latencies),
+        'duration_seconds': duration,
+        'ops_per_second': len(latencies) / duration if duration else 0.0,
+        'p50_ms': _quantile(latencies, 0.5) * 1000,
+        'p99_ms': _quantile(latencies, 0.99) * 1000
+    }
+
+
+async def run_benchmark(name: str, args, workdir: str) -> dict:
+    """Замер основных операций бота на одном хранилище"""
+    rng = random.Random(args.seed)
+    action_types = ['start', 'ai_question', 'button_about', 'button_cases', 'start_application']
+    now = datetime.now()
+    storage = await open_backend(name, args, workdir)
+    try:
+        user_ids = list(range(1, args.users + 1))
+        result = {'save_user': await _timed(
+            [lambda user_id=user_id: storage.save_user(user_id, f'user{user_id}', 'Имя', None)
+             for user_id in user_ids],
+            args.concurrency
+        )}
+
+        actions = [
+            (rng.choice(user_ids), rng.choice(action_types), now - timedelta(seconds=rng.randrange(86400 * 7)))
+            for _ in range(args.actions)
+        ]
+        batches = [actions[i:i + args.batch] for i in range(0, len(actions), args.batch)]
+        result['log_actions'] = await _timed(
+            [lambda batch=batch: storage.log_actions(batch) for batch in batches], args.concurrency)
+        result['log_actions']['rows_per_second'] = (
+            len(actions) / result['log_actions']['duration_seconds']
+            if result['log_actions']['duration_seconds'] else 0.0
+        )
+
+        result['get_user_info'] = await _timed(
+            [lambda: storage.get_user_info(rng.choice(user_ids)) for _ in range(args.users)], args.concurrency)
+        result['save_application'] = await _timed(
+            [lambda: storage.save_application(rng.choice(user_ids), '+79990000000') for _ in range(args.users // 10)],
+            args.concurrency
+        )
+        result['get_statistics'] = await _timed(
+            [storage.get_statistics for _ in range(100)], args.concurrency)
+        return result
+    finally:
+        await close_backend()
+
+
+async def run_suite(args) -> dict:
+    """Проверки и замеры для всех выбранных хранилищ"""
+    import logging
+
+    # Логи каждого действия исказят измерения
+    logging.basicConfig(level=logging.WARNING)
+
+    backends = [name.strip() for name in args.backends.split(',') if name.strip()]
+    result = {
+        'benchmark': 'storage',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': _git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key != 'postgres_dsn'},
+        'backends': {}
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in backends:
+            if name == 'postgres' and not args.postgres_dsn:
+                result['backends'][name] = {'skipped': "не задан --postgres-dsn"}
+                continue
+            backend = {'checks': await run_checks(name, args, workdir)}
+            if not args.check_only:
+                backend['benchmark'] = await run_benchmark(name, args, workdir)
+            result['backends'][name] = backend
+    return result
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    result = asyncio.run(run_suite(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    failed = [
+        f"{name}.{check}" for name, backend in result['backends'].items()
+        for check, status in backend.get('checks', {}).items() if status != 'ok'
+    ]
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        for name, backend in result['backends'].items():
+            if 'benchmark' in backend:
+                print(f"{name}: действий/с {backend['benchmark']['log_actions']['rows_per_second']:.0f}, "
+                      f"save_user p99 {backend['benchmark']['save_user']['p99_ms']:.1f} мс -> {output}")
+    else:
+        print(text)
+    if failed:
+        print(f"Не прошли проверки: {', '.join(failed)}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Сравнение двух результатов bench_bot
+
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+
+Код возврата 1, если какой-либо показатель ухудшился больше порога.
+"""
+import argparse
+import json
+import sys
+
+# Показатель: (путь в JSON, больше - лучше)
+METRICS = {
+    'updates/s': (('updates_per_second',), True),
+    'p50, мс': (('latency', 'p50_ms'), False),
+    'p90, мс': (('latency', 'p90_ms'), False),
+    'p99, мс': (('latency', 'p99_ms'), False),
+    'строк БД/с': (('db', 'rows_per_second'), True),
+    'запросов БД': (('db', 'statements'), False),
+    'peak RSS, МБ': (('peak_rss_mb',), False)
+}
+
+
+def _get(result: dict, path: tuple):
+    """Значение по пути в JSON или None"""
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(before: dict, after: dict, threshold: float) -> tuple:
+    """
+    Сравнение результатов
+
+    Returns:
+        (строки отчета, список ухудшившихся показателей)
+    """
+    lines = [f"{'показатель':<16}{'до':>12}{'после':>12}{'изменение':>12}"]
+    regressions = []
+    for name, (path, higher_is_better) in METRICS.items():
+        old, new = _get(before, path), _get(after, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        mark = ''
+        if worse > threshold:
+            regressions.append(name)
+            mark = '  ✗'
+        lines.append(f"{name:<16}{old:>12.1f}{new:>12.1f}{change:>+11.1%}{mark}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сравнение результатов нагрузочного теста")
+    parser.add_argument('before', help="JSON базового прогона")
+    parser.add_argument('after', help="JSON нового прогона")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Допустимое ухудшение (доля, по умолчанию 0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    with open(args.before, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, encoding='utf-8') as f:
+        after = json.load(f)
+
+    if before.get('config', {}).get('updates') != after.get('config', {}).get('updates'):
+        print("⚠️ Прогоны выполнены с разными параметрами - сравнение может быть некорректным")
+    lines, regressions = compare(before, after, args.threshold)
+    print('\n'.join(lines))
+    if regressions:
+        print(f"\nУхудшение больше {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from urllib.parse import parse_qs
+from http_server import HTTPServer, Response
+from google_sheets import GoogleSheetsManager
+
+
+class LatencyModel:
+    """Задержка и ошибки заглушки: логнормальная задержка и доля ответов с ошибкой"""
+
+    def __init__(self, median: float = 0.0, sigma: float = 0.5,
+                 error_rate: float = 0.0, error_status: int = 500, seed: int = None):
+        """
+        Инициализация модели
+
+        Args:
+            median: Медиана задержки (сек); 0 - без задержки
+            sigma: Разброс логнормального распределения
+            error_rate: Доля запросов, на которые возвращается ошибка
+            error_status: HTTP код ошибки
+            seed: Зерно генератора для воспроизводимости
+        """
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+
+    def delay(self) -> float:
+        """Случайная задержка ответа"""
+        if self.median <= 0:
+            return 0.0
+        return self._random.lognormvariate(math.log(self.median), self.sigma)
+
+    def is_error(self) -> bool:
+        """Вернуть ли ошибку на этот запрос"""
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    async def wait(self):
+        """Ожидание случайной задержки"""
+        delay = self.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class MockTelegramServer(HTTPServer):
+    """Заглушка Telegram Bot API: отвечает на любой метод по пути /bot<token>/<method>"""
+
+    def __init__(self, latency: LatencyModel = None, host: str = '127.0.0.1', port: int = 0):
+        super().__init__(host, port, max_body_size=20 * 1024 * 1024)
+        self.latency = latency or LatencyModel()
+        self.calls = {}
+        self.errors = 0
+        self._message_ids = itertools.count(1)
+
+    @property
+    def base_url(self) -> str:
+        """Адрес для TELEGRAM_BASE_URL"""
+        return f'http://{self.host}:{self.port}'
+
+    async def _dispatch(self, request) -> Response:
+        """Ответ на вызов метода Bot API"""
+        parts = request.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            return Response.text('Not Found', 404)
+        method = parts[1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        await self.latency.wait()
+        if self.latency.is_error():
+            self.errors += 1
+            return Response.json({'ok': False, 'error_code': self.latency.error_status,
+                                  'description': 'Mock error'}, self.latency.error_status)
+
+        return Response.json({'ok': True, 'result': self._result(method, self._params(request))})
+
+    def _params(self, request) -> dict:
+        """Параметры вызова (form-urlencoded или JSON; файлы не разбираются)"""
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return request.json()
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return {key: values[-1] for key, values in parse_qs(request.body.decode('utf-8')).items()}
+        return {}
+
+    def _result(self, method: str, params: dict):
+        """Правдоподобный результат метода"""
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method in ('getUpdates',):
+            return []
+        if method in ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument'):
+            chat_id = int(params.get('chat_id') or 0)
+            message = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}
+            }
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': 'bench-photo', 'file_unique_id': 'bench-photo',
+                                     'width': 640, 'height': 480}]
+            else:
+                message['text'] = params.get('text') or ''
+            return message
+        return True
+
+
+class MockGrokServer(HTTPServer):
+    """Заглушка Grok chat completions (обычные и потоковые ответы)"""
+
+    def __init__(self, latency: LatencyModel = None, answer_chars: int = 600,
+                 stream_chunks: int = 20, host: str = '127.0.0.1', port: int = 0):
+        super().__init__(host, port)
+        self.latency = latency or LatencyModel()
+        self.answer_chars = answer_chars
+        self.stream_chunks = stream_chunks
+        self.requests = 0
+        self.errors = 0
+        self.route('POST', '/v1/chat/completions', self._handle_completion)
+
+    @property
+    def url(self) -> str:
+        """Адрес для grok_client.GROK_API_URL"""
+        return f'http://{self.host}:{self.port}/v1/chat/completions'
+
+    async def _handle_completion(self, request) -> Response:
+        """Ответ на запрос chat completions"""
+        self.requests += 1
+        payload = request.json()
+        await self.latency.wait()
+        if self.latency.is_error():
+            self.errors += 1
+            return Response.json({'error': 'Mock error'}, self.latency.error_status)
+
+        question = payload['messages'][-1]['content']
+        answer = (f"Ответ на «{question[:50]}». " * (self.answer_chars // 40 + 1))[:self.answer_chars]
+
+        if not payload.get('stream'):
+            return Response.json({'choices': [{'message': {'role': 'assistant', 'content': answer}}]})
+
+        # Весь поток SSE отдается одним ответом - клиенту важен только формат
+        size = max(1, len(answer) // self.stream_chunks)
+        events = [
+            'data: ' + json.dumps({'choices': [{'delta': {'content': answer[i:i + size]}}]}, ensure_ascii=False)
+            for i in range(0, len(answer), size)
+        ]
+        events.append('data: [DONE]')
+        return Response(200, ('\n\n'.join(events) + '\n\n').encode('utf-8'), 'text/event-stream')
+
+
+class FakeSheetsManager(GoogleSheetsManager):
+    """GoogleSheetsManager без Google: листы из памяти с задержкой чтения"""
+
+    def __init__(self, sheets: dict = None, latency: LatencyModel = None, settings_ttl: float = 60.0):
+        super().__init__('', '', settings_ttl)
+        self.sheets = sheets or {
+            'Настройки': [
+                ['System Prompt', 'Ты ассистент для нагрузочного теста. Отвечай кратко.'],
+                ['AI_Model', 'grok-3-mini'],
+                ['AI_Temperature', '0.7'],
+                ['AI_MaxTokens', '500']
+            ],
+            # Пустой лист - используется меню по умолчанию
+            'Меню': []
+        }
+        self.latency = latency or LatencyModel()
+        self.reads = 0
+
+    def connect(self):
+        """Подключение не требуется"""
+        return True
+
+    def _fetch_settings(self, worksheet_name: str) -> list:
+        """Чтение листа из памяти с задержкой (вызывается в отдельном потоке)"""
+        self.reads += 1
+        delay = self.latency.delay()
+        if delay:
+            time.sleep(delay)
+        if worksheet_name not in self.sheets:
+            self.cache_stats['refresh_errors'] += 1
+            raise KeyError(f"Лист '{worksheet_name}' не найден")
+        values = self.sheets[worksheet_name]
+        self._settings_cache[worksheet_name] = (values, time.monotonic())
+        self.cache_stats['refreshes'] += 1
+        return values
@@ -1,11 +1,35 @@
+import startup
+
+# Замер импортов: отчет о запуске показывает, какие модули загружаются дольше всего
+startup.get_startup_timer().track_imports()
+
+import asyncio
+import contextlib
 import logging
-import httpx
 import os
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+import ai_cache
+import broadcast
+import cluster
 import database
+import dialogue
 import google_sheets
+import grok_client
+import media
+import menu
+import metrics
+import notifications
+import retention
+import scheduler
+import sheets_export
+import webhook
+from grok_client import GrokAPIError
+from scheduler import PerUserUpdateProcessor, SchedulerBusy
+
+startup.get_startup_timer().stop_tracking_imports()
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -21,21 +45,168 @@ logger = logging.getLogger(__name__)
 TOKEN = os.getenv('BOT_TOKEN')
 GROK_API_KEY = os.getenv('GROK_API_KEY')
 ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))
+# Адрес Bot API (например, локальный сервер telegram-bot-api); пусто - api.telegram.org
+TELEGRAM_BASE_URL = os.getenv('TELEGRAM_BASE_URL', '')
 
 # Google Sheets конфигурация
 GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
 GOOGLE_SPREADSHEET_ID = os.getenv('GOOGLE_SPREADSHEET_ID', '')
+SHEETS_SETTINGS_TTL = float(os.getenv('SHEETS_SETTINGS_TTL', '60'))
+# Пауза перед повторным подключением к Google Sheets (удваивается до 10 минут)
+SHEETS_CONNECT_RETRY = float(os.getenv('SHEETS_CONNECT_RETRY', '30'))
+
+# Выгрузка заявок (и агрегатов по дням) в Google Sheets; требует права записи в таблицу
+SHEETS_EXPORT_ENABLED = os.getenv('SHEETS_EXPORT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+SHEETS_EXPORT_INTERVAL = float(os.getenv('SHEETS_EXPORT_INTERVAL', '60'))
+SHEETS_EXPORT_BATCH = int(os.getenv('SHEETS_EXPORT_BATCH', '500'))
+SHEETS_EXPORT_ROLLUPS = os.getenv('SHEETS_EXPORT_ROLLUPS', 'false').lower() in ('1', 'true', 'yes')
+
+# Пул соединений к Grok API
+GROK_MAX_CONNECTIONS = int(os.getenv('GROK_MAX_CONNECTIONS', '20'))
+GROK_MAX_KEEPALIVE = int(os.getenv('GROK_MAX_KEEPALIVE', '10'))
+GROK_KEEPALIVE_EXPIRY = float(os.getenv('GROK_KEEPALIVE_EXPIRY', '30'))
+GROK_HTTP2 = os.getenv('GROK_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+GROK_CONNECT_TIMEOUT = float(os.getenv('GROK_CONNECT_TIMEOUT', '5'))
+GROK_READ_TIMEOUT = float(os.getenv('GROK_READ_TIMEOUT', '30'))
+GROK_WRITE_TIMEOUT = float(os.getenv('GROK_WRITE_TIMEOUT', '10'))
+GROK_POOL_TIMEOUT = float(os.getenv('GROK_POOL_TIMEOUT', '5'))
+
+# Повторы, дублирующие запросы и автоматический выключатель Grok
+GROK_MAX_RETRIES = int(os.getenv('GROK_MAX_RETRIES', '2'))
+GROK_RETRY_BASE = float(os.getenv('GROK_RETRY_BASE', '0.5'))
+GROK_RETRY_MAX_DELAY = float(os.getenv('GROK_RETRY_MAX_DELAY', '5'))
+GROK_HEDGE = os.getenv('GROK_HEDGE', 'false').lower() in ('1', 'true', 'yes')
+GROK_HEDGE_MIN_DELAY = float(os.getenv('GROK_HEDGE_MIN_DELAY', '1'))
+GROK_BREAKER_THRESHOLD = int(os.getenv('GROK_BREAKER_THRESHOLD', '5'))
+GROK_BREAKER_RECOVERY = float(os.getenv('GROK_BREAKER_RECOVERY', '30'))
+
+# Состояния выключателя Grok для /stats
+BREAKER_STATE_NAMES = {'closed': 'закрыт', 'half_open': 'пробный запрос', 'open': 'открыт'}
+
+# Статусы рассылки для /stats и /broadcast
+BROADCAST_STATUS_NAMES = {'running': 'идет', 'paused': 'приостановлена', 'done': 'завершена'}
+
+# Потоковые ответы Grok (правка сообщения по мере генерации)
+GROK_STREAMING = os.getenv('GROK_STREAMING', 'false').lower() in ('1', 'true', 'yes')
+GROK_STREAM_EDIT_INTERVAL = float(os.getenv('GROK_STREAM_EDIT_INTERVAL', '1.5'))
+GROK_STREAM_MIN_CHARS = int(os.getenv('GROK_STREAM_MIN_CHARS', '40'))
+
+# Максимальная длина промежуточного текста (лимит сообщения Telegram - 4096)
+STREAM_PREVIEW_LIMIT = 4000
+
+# Хранилище пользователей, действий и заявок: sqlite (файл рядом с ботом) или postgres
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite').lower()
+POSTGRES_DSN = os.getenv('POSTGRES_DSN', '')
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', '1'))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', '10'))
+POSTGRES_STATEMENT_CACHE = int(os.getenv('POSTGRES_STATEMENT_CACHE', '100'))
+
+# Пакетная запись действий пользователей
+ACTION_BATCH_SIZE = int(os.getenv('ACTION_BATCH_SIZE', '100'))
+ACTION_FLUSH_INTERVAL = float(os.getenv('ACTION_FLUSH_INTERVAL', '2'))
+ACTION_QUEUE_MAX = int(os.getenv('ACTION_QUEUE_MAX', '10000'))
+ACTION_QUEUE_POLICY = os.getenv('ACTION_QUEUE_POLICY', 'drop_oldest')
+
+# Хранение действий: построчно за последние N дней (0 - всегда), старше - агрегаты и архив по месяцам
+ACTIONS_RETENTION_DAYS = int(os.getenv('ACTIONS_RETENTION_DAYS', '0'))
+ACTIONS_ARCHIVE_DIR = os.getenv('ACTIONS_ARCHIVE_DIR', 'archive')
+ACTIONS_RETENTION_INTERVAL = float(os.getenv('ACTIONS_RETENTION_INTERVAL', '21600'))
+
+# Рассылка всем пользователям (/broadcast): скорость, параллельность, размер пакета
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_CHUNK = int(os.getenv('BROADCAST_CHUNK', '100'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '15'))
+# Рассылка ждет, пока столько или больше обработчиков отвечают пользователям
+BROADCAST_YIELD_HANDLERS = int(os.getenv('BROADCAST_YIELD_HANDLERS', '10'))
+
+# Очередь уведомлений администратору о заявках
+NOTIFY_POLL_INTERVAL = float(os.getenv('NOTIFY_POLL_INTERVAL', '5'))
+NOTIFY_DIGEST_WINDOW = float(os.getenv('NOTIFY_DIGEST_WINDOW', '1'))
+NOTIFY_MAX_DIGEST = int(os.getenv('NOTIFY_MAX_DIGEST', '20'))
+NOTIFY_RETRY_BASE = float(os.getenv('NOTIFY_RETRY_BASE', '5'))
+NOTIFY_RETRY_MAX = float(os.getenv('NOTIFY_RETRY_MAX', '600'))
+
+# Кэш профилей пользователей
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_SEEN_DEBOUNCE = float(os.getenv('USER_SEEN_DEBOUNCE', '300'))
+
+# Кэш ответов AI
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '1000'))
+AI_CACHE_MAX_BYTES = int(os.getenv('AI_CACHE_MAX_BYTES', str(5 * 1024 * 1024)))
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '3600'))
+AI_CACHE_FILE = os.getenv('AI_CACHE_FILE', '')
+
+# Память диалогов
+DIALOGUE_ENABLED = os.getenv('DIALOGUE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+DIALOGUE_HISTORY_TOKENS = int(os.getenv('DIALOGUE_HISTORY_TOKENS', '1500'))
+DIALOGUE_MAX_TURNS = int(os.getenv('DIALOGUE_MAX_TURNS', '10'))
+DIALOGUE_MAX_USERS = int(os.getenv('DIALOGUE_MAX_USERS', '5000'))
+DIALOGUE_MAX_TOTAL_TOKENS = int(os.getenv('DIALOGUE_MAX_TOTAL_TOKENS', '2000000'))
+DIALOGUE_IDLE_TTL = float(os.getenv('DIALOGUE_IDLE_TTL', '1800'))
+DIALOGUE_FILE = os.getenv('DIALOGUE_FILE', '')
+
+# Планировщик запросов к Grok
+GROK_MAX_CONCURRENT = int(os.getenv('GROK_MAX_CONCURRENT', '8'))
+GROK_MAX_QUEUE = int(os.getenv('GROK_MAX_QUEUE', '100'))
+GROK_MAX_WAIT = float(os.getenv('GROK_MAX_WAIT', '10'))
+GROK_USER_RATE = float(os.getenv('GROK_USER_RATE', '0.2'))
+GROK_USER_BURST = int(os.getenv('GROK_USER_BURST', '3'))
+
+# Сколько обновлений Telegram обрабатывать одновременно
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Ответы при перегрузке
+BUSY_TEXT = "⏳ Сейчас очень много вопросов. Пожалуйста, попробуйте через минуту."
+RATE_LIMITED_TEXT = "✋ Вы задаете вопросы слишком часто. Подождите немного и попробуйте снова."
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Режим кластера (BOT_MODE=cluster): несколько рабочих процессов
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', str(os.cpu_count() or 2)))
+CLUSTER_QUEUE_SIZE = int(os.getenv('CLUSTER_QUEUE_SIZE', '1000'))
+CLUSTER_WEBHOOK = os.getenv('CLUSTER_WEBHOOK', 'false').lower() in ('1', 'true', 'yes')
+SETTINGS_SNAPSHOT_FILE = os.getenv('SETTINGS_SNAPSHOT_FILE', 'settings_snapshot.json')
+
+# Номер рабочего процесса кластера (None - бот работает одним процессом)
+CLUSTER_WORKER_INDEX = None
+
+# HTTP сервер метрик Prometheus (0 - выключен); в кластере процесс N слушает METRICS_PORT + N + 1
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
+# Бот обрабатывает только сообщения - остальные типы обновлений не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE]
 
 # Состояния для обработки заявки
 WAITING_FOR_PHONE = 1
 
+# Клавиатура на время ввода номера телефона
+CANCEL_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("❌ Отмена")]], resize_keyboard=True)
+
+# Листы Google Sheets, которые бот загружает при запуске и по /reload
+SETTINGS_WORKSHEETS = ("Настройки", menu.MENU_WORKSHEET)
 
+# Фоновое подключение к Google Sheets (бот отвечает, не дожидаясь его)
+_sheets_connect_task = None
+
+
+@metrics.instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start - приветствует пользователя и показывает клавиатуру"""
     user = update.effective_user
     
     # Сохраняем информацию о пользователе
-    database.save_user(
+    await database.save_user_async(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -43,87 +214,239 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
     
     # Логируем действие
-    database.log_action(user.id, 'start')
-    
-    # Создаем кнопки клавиатуры
-    keyboard = [
-        [KeyboardButton("О нас"), KeyboardButton("Кейсы")],
-        [KeyboardButton("👤 Руководитель"), KeyboardButton("📞 Номер телефона")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True,  # Подстраивает размер кнопок под экран
-        one_time_keyboard=False  # Клавиатура не исчезает после нажатия
-    )
+    await database.log_action_async(user.id, 'start')
+    
+    # /start начинает разговор с AI заново
+    memory = dialogue.get_dialogue_memory()
+    if memory:
+        await memory.clear(user.id)
     
-    # Приветствие пользователя
+    # Приветствие пользователя с клавиатурой главного меню
     await update.message.reply_text(
         f'Привет, {user.first_name}! 👋\n\n'
         f'Я бот-помощник. Выберите интересующий раздел:',
-        reply_markup=reply_markup
+        reply_markup=menu.get_menu().main_keyboard
     )
 
 
-async def ask_grok(question: str) -> str:
+def build_grok_payload(question: str, history: list = None) -> dict:
+    """Формирование запроса к Grok AI с промптом, историей диалога и параметрами из Google Sheets"""
+    # Получаем системный промпт из Google Sheets
+    sheets_manager = google_sheets.get_sheets_manager()
+    if sheets_manager:
+        system_prompt = sheets_manager.get_system_prompt()
+        ai_params = sheets_manager.get_ai_parameters()
+    else:
+        # Значения по умолчанию, если Google Sheets недоступен
+        system_prompt = google_sheets.DEFAULT_SYSTEM_PROMPT
+        ai_params = google_sheets.DEFAULT_AI_PARAMS
+    
+    return {
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            *(history or []),
+            {
+                "role": "user",
+                "content": question
+            }
+        ],
+        "model": ai_params.get('model', 'grok-3-mini'),
+        "stream": False,
+        "temperature": ai_params.get('temperature', 0.7),
+        "max_tokens": ai_params.get('max_tokens', google_sheets.DEFAULT_AI_PARAMS['max_tokens'])
+    }
+
+
+async def get_dialogue_history(user_id: int) -> list:
+    """История диалога пользователя для запроса к Grok (пустая, если память отключена)"""
+    memory = dialogue.get_dialogue_memory()
+    if not memory or user_id is None:
+        return []
+    return await memory.history(user_id)
+
+
+async def remember_dialogue(user_id: int, question: str, answer: str) -> None:
+    """Сохранение вопроса и ответа в истории пользователя"""
+    memory = dialogue.get_dialogue_memory()
+    if memory and user_id is not None:
+        await memory.append(user_id, question, answer)
+
+
+def get_cached_grok_answer(question: str, payload: dict):
+    """Ответ на вопрос из кэша или None"""
+    cache = ai_cache.get_answer_cache()
+    if not cache:
+        return None
+    return cache.get(ai_cache.make_cache_key(question, payload))
+
+
+async def remember_grok_answer(question: str, payload: dict, answer: str) -> None:
+    """Сохранение успешного ответа Grok в кэше"""
+    cache = ai_cache.get_answer_cache()
+    if cache:
+        await cache.put(
+            ai_cache.make_cache_key(question, payload),
+            answer,
+            ai_cache.settings_fingerprint(payload)
+        )
+
+
+def grok_slot(user_id):
+    """Слот планировщика для запроса к Grok (без ограничений, если планировщик не запущен)"""
+    request_scheduler = scheduler.get_scheduler()
+    if request_scheduler is None:
+        return contextlib.nullcontext()
+    return request_scheduler.slot(user_id)
+
+
+async def fetch_grok_answer(question: str, payload: dict, user_id: int = None) -> str:
+    """Запрос ответа у Grok API (без обработки ошибок) и сохранение его в кэше"""
+    async with grok_slot(user_id):
+        return await _fetch_grok_answer(question, payload)
+
+
+async def _fetch_grok_answer(question: str, payload: dict) -> str:
+    """Запрос ответа у Grok API (слот планировщика уже получен)"""
+    client = grok_client.get_grok_client()
+    response = await client.chat_completion(payload)
+    
+    if response.status_code != 200:
+        raise GrokAPIError(response.status_code, response.text)
+    
+    data = response.json()
+    answer = data['choices'][0]['message']['content']
+    await remember_grok_answer(question, payload, answer)
+    return answer
+
+
+async def ask_grok(question: str, payload: dict = None, user_id: int = None) -> str:
     """Отправка вопроса к Grok AI и получение ответа"""
     try:
-        # Получаем системный промпт из Google Sheets
-        sheets_manager = google_sheets.get_sheets_manager()
-        if sheets_manager:
-            system_prompt = sheets_manager.get_system_prompt()
-            ai_params = sheets_manager.get_ai_parameters()
-        else:
-            # Значения по умолчанию, если Google Sheets недоступен
-            system_prompt = "Ты helpful AI-ассистент. Отвечай на русском языке кратко и по делу."
-            ai_params = {
-                'model': 'grok-beta',
-                'temperature': 0.7
-            }
+        if payload is None:
+            payload = build_grok_payload(question, await get_dialogue_history(user_id))
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.x.ai/v1/chat/completions",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {GROK_API_KEY}"
-                },
-                json={
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": question
-                        }
-                    ],
-                    "model": ai_params.get('model', 'grok-3-mini'),
-                    "stream": False,
-                    "temperature": ai_params.get('temperature', 0.7)
-                }
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return data['choices'][0]['message']['content']
-            else:
-                logger.error(f"Grok API error: {response.status_code} - {response.text}")
-                return "Извините, произошла ошибка при обработке вашего вопроса. Попробуйте позже."
-                
+        # Одинаковые вопросы, заданные одновременно, получают ответ одного запроса
+        answer = await ai_cache.get_single_flight().do(
+            ai_cache.make_cache_key(question, payload),
+            lambda: fetch_grok_answer(question, payload, user_id)
+        )
+        await remember_dialogue(user_id, question, answer)
+        return answer
+    except SchedulerBusy as e:
+        logger.warning(f"Grok перегружен: {e.reason}")
+        return BUSY_TEXT
+    except GrokAPIError as e:
+        logger.error(f"Grok API error: {e.status_code} - {e.text}")
+        return "Извините, произошла ошибка при обработке вашего вопроса. Попробуйте позже."
     except Exception as e:
         logger.error(f"Error calling Grok API: {e}")
         return "Произошла ошибка при связи с AI. Пожалуйста, попробуйте позже."
 
 
+async def stream_grok_answer(question: str, payload: dict, placeholder, user_id: int = None) -> str:
+    """Потоковый запрос к Grok: заглушка редактируется по мере генерации текста"""
+    async with grok_slot(user_id):
+        return await _stream_grok_answer(question, payload, placeholder)
+
+
+async def _stream_grok_answer(question: str, payload: dict, placeholder) -> str:
+    """Чтение потока Grok с правкой сообщения-заглушки (слот планировщика уже получен)"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    last_edit = started
+    shown_text = ""
+    chunks = []
+    
+    try:
+        client = grok_client.get_grok_client()
+        async for chunk in client.stream_chat_completion(payload):
+            if not chunks:
+                logger.info(f"Grok: первый токен через {loop.time() - started:.2f} с")
+            chunks.append(chunk)
+            
+            # Склеиваем фрагменты и редактируем не чаще раза в интервал,
+            # чтобы не упереться в лимиты Telegram на редактирование
+            text = "".join(chunks)
+            if (loop.time() - last_edit < GROK_STREAM_EDIT_INTERVAL
+                    or len(text) - len(shown_text) < GROK_STREAM_MIN_CHARS):
+                continue
+            
+            # Промежуточные версии без разметки: незакрытый Markdown Telegram не примет
+            preview = f"🤖 Grok AI отвечает:\n\n{text[:STREAM_PREVIEW_LIMIT]}…"
+            try:
+                await placeholder.edit_text(preview)
+                shown_text = text
+            except RetryAfter as e:
+                last_edit = loop.time() + e.retry_after
+                continue
+            except BadRequest as e:
+                logger.warning(f"Не удалось обновить потоковый ответ: {e}")
+            last_edit = loop.time()
+    except (GrokAPIError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        # Поток оборвался на середине: обрывок - не ответ, его нельзя ни кэшировать,
+        # ни запоминать в диалоге. Повторяем запрос целиком без потока (в том же слоте)
+        if not chunks:
+            raise
+        logger.warning(f"Поток Grok оборвался ({e}), повторяем запрос без потока")
+        return await _fetch_grok_answer(question, payload)
+    
+    ai_response = "".join(chunks)
+    if not ai_response:
+        raise ValueError("Пустой ответ Grok API")
+    await remember_grok_answer(question, payload, ai_response)
+    return ai_response
+
+
+async def reply_with_grok_stream(update: Update, question: str, payload: dict) -> None:
+    """Потоковый ответ Grok AI с финальной версией в Markdown"""
+    placeholder = await update.message.reply_text("🤖 Grok AI отвечает:\n\n⏳")
+    
+    try:
+        # Если такой же вопрос уже генерируется, ждем его ответ вместо нового запроса
+        ai_response = await ai_cache.get_single_flight().do(
+            ai_cache.make_cache_key(question, payload),
+            lambda: stream_grok_answer(question, payload, placeholder, update.effective_user.id)
+        )
+    except SchedulerBusy as e:
+        logger.warning(f"Grok перегружен: {e.reason}")
+        await placeholder.edit_text(BUSY_TEXT)
+        return
+    except GrokAPIError as e:
+        logger.error(f"Grok API error: {e.status_code} - {e.text}")
+        await placeholder.edit_text("Извините, произошла ошибка при обработке вашего вопроса. Попробуйте позже.")
+        return
+    except Exception as e:
+        logger.error(f"Error calling Grok API: {e}")
+        await placeholder.edit_text("Произошла ошибка при связи с AI. Пожалуйста, попробуйте позже.")
+        return
+    
+    await remember_dialogue(update.effective_user.id, question, ai_response)
+    
+    # Финальная версия - с Markdown, как у обычного ответа
+    try:
+        await placeholder.edit_text(
+            f"🤖 *Grok AI отвечает:*\n\n{ai_response}",
+            parse_mode='Markdown'
+        )
+    except BadRequest as e:
+        logger.warning(f"Не удалось применить Markdown к ответу: {e}")
+        await placeholder.edit_text(f"🤖 Grok AI отвечает:\n\n{ai_response}")
+
+
+@metrics.instrument_handler
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /stats - показывает статистику администратору"""
     user = update.effective_user
     
     # Проверяем права доступа
     if user.id == ADMIN_ID:
-        database.log_action(user.id, 'view_statistics')
-        stats_data = database.get_statistics()
+        await database.log_action_async(user.id, 'view_statistics')
+        stats_data = await database.get_statistics_async()
         
         # Формируем сообщение со статистикой
         message = "📊 *СТАТИСТИКА БОТА*\n\n"
@@ -136,13 +459,20 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 'start': '🚀 /start',
                 'button_about': '📌 О нас',
                 'button_cases': '💼 Кейсы',
-                'view_statistics': '📊 Статистика'
+                'view_statistics': '📊 Статистика',
+                'ai_question': '🤖 Вопросы AI',
+                'ai_cache_hit': '⚡ Ответы AI из кэша'
             }
             for action_type, count in stats_data['actions_stats']:
                 action_name = action_names.get(action_type, action_type)
                 percentage = (count / total_actions * 100) if total_actions > 0 else 0
                 message += f"  • {action_name}: {count} ({percentage:.1f}%)\n"
             message += f"\n✅ Всего действий: *{total_actions}*\n\n"
+            
+            action_counts = dict(stats_data['actions_stats'])
+            if action_counts.get('ai_question'):
+                hit_ratio = action_counts.get('ai_cache_hit', 0) / action_counts['ai_question'] * 100
+                message += f"⚡ Доля ответов AI из кэша: *{hit_ratio:.1f}%*\n\n"
         
         if stats_data['top_users']:
             message += "🏆 *ТОП-5 пользователей:*\n"
@@ -150,6 +480,135 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 username_str = f"@{username}" if username else "без username"
                 message += f"{i}. {first_name} ({username_str}) - {action_count} действий\n"
         
+        if stats_data['daily_stats']:
+            message += "\n📅 *Действия за 7 дней:*\n"
+            for day, count in stats_data['daily_stats']:
+                message += f"  • {day}: {count}\n"
+        
+        client = grok_client.get_grok_client()
+        if client:
+            pool = client.get_pool_stats()
+            message += (
+                "\n🌐 *Пул Grok:*\n"
+                f"  • Запросов: {pool['requests']} (ошибок: {pool['errors']})\n"
+                f"  • В работе: {pool['in_flight']}, пик: {pool['peak_in_flight']}\n"
+                f"  • Соединений: {pool['open_connections']}/{pool['max_connections']} "
+                f"(простаивают: {pool['idle_connections']})\n"
+                f"  • Таймауты пула: {pool['pool_timeouts']}\n"
+                f"  • Повторов: {pool['retries']}, дублирующих запросов: {pool['hedged']} "
+                f"(быстрее основного: {pool['hedge_wins']})\n"
+                f"  • Выключатель: {BREAKER_STATE_NAMES[pool['breaker_state']]} (срабатываний: {pool['breaker_opened']}, "
+                f"отклонено: {pool['breaker_rejected']})\n"
+                f"  • Объединено одинаковых запросов: {ai_cache.get_single_flight().get_stats()['coalesced']}\n"
+            )
+        
+        storage_stats = database.get_storage().get_stats()
+        if 'pool_size' in storage_stats:
+            message += (
+                "\n🐘 *PostgreSQL:*\n"
+                f"  • Соединений в пуле: {storage_stats['pool_size']}, свободно: {storage_stats['pool_idle']}\n"
+            )
+        
+        buffer = database.get_action_buffer()
+        if buffer:
+            buffer_stats = buffer.get_stats()
+            message += (
+                "\n🗂 *Буфер действий:*\n"
+                f"  • В очереди: {buffer_stats['queue_depth']}, потеряно: {buffer_stats['dropped']}\n"
+                f"  • Записано: {buffer_stats['flushed']} за {buffer_stats['batches']} пакетов\n"
+                f"  • Запись пакета: {buffer_stats['avg_flush_seconds'] * 1000:.1f} мс "
+                f"(макс. {buffer_stats['max_flush_seconds'] * 1000:.1f} мс)\n"
+            )
+        
+        action_retention = retention.get_action_retention()
+        if action_retention:
+            retention_stats = action_retention.get_stats()
+            db_size = sum(
+                os.path.getsize(path) for path in (database.DB_FILE, database.DB_FILE + '-wal')
+                if os.path.exists(path)
+            )
+            message += (
+                "\n🧹 *Хранение действий:*\n"
+                f"  • Построчно за {action_retention.keep_days} дн., размер БД: {db_size / 1024 / 1024:.1f} МБ\n"
+                f"  • Свернуто дней: {retention_stats['days']}, строк: {retention_stats['archived']}, "
+                f"освобождено страниц: {retention_stats['freed_pages']}, ошибок: {retention_stats['errors']}\n"
+            )
+        
+        engine = broadcast.get_broadcast_engine()
+        last_broadcast = await database.get_broadcast_async()
+        if engine and last_broadcast:
+            engine_stats = engine.get_stats()
+            message += (
+                "\n📣 *Рассылка:*\n"
+                f"  • Последняя #{last_broadcast['id']}: {BROADCAST_STATUS_NAMES.get(last_broadcast['status'], last_broadcast['status'])}, "
+                f"доставлено {last_broadcast['sent']} из {last_broadcast['total']}\n"
+                f"  • В этом процессе: доставлено {engine_stats['sent']}, заблокировали {engine_stats['blocked']}, "
+                f"ошибок {engine_stats['failed']}, ограничений Telegram {engine_stats['retry_after']}\n"
+            )
+        
+        outbox = notifications.get_notification_outbox()
+        if outbox:
+            outbox_stats = outbox.get_stats()
+            pending = await database.count_pending_notifications_async()
+            message += (
+                "\n🔔 *Уведомления о заявках:*\n"
+                f"  • Отправлено: {outbox_stats['sent']} ({outbox_stats['messages']} сообщений, "
+                f"сводок: {outbox_stats['digests']}), ожидают: {pending}\n"
+                f"  • Повторов: {outbox_stats['retries']}, ограничений Telegram: {outbox_stats['retry_after']}\n"
+            )
+        
+        exporter = sheets_export.get_sheets_exporter()
+        if exporter:
+            export_stats = exporter.get_stats()
+            last_export = export_stats['last_export']
+            message += (
+                "\n📤 *Выгрузка в Google Sheets:*\n"
+                f"  • Заявок: {export_stats['applications']}, строк по дням: {export_stats['rollups']}\n"
+                f"  • Запросов: {export_stats['requests']}, ошибок: {export_stats['errors']}, "
+                f"последняя: {last_export.strftime('%H:%M:%S') if last_export else 'еще не было'}\n"
+            )
+        
+        request_scheduler = scheduler.get_scheduler()
+        if request_scheduler:
+            queue = request_scheduler.get_stats()
+            rejected = (queue['rejected_rate_limited'] + queue['rejected_queue_full']
+                        + queue['rejected_timeout'])
+            message += (
+                "\n🚦 *Очередь Grok:*\n"
+                f"  • В работе: {queue['running']}/{queue['max_concurrent']}, "
+                f"в очереди: {queue['queued']}\n"
+                f"  • Ожидание: {queue['avg_wait_seconds']:.2f} с "
+                f"(макс. {queue['max_wait_seconds']:.2f} с)\n"
+                f"  • Отказов: {rejected} (лимит пользователя: {queue['rejected_rate_limited']}, "
+                f"очередь: {queue['rejected_queue_full']}, ожидание: {queue['rejected_timeout']})\n"
+            )
+        
+        user_cache = database.get_user_cache().get_stats()
+        message += (
+            "\n👤 *Кэш пользователей:*\n"
+            f"  • Профилей: {user_cache['size']}, попаданий: {user_cache['hits']}, "
+            f"промахов: {user_cache['misses']}\n"
+            f"  • Пропущено записей: {user_cache['skipped_writes']}\n"
+        )
+
+        media_stats = media.get_media_registry().get_stats()
+        message += (
+            "\n🖼 *Медиафайлы:*\n"
+            f"  • Отправлено по file_id: {media_stats['cached']}, загрузок: {media_stats['uploads']}, "
+            f"отклонено file_id: {media_stats['rejected']}\n"
+        )
+
+        memory = dialogue.get_dialogue_memory()
+        if memory:
+            memory_stats = memory.get_stats()
+            message += (
+                "\n💬 *Память диалогов:*\n"
+                f"  • Диалогов: {memory_stats['users']}, токенов: {memory_stats['tokens']}\n"
+                f"  • Вытеснено: {memory_stats['evicted_idle']} по времени, "
+                f"{memory_stats['evicted_capacity']} по объему (в файл: {memory_stats['spilled']}, "
+                f"восстановлено: {memory_stats['restored']})\n"
+            )
+
         await update.message.reply_text(message, parse_mode='Markdown')
     else:
         # Для обычных пользователей статистика недоступна
@@ -158,112 +617,263 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик текстовых сообщений (нажатий на кнопки)"""
-    text = update.message.text
+def _format_latency_rows(title: str, rows: list, label: str, limit: int = 5) -> str:
+    """Строки /perf для гистограммы: количество и квантили по наборам меток"""
+    if not rows:
+        return ""
+    text = f"\n{title}:\n"
+    for row in rows[:limit]:
+        labels = row['labels']
+        name = labels.get(label, '')
+        status = labels.get('status')
+        if status and status not in ('ok', '200'):
+            name = f"{name} ({status})"
+        text += (
+            f"  • {name}: {row['count']}, p50 {row['p50'] * 1000:.0f} мс, "
+            f"p95 {row['p95'] * 1000:.0f} мс, p99 {row['p99'] * 1000:.0f} мс\n"
+        )
+    return text
+
+
+@metrics.instrument_handler
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /perf - задержки внешних зависимостей для администратора"""
     user = update.effective_user
     
-    if text == "О нас":
-        database.log_action(user.id, 'button_about')
+    # Проверяем права доступа
+    if user.id != ADMIN_ID:
         await update.message.reply_text(
-            "📌 *О нас*\n\n"
-            "Мы - команда профессионалов, которая занимается разработкой "
-            "инновационных решений для вашего бизнеса.\n\n"
-            "Наша миссия - делать мир лучше с помощью технологий!",
-            parse_mode='Markdown'
+            "У вас нет доступа к этой команде."
         )
-    elif text == "Кейсы":
-        database.log_action(user.id, 'button_cases')
-        
-        # Клавиатура с кнопкой для заявки
-        keyboard = [
-            [KeyboardButton("📞 Оставить заявку")],
-            [KeyboardButton("⬅️ Назад в меню")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
+        return
+    
+    message = "⏱ Производительность\n"
+    message += (
+        f"\nВ работе: обработчиков {metrics.HANDLERS_IN_FLIGHT.value():.0f}, "
+        f"запросов к Grok {metrics.GROK_IN_FLIGHT.value():.0f}, "
+        f"к Telegram {metrics.TELEGRAM_IN_FLIGHT.value():.0f}, "
+        f"к БД {metrics.DB_IN_FLIGHT.value():.0f}\n"
+    )
+    message += _format_latency_rows("Grok API", metrics.GROK_REQUEST_SECONDS.summary(), 'mode')
+    message += _format_latency_rows("Google Sheets", metrics.SHEETS_READ_SECONDS.summary(), 'worksheet')
+    message += _format_latency_rows("SQLite", metrics.DB_QUERY_SECONDS.summary(), 'operation')
+    message += _format_latency_rows("Обработчики", metrics.HANDLER_SECONDS.summary(), 'handler')
+    message += _format_latency_rows("Telegram API", metrics.TELEGRAM_REQUEST_SECONDS.summary(), 'method')
+    message += f"\n{startup.get_startup_timer().format_report()}\n"
+    
+    # Без Markdown: в названиях операций есть символы подчеркивания
+    await update.message.reply_text(message)
+
+
+@metrics.instrument_handler
+async def reload_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /reload - перечитывает настройки из Google Sheets"""
+    user = update.effective_user
+    
+    # Проверяем права доступа
+    if user.id != ADMIN_ID:
         await update.message.reply_text(
-            "💼 *Наши кейсы*\n\n"
-            "1 Разработка мобильного приложения для доставки\n"
-            "2 Создание CRM-системы для автоматизации продаж\n"
-            "3 Внедрение AI-чатбота для службы поддержки\n\n"
-            "Более 100 успешных проектов реализовано!\n\n"
-            "🎁 *Хотите получить наш продукт?*\n"
-            "Оставьте заявку, и мы свяжемся с вами!",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
+            "У вас нет доступа к этой команде."
         )
-    elif text == "Руководитель":
-        database.log_action(user.id, 'button_director')
-        
-        # Путь к фото руководителя
-        photo_path = 'director.jpg'
-        
-        # Описание руководителя
-        caption = (
-            "👤 *Наш руководитель*\n\n"
-            "*Иван Иванов*\n"
-            "Генеральный директор\n\n"
-            "• 15+ лет опыта в IT-индустрии\n"
-            "• Управляет командой из 50+ специалистов\n"
-            "• Реализовал более 200 успешных проектов\n\n"
-            "_\"Наша цель - создавать решения, которые меняют бизнес к лучшему!\"_"
+        return
+    
+    await database.log_action_async(user.id, 'reload_settings')
+    
+    sheets_manager = google_sheets.get_sheets_manager()
+    if not sheets_manager:
+        if _sheets_connect_task is not None and not _sheets_connect_task.done():
+            await update.message.reply_text("⏳ Google Sheets еще подключается, пока используются настройки по умолчанию")
+        else:
+            await update.message.reply_text("⚠️ Google Sheets не подключен")
+        return
+    
+    if await sheets_manager.reload_settings():
+        # Лист "Меню" необязателен: без него используется меню по умолчанию
+        menu_loaded = await sheets_manager.reload_settings(menu.MENU_WORKSHEET)
+        current_menu = menu.get_menu()
+        cache = sheets_manager.get_cache_stats()
+        await update.message.reply_text(
+            "✅ Настройки перезагружены\n"
+            f"Меню: {'из таблицы' if menu_loaded else 'по умолчанию'}, "
+            f"кнопок: {len(current_menu.items)}\n\n"
+            f"Попаданий в кэш: {cache['hits']}, промахов: {cache['misses']}\n"
+            f"Обновлений: {cache['refreshes']} (ошибок: {cache['refresh_errors']})\n"
+            f"Последнее обновление: {cache['last_refresh_seconds']:.2f} с, "
+            f"среднее: {cache['avg_refresh_seconds']:.2f} с"
         )
-        
-        try:
-            # Отправляем фото с описанием
-            with open(photo_path, 'rb') as photo:
-                await update.message.reply_photo(
-                    photo=photo,
-                    caption=caption,
-                    parse_mode='Markdown'
-                )
-        except FileNotFoundError:
-            # Если фото не найдено, отправляем только текст
-            await update.message.reply_text(
-                f"{caption}\n\n⚠️ _Фото временно недоступно_",
-                parse_mode='Markdown'
-            )
-    elif text == "📞 Номер телефона":
-        database.log_action(user.id, 'button_phone')
+    else:
+        await update.message.reply_text("❌ Не удалось перезагрузить настройки, используются прежние")
+
+
+@metrics.instrument_handler
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /broadcast - рассылка всем пользователям"""
+    user = update.effective_user
+    
+    # Проверяем права доступа
+    if user.id != ADMIN_ID:
         await update.message.reply_text(
-            "📞 *Наш контактный номер телефона:*\n\n"
-            "`88005553535351312`\n\n"
-            "Звоните в любое время! Мы работаем 24/7 🕐",
-            parse_mode='Markdown'
+            "У вас нет доступа к этой команде."
         )
-    elif text == "⬅️ Назад в меню":
-        # Возвращаем основное меню
-        keyboard = [
-            [KeyboardButton("О нас"), KeyboardButton("Кейсы")],
-            [KeyboardButton("👤 Руководитель"), KeyboardButton("📞 Номер телефона")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        return
+    
+    # Текст после команды как есть: с переносами строк и форматированием (HTML)
+    command_entity = update.message.entities[0]
+    text = update.message.text_html[command_entity.offset + command_entity.length:].strip()
+    source_message = update.message.reply_to_message
+    if not text and not source_message:
         await update.message.reply_text(
-            "Главное меню:",
-            reply_markup=reply_markup
+            "Использование:\n"
+            "/broadcast <текст> - разослать текст всем пользователям\n"
+            "/broadcast в ответ на сообщение - разослать копию сообщения\n"
+            "/broadcast_status, /broadcast_stop, /broadcast_resume - состояние, пауза, продолжение"
         )
-    else:
-        # Если сообщение не соответствует кнопкам, отправляем вопрос в Grok AI
-        database.log_action(user.id, 'ai_question')
-        
-        # Отправляем индикатор печатания
-        await update.message.chat.send_action("typing")
-        
-        # Получаем ответ от Grok
-        ai_response = await ask_grok(text)
-        
-        # Отправляем ответ пользователю
+        return
+    
+    last_broadcast = await database.get_broadcast_async()
+    if last_broadcast and last_broadcast['status'] != 'done':
+        await update.message.reply_text(
+            f"⚠️ Рассылка #{last_broadcast['id']} не завершена "
+            f"({BROADCAST_STATUS_NAMES.get(last_broadcast['status'], last_broadcast['status'])}). "
+            "Продолжите ее (/broadcast_resume) или дождитесь окончания"
+        )
+        return
+    
+    await database.log_action_async(user.id, 'broadcast')
+    broadcast_id = await broadcast.get_broadcast_engine().start_broadcast(
+        update.effective_chat.id,
+        text=None if source_message else text,
+        source_message=source_message
+    )
+    logger.info(f"Администратор запустил рассылку #{broadcast_id}")
+
+
+@metrics.instrument_handler
+async def broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команд /broadcast_status, /broadcast_stop и /broadcast_resume"""
+    user = update.effective_user
+    
+    # Проверяем права доступа
+    if user.id != ADMIN_ID:
+        await update.message.reply_text(
+            "У вас нет доступа к этой команде."
+        )
+        return
+    
+    # /broadcast_stop@имя_бота -> stop
+    command = update.message.text.split()[0].split('@')[0].rpartition('_')[2]
+    last_broadcast = await database.get_broadcast_async()
+    if not last_broadcast:
+        await update.message.reply_text("Рассылок еще не было")
+        return
+    
+    if command == 'stop' and last_broadcast['status'] == 'running':
+        # Рассылка остановится после текущего пакета (в любом процессе кластера)
+        await database.set_broadcast_status_async(last_broadcast['id'], 'paused')
+        await update.message.reply_text(f"⏸ Рассылка #{last_broadcast['id']} будет приостановлена")
+        return
+    if command == 'resume' and last_broadcast['status'] == 'paused':
+        await database.set_broadcast_status_async(last_broadcast['id'], 'running')
+        broadcast.get_broadcast_engine().run(last_broadcast['id'])
+        await update.message.reply_text(f"▶️ Рассылка #{last_broadcast['id']} продолжается")
+        return
+    
+    done = last_broadcast['sent'] + last_broadcast['blocked'] + last_broadcast['failed']
+    await update.message.reply_text(
+        f"📣 Рассылка #{last_broadcast['id']}: "
+        f"{BROADCAST_STATUS_NAMES.get(last_broadcast['status'], last_broadcast['status'])}\n"
+        f"Обработано: {done} из {last_broadcast['total']}\n"
+        f"Доставлено: {last_broadcast['sent']}, заблокировали бота: {last_broadcast['blocked']}, "
+        f"ошибок: {last_broadcast['failed']}"
+    )
+
+
+async def reply_with_menu_item(update: Update, item: menu.MenuItem) -> None:
+    """Ответ на нажатие кнопки меню"""
+    if item.action:
+        await database.log_action_async(update.effective_user.id, item.action)
+    
+    text = item.reply
+    if item.photo:
+        try:
+            # Фото загружается в Telegram только один раз
+            await media.get_media_registry().reply(
+                update.message,
+                item.photo,
+                caption=item.reply,
+                parse_mode='Markdown',
+                reply_markup=item.reply_markup
+            )
+            return
+        except FileNotFoundError:
+            # Если фото не найдено, отправляем только текст
+            text = f"{item.reply}\n\n⚠️ _Фото временно недоступно_"
+    
+    await update.message.reply_text(
+        text,
+        parse_mode='Markdown',
+        reply_markup=item.reply_markup
+    )
+
+
+@metrics.instrument_handler
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик текстовых сообщений (нажатий на кнопки)"""
+    text = update.message.text
+    user = update.effective_user
+    
+    # Кнопки меню: один поиск в скомпилированной таблице
+    item = menu.get_menu().lookup(text)
+    if item is not None:
+        await reply_with_menu_item(update, item)
+        return
+    
+    # Сообщение не соответствует кнопкам - отправляем вопрос в Grok AI
+    await database.log_action_async(user.id, 'ai_question')
+    
+    # История диалога ограничена бюджетом токенов, поэтому размер запроса не растет
+    payload = build_grok_payload(text, await get_dialogue_history(user.id))
+    
+    # Такой вопрос уже задавали с теми же настройками и контекстом - отвечаем из кэша
+    ai_response = get_cached_grok_answer(text, payload)
+    if ai_response is not None:
+        await database.log_action_async(user.id, 'ai_cache_hit')
+        await remember_dialogue(user.id, text, ai_response)
         await update.message.reply_text(
             f"🤖 *Grok AI отвечает:*\n\n{ai_response}",
             parse_mode='Markdown'
         )
+        return
+    
+    # Не даем одному пользователю занять весь лимит запросов к Grok
+    request_scheduler = scheduler.get_scheduler()
+    if request_scheduler and not request_scheduler.try_take_token(user.id):
+        await database.log_action_async(user.id, 'ai_rate_limited')
+        await update.message.reply_text(RATE_LIMITED_TEXT)
+        return
+    
+    if GROK_STREAMING:
+        await reply_with_grok_stream(update, text, payload)
+        return
+    
+    # Отправляем индикатор печатания
+    await update.message.chat.send_action("typing")
+    
+    # Получаем ответ от Grok
+    ai_response = await ask_grok(text, payload, user.id)
+    
+    # Отправляем ответ пользователю
+    await update.message.reply_text(
+        f"🤖 *Grok AI отвечает:*\n\n{ai_response}",
+        parse_mode='Markdown'
+    )
 
 
+@metrics.instrument_handler
 async def request_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало процесса оформления заявки"""
     user = update.effective_user
-    database.log_action(user.id, 'start_application')
+    await database.log_action_async(user.id, 'start_application')
     
     await update.message.reply_text(
         "📞 *Оставить заявку*\n\n"
@@ -272,14 +882,12 @@ async def request_application(update: Update, context: ContextTypes.DEFAULT_TYPE
         "Формат: +7XXXXXXXXXX или 8XXXXXXXXXX\n\n"
         "Или нажмите \"Отмена\" для возврата в меню.",
         parse_mode='Markdown',
-        reply_markup=ReplyKeyboardMarkup(
-            [[KeyboardButton("❌ Отмена")]],
-            resize_keyboard=True
-        )
+        reply_markup=CANCEL_KEYBOARD
     )
     return WAITING_FOR_PHONE
 
 
+@metrics.instrument_handler
 async def receive_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка полученного номера телефона"""
     user = update.effective_user
@@ -301,90 +909,274 @@ async def receive_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         )
         return WAITING_FOR_PHONE
     
-    # Сохраняем заявку в базу данных
-    database.save_application(user.id, phone)
-    database.log_action(user.id, 'application_submitted')
+    # Сохраняем заявку вместе с уведомлением администратору: его отправит
+    # очередь уведомлений в фоне, с повторами, не задерживая ответ пользователю
+    notification = None
+    if ADMIN_ID:
+        payload = {
+            'user_id': user.id,
+            'username': user.username,
+            'full_name': user.full_name,
+            'phone': phone
+        }
+        notification = (ADMIN_ID, 'application', payload)
+    await database.save_application_async(user.id, phone, notification)
+    await database.log_action_async(user.id, 'application_submitted')
     
-    # Отправляем уведомление администратору
-    try:
-        user_info = database.get_user_info(user.id)
-        if user_info:
-            _, username, first_name, last_name = user_info
-            username_str = f"@{username}" if username else "без username"
-            full_name = f"{first_name} {last_name or ''}".strip()
-            
-            admin_message = (
-                "🔔 *НОВАЯ ЗАЯВКА!*\n\n"
-                f"👤 Клиент: {full_name}\n"
-                f"🆔 Username: {username_str}\n"
-                f"🆔 User ID: {user.id}\n"
-                f"📞 Телефон: `{phone}`\n\n"
-                "Свяжитесь с клиентом как можно скорее!"
-            )
-            
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=admin_message,
-                parse_mode='Markdown'
-            )
-    except Exception as e:
-        logger.error(f"Ошибка отправки уведомления админу: {e}")
+    outbox = notifications.get_notification_outbox()
+    if outbox and notification:
+        outbox.wake()
     
     # Благодарим пользователя
-    keyboard = [
-        [KeyboardButton("О нас"), KeyboardButton("Кейсы")],
-        [KeyboardButton("👤 Руководитель"), KeyboardButton("📞 Номер телефона")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
     await update.message.reply_text(
         "✅ *Спасибо за вашу заявку!*\n\n"
         f"Мы получили ваш номер телефона: {phone}\n\n"
         "Наш менеджер свяжется с вами в ближайшее время.\n"
         "Обычно это занимает не более 15 минут! 🚀",
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=menu.get_menu().main_keyboard
     )
     
     return ConversationHandler.END
 
 
+@metrics.instrument_handler
 async def cancel_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отмена оформления заявки"""
-    keyboard = [
-        [KeyboardButton("О нас"), KeyboardButton("Кейсы")],
-        [KeyboardButton("👤 Руководитель"), KeyboardButton("📞 Номер телефона")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
     await update.message.reply_text(
         "Заявка отменена. Возвращаю вас в главное меню.",
-        reply_markup=reply_markup
+        reply_markup=menu.get_menu().main_keyboard
     )
     
     return ConversationHandler.END
 
 
-def main() -> None:
-    """Запуск бота"""
-    # Инициализируем базу данных
-    database.init_database()
+async def post_init(application: Application) -> None:
+    """Создание общих ресурсов после инициализации приложения"""
+    await database.open_storage(STORAGE_BACKEND, **storage_options())
     
-    # Инициализируем Google Sheets (опционально)
-    if GOOGLE_SPREADSHEET_ID and os.path.exists(GOOGLE_CREDENTIALS_FILE):
-        sheets_manager = google_sheets.init_sheets_manager(
-            GOOGLE_CREDENTIALS_FILE,
-            GOOGLE_SPREADSHEET_ID
+    scheduler.init_scheduler(
+        max_concurrent=GROK_MAX_CONCURRENT,
+        max_queue=GROK_MAX_QUEUE,
+        max_wait=GROK_MAX_WAIT,
+        user_rate=GROK_USER_RATE,
+        user_burst=GROK_USER_BURST
+    )
+    grok_client.init_grok_client(
+        GROK_API_KEY,
+        max_connections=GROK_MAX_CONNECTIONS,
+        max_keepalive_connections=GROK_MAX_KEEPALIVE,
+        keepalive_expiry=GROK_KEEPALIVE_EXPIRY,
+        connect_timeout=GROK_CONNECT_TIMEOUT,
+        read_timeout=GROK_READ_TIMEOUT,
+        write_timeout=GROK_WRITE_TIMEOUT,
+        pool_timeout=GROK_POOL_TIMEOUT,
+        http2=GROK_HTTP2,
+        max_retries=GROK_MAX_RETRIES,
+        retry_base=GROK_RETRY_BASE,
+        retry_max_delay=GROK_RETRY_MAX_DELAY,
+        hedge=GROK_HEDGE,
+        hedge_min_delay=GROK_HEDGE_MIN_DELAY,
+        breaker_threshold=GROK_BREAKER_THRESHOLD,
+        breaker_recovery=GROK_BREAKER_RECOVERY
+    )
+    
+    database.start_action_buffer(
+        batch_size=ACTION_BATCH_SIZE,
+        flush_interval=ACTION_FLUSH_INTERVAL,
+        max_size=ACTION_QUEUE_MAX,
+        overflow_policy=ACTION_QUEUE_POLICY
+    )
+    
+    # В кластере старые действия сворачивает только первый рабочий процесс
+    if ACTIONS_RETENTION_DAYS > 0 and STORAGE_BACKEND != 'sqlite':
+        logger.warning("⚠️ ACTIONS_RETENTION_DAYS работает только с хранилищем sqlite")
+    elif ACTIONS_RETENTION_DAYS > 0 and CLUSTER_WORKER_INDEX in (None, 0):
+        retention.start_action_retention(
+            keep_days=ACTIONS_RETENTION_DAYS,
+            archive_dir=ACTIONS_ARCHIVE_DIR,
+            interval=ACTIONS_RETENTION_INTERVAL
         )
-        if sheets_manager:
-            logger.info("✅ Google Sheets успешно подключен")
-        else:
-            logger.warning("⚠️ Google Sheets не подключен, используются значения по умолчанию")
+    
+    # Рассылка идет через отдельный пул соединений, чтобы не занимать соединения ответов
+    broadcast_engine = broadcast.init_broadcast_engine(
+        Bot(
+            TOKEN,
+            base_url=TELEGRAM_BASE_URL.rstrip('/') + '/bot' if TELEGRAM_BASE_URL else 'https://api.telegram.org/bot',
+            request=metrics.MeteredRequest(connection_pool_size=BROADCAST_CONCURRENCY)
+        ),
+        report_bot=application.bot,
+        rate=BROADCAST_RATE,
+        concurrency=BROADCAST_CONCURRENCY,
+        chunk_size=BROADCAST_CHUNK,
+        progress_interval=BROADCAST_PROGRESS_INTERVAL,
+        is_busy=lambda: metrics.HANDLERS_IN_FLIGHT.value() >= BROADCAST_YIELD_HANDLERS
+    )
+    # В кластере прерванную рассылку продолжает только первый рабочий процесс
+    if CLUSTER_WORKER_INDEX in (None, 0):
+        await broadcast_engine.resume_interrupted()
+    
+    notifications.start_notification_outbox(
+        application.bot,
+        poll_interval=NOTIFY_POLL_INTERVAL,
+        digest_window=NOTIFY_DIGEST_WINDOW,
+        max_digest=NOTIFY_MAX_DIGEST,
+        retry_base=NOTIFY_RETRY_BASE,
+        retry_max=NOTIFY_RETRY_MAX
+    )
+    
+    if AI_CACHE_ENABLED:
+        answer_cache = ai_cache.init_answer_cache(
+            max_entries=AI_CACHE_MAX_ENTRIES,
+            max_bytes=AI_CACHE_MAX_BYTES,
+            ttl=AI_CACHE_TTL,
+            persist_path=AI_CACHE_FILE or None
+        )
+        await asyncio.to_thread(answer_cache.load)
+    
+    if DIALOGUE_ENABLED:
+        memory = dialogue.init_dialogue_memory(
+            history_tokens=DIALOGUE_HISTORY_TOKENS,
+            max_turns=DIALOGUE_MAX_TURNS,
+            max_users=DIALOGUE_MAX_USERS,
+            max_total_tokens=DIALOGUE_MAX_TOTAL_TOKENS,
+            idle_ttl=DIALOGUE_IDLE_TTL,
+            spill_path=DIALOGUE_FILE or None
+        )
+        await asyncio.to_thread(memory.load)
+    
+    if METRICS_PORT:
+        await metrics.start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+    
+    sheets_manager = google_sheets.get_sheets_manager()
+    if sheets_manager:
+        # Рабочий процесс кластера: настройки из снимка главного процесса
+        await start_sheets(sheets_manager)
     else:
-        logger.warning("⚠️ Google Sheets не настроен, используются значения по умолчанию")
+        # Подключаемся в фоне, до готовности работаем с настройками по умолчанию
+        sheets_manager = create_sheets_manager()
+        if sheets_manager:
+            global _sheets_connect_task
+            _sheets_connect_task = asyncio.create_task(connect_sheets(sheets_manager))
     
-    # Создаем приложение
-    application = Application.builder().token(TOKEN).build()
+    timer = startup.get_startup_timer()
+    timer.checkpoint('post_init')
+    timer.mark_ready()
+    report_startup()
+
+
+def report_startup() -> None:
+    """Отчет о запуске в лог и в метрики"""
+    timer = startup.get_startup_timer()
+    for phase, seconds in timer.get_report()['phases'].items():
+        metrics.STARTUP_SECONDS.set(seconds, phase=phase)
+    logger.info(timer.format_report())
+
+
+async def start_sheets(sheets_manager) -> None:
+    """Прогрев кэша настроек и запуск выгрузки для подключенного менеджера Google Sheets"""
+    # Прогреваем кэш настроек, чтобы первый вопрос не ждал Google Sheets
+    for worksheet_name in SETTINGS_WORKSHEETS:
+        await sheets_manager.reload_settings(worksheet_name)
+    
+    # В кластере выгрузку выполняет главный процесс (у рабочих нет подключения к таблице)
+    if SHEETS_EXPORT_ENABLED and sheets_manager.spreadsheet is not None:
+        sheets_export.start_sheets_exporter(sheets_manager, **sheets_export_options())
+
+
+async def connect_sheets(sheets_manager) -> None:
+    """Подключение к Google Sheets в фоне (с повторами при ошибках)"""
+    with startup.get_startup_timer().phase('sheets'):
+        await sheets_manager.connect_async(retry_interval=SHEETS_CONNECT_RETRY)
+        await start_sheets(sheets_manager)
+    # Обработчики видят таблицу, когда настройки уже в кэше
+    google_sheets.set_sheets_manager(sheets_manager)
+    logger.info("✅ Google Sheets успешно подключен")
+    report_startup()
+
+
+async def post_shutdown(application: Application) -> None:
+    """Освобождение общих ресурсов при остановке приложения"""
+    await metrics.stop_metrics_server()
+    if _sheets_connect_task is not None:
+        _sheets_connect_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _sheets_connect_task
+    await sheets_export.stop_sheets_exporter()
+    await notifications.stop_notification_outbox()
+    await broadcast.close_broadcast_engine()
+    await retention.stop_action_retention()
+    await grok_client.close_grok_client()
+    ai_cache.close_answer_cache()
+    await asyncio.to_thread(dialogue.close_dialogue_memory)
+    await database.stop_action_buffer()
+    await database.close_storage()
+    database.close_database()
+
+
+def storage_options() -> dict:
+    """Параметры хранилища PostgreSQL (для sqlite параметров нет)"""
+    if STORAGE_BACKEND != 'postgres':
+        return {}
+    return {
+        'dsn': POSTGRES_DSN,
+        'min_size': POSTGRES_POOL_MIN,
+        'max_size': POSTGRES_POOL_MAX,
+        'statement_cache_size': POSTGRES_STATEMENT_CACHE
+    }
+
+
+def sheets_export_options() -> dict:
+    """Параметры выгрузки в Google Sheets"""
+    return {
+        'interval': SHEETS_EXPORT_INTERVAL,
+        'batch_size': SHEETS_EXPORT_BATCH,
+        'export_rollups': SHEETS_EXPORT_ROLLUPS
+    }
+
+
+def sheets_configured() -> bool:
+    """Задана ли таблица и есть ли файл учетных данных для нее"""
+    return bool(GOOGLE_SPREADSHEET_ID) and os.path.exists(GOOGLE_CREDENTIALS_FILE)
+
+
+def create_sheets_manager(snapshot_path: str = None):
+    """Менеджер Google Sheets без подключения (None, если таблица не настроена)"""
+    if sheets_configured():
+        return google_sheets.GoogleSheetsManager(
+            GOOGLE_CREDENTIALS_FILE,
+            GOOGLE_SPREADSHEET_ID,
+            settings_ttl=SHEETS_SETTINGS_TTL,
+            snapshot_path=snapshot_path,
+            scopes=google_sheets.WRITE_SCOPES if SHEETS_EXPORT_ENABLED else google_sheets.SCOPES
+        )
+    logger.warning("⚠️ Google Sheets не настроен, используются значения по умолчанию")
+    return None
+
+
+def build_application(update_queue_size: int = None) -> Application:
+    """
+    Создание приложения бота с обработчиками
+    
+    Args:
+        update_queue_size: Размер очереди обновлений; если задан - приложение
+            создается без Updater (обновления доставляет вебхук или кластер)
+    """
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        # Пул такого же размера, как по умолчанию в PTB, плюс учет задержек Bot API
+        .request(metrics.MeteredRequest(connection_pool_size=256))
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL.rstrip('/') + '/bot')
+    if update_queue_size:
+        # Ограниченная очередь: при переполнении вебхук отвечает 503 и Telegram повторит доставку
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=update_queue_size))
+    application = builder.build()
     
     # ConversationHandler для обработки заявок
     application_handler = ConversationHandler(
@@ -404,13 +1196,123 @@ def main() -> None:
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("reload", reload_settings))
+    application.add_handler(CommandHandler("perf", perf))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler(
+        ["broadcast_status", "broadcast_stop", "broadcast_resume"], broadcast_control))
     application.add_handler(application_handler)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+
+def configure_cluster_worker(index: int, workers: int) -> None:
+    """
+    Настройка рабочего процесса кластера до создания приложения
+    
+    Общие лимиты Grok делятся между процессами, чтобы вместе они не превышали заданных.
+    Лимиты пользователя (GROK_USER_RATE, GROK_USER_BURST) не делятся: все обновления
+    пользователя обрабатывает один процесс. BROADCAST_RATE тоже не делится - рассылку
+    в каждый момент ведет только один процесс.
+    """
+    global METRICS_PORT, CLUSTER_WORKER_INDEX
+    global GROK_MAX_CONCURRENT, GROK_MAX_QUEUE, GROK_MAX_CONNECTIONS, GROK_MAX_KEEPALIVE
+    CLUSTER_WORKER_INDEX = index
+    # У каждого процесса свой порт метрик
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    
+    GROK_MAX_CONCURRENT = max(1, GROK_MAX_CONCURRENT // workers)
+    GROK_MAX_QUEUE = max(1, GROK_MAX_QUEUE // workers)
+    GROK_MAX_CONNECTIONS = max(1, GROK_MAX_CONNECTIONS // workers)
+    GROK_MAX_KEEPALIVE = max(1, GROK_MAX_KEEPALIVE // workers)
+    
+    # Схема базы уже обновлена главным процессом
+    database.init_user_cache(USER_CACHE_SIZE, USER_SEEN_DEBOUNCE)
+    # Снимок пишет только главный процесс с настроенной таблицей (см. create_sheets_manager)
+    if sheets_configured():
+        google_sheets.init_shared_settings_reader(SETTINGS_SNAPSHOT_FILE)
+
+
+def run_cluster_worker(index: int, update_queue) -> None:
+    """Точка входа рабочего процесса кластера"""
+    logging.basicConfig(
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        force=True
+    )
+    configure_cluster_worker(index, CLUSTER_WORKERS)
+    
+    application = build_application(update_queue_size=CLUSTER_QUEUE_SIZE)
+    asyncio.run(cluster.serve_worker(application, update_queue))
+
+
+def main() -> None:
+    """Запуск бота"""
+    # Инициализируем базу данных
+    timer = startup.get_startup_timer()
+    database.init_database()
+    database.init_user_cache(USER_CACHE_SIZE, USER_SEEN_DEBOUNCE)
+    timer.checkpoint('database')
+    
+    if BOT_MODE == 'cluster':
+        # Главный процесс только получает обновления и обновляет снимок настроек;
+        # к Google Sheets он подключается в фоне, уже принимая обновления
+        sheets_manager = create_sheets_manager(snapshot_path=SETTINGS_SNAPSHOT_FILE)
+        database.close_database()
+        exporter = None
+        if SHEETS_EXPORT_ENABLED and sheets_manager:
+            exporter = sheets_export.SheetsExporter(sheets_manager, **sheets_export_options())
+        webhook_options = None
+        if CLUSTER_WEBHOOK:
+            webhook_options = {
+                'url': WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                'listen': WEBHOOK_LISTEN,
+                'port': WEBHOOK_PORT,
+                'path': WEBHOOK_PATH,
+                'secret_token': WEBHOOK_SECRET or None,
+                'max_connections': WEBHOOK_MAX_CONNECTIONS
+            }
+        logger.info(f"Бот запущен в режиме кластера ({CLUSTER_WORKERS} процессов)!")
+        cluster.run_cluster(
+            TOKEN,
+            CLUSTER_WORKERS,
+            run_cluster_worker,
+            queue_size=CLUSTER_QUEUE_SIZE,
+            allowed_updates=ALLOWED_UPDATES,
+            webhook_options=webhook_options,
+            settings_manager=sheets_manager,
+            settings_worksheets=SETTINGS_WORKSHEETS,
+            settings_interval=SHEETS_SETTINGS_TTL,
+            settings_connect_retry=SHEETS_CONNECT_RETRY,
+            base_url=TELEGRAM_BASE_URL.rstrip('/') + '/bot' if TELEGRAM_BASE_URL else None,
+            exporter=exporter,
+            storage_backend=STORAGE_BACKEND,
+            storage_options=storage_options()
+        )
+        return
+    
+    # Создаем приложение (Google Sheets подключается в фоне после запуска, см. post_init)
+    application = build_application(
+        update_queue_size=WEBHOOK_QUEUE_SIZE if BOT_MODE == 'webhook' else None
+    )
+    timer.checkpoint('application')
     
     # Запускаем бота
     logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-
+    if BOT_MODE == 'webhook':
+        webhook.run_webhook(
+            application,
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
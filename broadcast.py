@@ -0,0 +1,337 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз повторять отправку одному получателю при сетевых ошибках
+MAX_ATTEMPTS = 3
+
+# После стольких успешных отправок подряд скорость снова повышается на 1 сообщение/с
+RATE_RECOVERY_STEP = 100
+
+# Аренда рассылки (сек): продлевается перед каждым пакетом; если процесс, который
+# ведет рассылку, упал, после ее истечения рассылку подхватит другой процесс кластера
+LEASE_SECONDS = 300
+
+# Как часто ожидающий процесс проверяет, освободилась ли рассылка (сек)
+LEASE_POLL_INTERVAL = 5.0
+
+
+class BroadcastEngine:
+    """Рассылка всем пользователям с ограничением скорости и продолжением после остановки"""
+
+    def __init__(self, bot, report_bot=None, rate: float = 20.0, min_rate: float = 1.0,
+                 concurrency: int = 8, chunk_size: int = 100, progress_interval: float = 15.0,
+                 is_busy=None):
+        """
+        Инициализация рассылки
+
+        Args:
+            bot: Telegram Bot для рассылки (лучше с отдельным пулом соединений)
+            report_bot: Bot, через который отправляется прогресс администратору (по умолчанию bot)
+            rate: Максимум сообщений в секунду (общий лимит Telegram - около 30)
+            min_rate: Ниже этой скорости RetryAfter ее не снижает
+            concurrency: Сколько сообщений отправляется одновременно
+            chunk_size: Сколько получателей читать из БД и записывать результатов за раз
+            progress_interval: Как часто обновлять сообщение о прогрессе (сек)
+            is_busy: Функция без аргументов; пока она возвращает True, рассылка ждет -
+                ответы пользователям важнее
+        """
+        self.bot = bot
+        self.report_bot = report_bot or bot
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.is_busy = is_busy
+        # Владелец аренды рассылки в БД - этот процесс
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._next_slot = 0.0
+        self._pause_until = 0.0
+        self._successes = 0
+        self._tasks = {}
+
+        # Счетчики рассылки в этом процессе
+        self.stats = {
+            'sent': 0,
+            'blocked': 0,
+            'failed': 0,
+            'retry_after': 0,
+            'yielded_seconds': 0.0
+        }
+
+    async def start_broadcast(self, admin_chat_id: int, text: str = None, source_message=None) -> int:
+        """
+        Создание и запуск рассылки
+
+        Args:
+            admin_chat_id: Чат администратора для отчета о прогрессе
+            text: Текст рассылки в HTML (как Message.text_html)
+            source_message: Сообщение, которое копируется получателям вместо текста
+
+        Returns:
+            id рассылки
+        """
+        source_chat_id = source_message.chat_id if source_message else None
+        source_message_id = source_message.message_id if source_message else None
+        broadcast_id = await database.create_broadcast_async(admin_chat_id, text, source_chat_id, source_message_id)
+        self.run(broadcast_id)
+        return broadcast_id
+
+    def run(self, broadcast_id: int):
+        """Запуск (или продолжение) рассылки в фоне"""
+        task = self._tasks.get(broadcast_id)
+        if task is None or task.done():
+            self._tasks[broadcast_id] = asyncio.get_running_loop().create_task(self._run(broadcast_id))
+
+    def is_running(self) -> bool:
+        """Идет ли рассылка в этом процессе"""
+        return any(not task.done() for task in self._tasks.values())
+
+    async def resume_interrupted(self) -> list:
+        """Продолжение рассылок, прерванных остановкой бота"""
+        broadcast_ids = await database.get_running_broadcast_ids_async()
+        for broadcast_id in broadcast_ids:
+            logger.info(f"Продолжение рассылки #{broadcast_id}")
+            self.run(broadcast_id)
+        return broadcast_ids
+
+    async def stop(self):
+        """Остановка рассылок; статус в БД остается running - продолжим после запуска"""
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        await self.bot.shutdown()
+
+    async def _acquire(self):
+        """Ожидание очереди на отправку: лимит скорости, RetryAfter и занятость бота"""
+        while True:
+            now = time.monotonic()
+            if now < self._pause_until:
+                await asyncio.sleep(self._pause_until - now)
+                continue
+            if self.is_busy is not None and self.is_busy():
+                await asyncio.sleep(0.1)
+                self.stats['yielded_seconds'] += 0.1
+                continue
+            break
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, broadcast: dict, user_id: int) -> tuple:
+        """
+        Отправка одному получателю
+
+        Returns:
+            (user_id, статус sent/blocked/failed, текст ошибки)
+        """
+        attempt = 0
+        while True:
+            await self._acquire()
+            try:
+                if broadcast['source_message_id']:
+                    await self.bot.copy_message(
+                        chat_id=user_id,
+                        from_chat_id=broadcast['source_chat_id'],
+                        message_id=broadcast['source_message_id']
+                    )
+                else:
+                    await self.bot.send_message(chat_id=user_id, text=broadcast['text'], parse_mode=ParseMode.HTML)
+            except RetryAfter as e:
+                # Лимит действует на весь бот: пауза для всех отправок и снижение скорости
+                self.stats['retry_after'] += 1
+                self._pause_until = max(self._pause_until, time.monotonic() + float(e.retry_after))
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._successes = 0
+                logger.warning(f"Рассылка приостановлена на {e.retry_after} с, скорость {self.rate:.1f}/с")
+                continue
+            except Forbidden as e:
+                # Пользователь заблокировал бота
+                return user_id, 'blocked', str(e)
+            except BadRequest as e:
+                return user_id, 'failed', str(e)
+            except NetworkError as e:
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS:
+                    metrics.ERRORS.inc(component='broadcast')
+                    return user_id, 'failed', str(e)
+                await asyncio.sleep(2 ** attempt)
+                continue
+            except Exception as e:
+                metrics.ERRORS.inc(component='broadcast')
+                return user_id, 'failed', str(e)
+
+            self._successes += 1
+            if self._successes >= RATE_RECOVERY_STEP and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 1)
+                self._successes = 0
+            return user_id, 'sent', None
+
+    async def _send_chunk(self, broadcast: dict, recipients: list, results: list):
+        """Отправка пакета получателей не более чем concurrency сообщениями одновременно"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with semaphore:
+                result = await self._send(broadcast, user_id)
+            results.append(result)
+            self.stats[result[1]] += 1
+
+        await asyncio.gather(*(send(user_id) for user_id in recipients))
+
+    def _format_progress(self, broadcast: dict, started: float, sent_now: int) -> str:
+        """Текст сообщения о прогрессе"""
+        done = broadcast['sent'] + broadcast['blocked'] + broadcast['failed']
+        elapsed = time.monotonic() - started
+        speed = sent_now / elapsed if elapsed > 0 else 0.0
+        title = "✅ Рассылка" if broadcast['status'] == 'done' else "📣 Рассылка"
+        state = {'done': "завершена", 'paused': "приостановлена"}.get(broadcast['status'], "идет")
+        return (
+            f"{title} #{broadcast['id']} {state}\n\n"
+            f"Обработано: {done} из {broadcast['total']}\n"
+            f"Доставлено: {broadcast['sent']}, заблокировали бота: {broadcast['blocked']}, "
+            f"ошибок: {broadcast['failed']}\n"
+            f"Скорость: {speed:.1f} сообщ./с (лимит {self.rate:.0f}/с), прошло {elapsed:.0f} с"
+        )
+
+    async def _report(self, broadcast: dict, message, started: float, sent_now: int):
+        """Отправка или обновление сообщения о прогрессе администратору"""
+        text = self._format_progress(broadcast, started, sent_now)
+        try:
+            if message is None:
+                return await self.report_bot.send_message(chat_id=broadcast['admin_chat_id'], text=text)
+            await message.edit_text(text)
+        except Exception as e:
+            # Прогресс - не главное: рассылка продолжается
+            logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast['id']}: {e}")
+        return message
+
+    async def _run(self, broadcast_id: int):
+        """Фоновая рассылка; при ошибке статус остается running и рассылку можно продолжить"""
+        try:
+            await self._deliver(broadcast_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.ERRORS.inc(component='broadcast')
+            logger.error(f"Ошибка рассылки #{broadcast_id}: {e}")
+
+    async def _wait_for_lease(self, broadcast_id: int) -> bool:
+        """
+        Захват аренды рассылки
+
+        Пока рассылку ведет другой процесс (например, дорабатывает пакет после
+        паузы), ждем: он закончит ее сам, поставит на паузу или его аренда истечет.
+
+        Returns:
+            True, если рассылку ведет этот процесс; False, если она больше не идет
+        """
+        while not await database.claim_broadcast_async(broadcast_id, self.owner, LEASE_SECONDS):
+            broadcast = await database.get_broadcast_async(broadcast_id)
+            if broadcast['status'] != 'running':
+                return False
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+        return True
+
+    async def _deliver(self, broadcast_id: int):
+        """Рассылка с арендой: пакеты отправляет только один процесс кластера"""
+        if not await self._wait_for_lease(broadcast_id):
+            return
+        try:
+            await self._deliver_leased(broadcast_id)
+        finally:
+            await asyncio.shield(database.release_broadcast_async(broadcast_id, self.owner))
+
+    async def _deliver_leased(self, broadcast_id: int):
+        """Рассылка пакетами по возрастанию user_id до конца списка или паузы"""
+        await self.bot.initialize()
+        broadcast = await database.get_broadcast_async(broadcast_id)
+        after_user_id = broadcast['last_user_id']
+        started = time.monotonic()
+        sent_now = 0
+        message = await self._report(broadcast, None, started, sent_now)
+        reported_at = time.monotonic()
+
+        while True:
+            # Паузу могли поставить из другого процесса - проверяем статус перед каждым пакетом
+            broadcast = await database.get_broadcast_async(broadcast_id)
+            if broadcast['status'] != 'running':
+                break
+            if not await database.claim_broadcast_async(broadcast_id, self.owner, LEASE_SECONDS):
+                logger.warning(f"Рассылку #{broadcast_id} уже ведет другой процесс")
+                break
+            recipients = await database.get_broadcast_recipients_async(broadcast_id, after_user_id, self.chunk_size)
+            if not recipients:
+                await database.set_broadcast_status_async(broadcast_id, 'done')
+                break
+
+            results = []
+            try:
+                await self._send_chunk(broadcast, recipients, results)
+            except asyncio.CancelledError:
+                # Сохраняем то, что успели отправить; курсор не двигаем
+                await asyncio.shield(database.record_broadcast_deliveries_async(broadcast_id, results))
+                raise
+            await database.record_broadcast_deliveries_async(broadcast_id, results, recipients[-1])
+            after_user_id = recipients[-1]
+            sent_now += sum(1 for result in results if result[1] == 'sent')
+
+            if time.monotonic() - reported_at >= self.progress_interval:
+                broadcast = await database.get_broadcast_async(broadcast_id)
+                message = await self._report(broadcast, message, started, sent_now)
+                reported_at = time.monotonic()
+
+        broadcast = await database.get_broadcast_async(broadcast_id)
+        await self._report(broadcast, message, started, sent_now)
+        logger.info(
+            f"Рассылка #{broadcast_id}: доставлено {broadcast['sent']}, заблокировали {broadcast['blocked']}, "
+            f"ошибок {broadcast['failed']} ({broadcast['status']})"
+        )
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков рассылки
+
+        Returns:
+            Словарь с доставленными, заблокированными и ошибками, текущей скоростью
+        """
+        engine_stats = dict(self.stats)
+        engine_stats['rate'] = self.rate
+        engine_stats['running'] = self.is_running()
+        return engine_stats
+
+
+# Глобальная рассылка
+_broadcast_engine = None
+
+def init_broadcast_engine(bot, **options) -> BroadcastEngine:
+    """Инициализация глобальной рассылки"""
+    global _broadcast_engine
+    _broadcast_engine = BroadcastEngine(bot, **options)
+    return _broadcast_engine
+
+async def close_broadcast_engine():
+    """Остановка глобальной рассылки"""
+    global _broadcast_engine
+    if _broadcast_engine is not None:
+        engine = _broadcast_engine
+        _broadcast_engine = None
+        await engine.stop()
+
+def get_broadcast_engine() -> BroadcastEngine:
+    """Получение глобальной рассылки"""
+    return _broadcast_engine
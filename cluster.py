@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from collections import deque
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.ext import Application
+import database
+from webhook import WebhookServer, stop_event_on_signals
+
+logger = logging.getLogger(__name__)
+
+# Сигнал рабочему процессу завершить работу
+STOP = 'stop'
+
+# Упавший рабочий процесс перезапускается, но не больше MAX_RESTARTS раз за RESTART_WINDOW секунд
+MAX_RESTARTS = 5
+RESTART_WINDOW = 300.0
+
+# Как часто главный процесс проверяет, что рабочие процессы живы (сек)
+WATCH_INTERVAL = 1.0
+
+
+class WorkerDied(RuntimeError):
+    """Рабочий процесс падает слишком часто - главный процесс останавливается"""
+
+
+def user_id_of(data: dict):
+    """ID пользователя из обновления в формате JSON Bot API (без разбора в объекты)"""
+    for key, value in data.items():
+        if key != 'update_id' and isinstance(value, dict):
+            sender = value.get('from')
+            if isinstance(sender, dict):
+                return sender.get('id')
+            return None
+    return None
+
+
+def shard_for(data: dict, workers: int) -> int:
+    """
+    Номер рабочего процесса для обновления
+
+    Все обновления одного пользователя попадают в один процесс, поэтому
+    состояние ConversationHandler (WAITING_FOR_PHONE) остается согласованным.
+    """
+    user_id = user_id_of(data)
+    return user_id % workers if user_id is not None else 0
+
+
+class ClusterFront:
+    """Главный процесс кластера: запускает рабочие процессы и раздает им обновления"""
+
+    def __init__(self, workers: int, worker_entry, queue_size: int = 1000):
+        """
+        Инициализация главного процесса
+
+        Args:
+            workers: Количество рабочих процессов
+            worker_entry: Функция (номер процесса, очередь) - точка входа рабочего процесса
+            queue_size: Размер очереди каждого рабочего процесса
+        """
+        self.workers = workers
+        self.worker_entry = worker_entry
+        self.queue_size = queue_size
+
+        # spawn: рабочие процессы не наследуют потоки и соединения главного
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = []
+        self.processes = []
+        self._restarts = [deque() for _ in range(workers)]
+        # WorkerDied, из-за которого главный процесс останавливается
+        self.error = None
+        self.stats = {
+            'dispatched': [0] * workers,
+            'rejected_queue_full': 0,
+            'restarts': 0
+        }
+
+    def start(self):
+        """Запуск рабочих процессов"""
+        for index in range(self.workers):
+            self.queues.append(self._context.Queue(maxsize=self.queue_size))
+            self.processes.append(self._spawn(index))
+        logger.info(f"Запущено рабочих процессов: {self.workers}")
+
+    def _spawn(self, index: int):
+        """Запуск рабочего процесса с его очередью"""
+        process = self._context.Process(
+            target=self.worker_entry,
+            args=(index, self.queues[index]),
+            name=f'bot-worker-{index}'
+        )
+        process.start()
+        return process
+
+    def check_worker(self, index: int):
+        """
+        Перезапуск рабочего процесса, если он упал
+
+        Очередь остается прежней: обновления, которые процесс не успел взять, обработает новый.
+
+        Raises:
+            WorkerDied: Процесс упал больше MAX_RESTARTS раз за RESTART_WINDOW секунд
+        """
+        process = self.processes[index]
+        if process.is_alive():
+            return
+        now = time.monotonic()
+        restarts = self._restarts[index]
+        while restarts and now - restarts[0] > RESTART_WINDOW:
+            restarts.popleft()
+        if len(restarts) >= MAX_RESTARTS:
+            self.error = WorkerDied(
+                f"Процесс {process.name} упал {len(restarts) + 1} раз за {RESTART_WINDOW:.0f} с "
+                f"(код {process.exitcode})"
+            )
+            raise self.error
+        restarts.append(now)
+        self.stats['restarts'] += 1
+        logger.error(f"Процесс {process.name} завершился с кодом {process.exitcode}, перезапускаем")
+        self.processes[index] = self._spawn(index)
+
+    def check_workers(self):
+        """Перезапуск всех упавших рабочих процессов"""
+        for index in range(self.workers):
+            self.check_worker(index)
+
+    def dispatch(self, data: dict) -> bool:
+        """
+        Передача обновления рабочему процессу его пользователя
+
+        Returns:
+            False, если очередь рабочего процесса переполнена
+        """
+        index = shard_for(data, self.workers)
+        try:
+            self.queues[index].put_nowait(data)
+        except queue.Full:
+            self.stats['rejected_queue_full'] += 1
+            return False
+        self.stats['dispatched'][index] += 1
+        return True
+
+    def alive(self) -> bool:
+        """Все рабочие процессы работают"""
+        return all(process.is_alive() for process in self.processes)
+
+    def stop(self, timeout: float = 30.0):
+        """Остановка рабочих процессов после обработки их очередей"""
+        for update_queue in self.queues:
+            try:
+                update_queue.put(STOP, timeout=1)
+            except queue.Full:
+                pass
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Процесс {process.name} не завершился, останавливаем принудительно")
+                process.terminate()
+        logger.info("Рабочие процессы остановлены")
+
+
+class ClusterWebhookServer(WebhookServer):
+    """Вебхук главного процесса: обновления уходят рабочим процессам без разбора"""
+
+    def __init__(self, front: ClusterFront, **options):
+        super().__init__(None, **options)
+        self.front = front
+
+    def enqueue(self, data: dict) -> bool:
+        """Передача обновления рабочему процессу"""
+        if not isinstance(data, dict) or 'update_id' not in data:
+            raise ValueError("Нет update_id")
+        return self.front.dispatch(data)
+
+    def health(self) -> dict:
+        """Состояние рабочих процессов"""
+        return {
+            'running': self.front.alive(),
+            'workers': self.front.workers,
+            'dispatched': self.front.stats['dispatched'],
+            'restarts': self.front.stats['restarts']
+        }
+
+
+async def _poll_updates(bot: Bot, front: ClusterFront, allowed_updates: list, stop_event: asyncio.Event):
+    """Long polling в главном процессе с передачей обновлений рабочим"""
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while not stop_event.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (NetworkError, TimedOut) as e:
+                logger.warning(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                data = update.to_dict()
+                # Очередь процесса заполнена - ждем, обновления не теряем. Очередь упавшего
+                # процесса не разберет никто: процесс перезапускается (или WorkerDied)
+                while not front.dispatch(data):
+                    front.check_worker(shard_for(data, front.workers))
+                    await asyncio.sleep(0.05)
+                offset = update.update_id + 1
+    finally:
+        # Telegram считает обновления полученными только после запроса со следующим offset;
+        # без него последний пакет придет повторно после перезапуска
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, allowed_updates=allowed_updates)
+            except TelegramError as e:
+                logger.warning(f"Не удалось подтвердить последние обновления: {e}")
+
+
+async def _watch_workers(front: ClusterFront, stop_event: asyncio.Event):
+    """Перезапуск упавших рабочих процессов; если они падают постоянно - остановка главного"""
+    while not stop_event.is_set():
+        try:
+            front.check_workers()
+        except WorkerDied as e:
+            logger.error(f"{e}, главный процесс останавливается")
+            stop_event.set()
+            return
+        await asyncio.sleep(WATCH_INTERVAL)
+
+
+async def serve_front(front: ClusterFront, token: str, allowed_updates: list = None,
+                      webhook_options: dict = None, settings_manager=None,
+                      settings_worksheets: tuple = ("Настройки",), settings_interval: float = 60.0,
+                      settings_connect_retry: float = 30.0, base_url: str = None, exporter=None,
+                      storage_backend: str = 'sqlite', storage_options: dict = None):
+    """
+    Работа главного процесса до получения SIGINT/SIGTERM
+
+    Args:
+        front: Главный процесс с запущенными рабочими
+        token: Токен бота
+        allowed_updates: Типы обновлений, которые нужны боту
+        webhook_options: Параметры вебхука (url, listen, port, path, secret_token,
+            max_connections); если не заданы - используется long polling
+        settings_manager: GoogleSheetsManager, который обновляет общий снимок настроек
+        settings_worksheets: Листы, которые попадают в снимок
+        settings_interval: Как часто обновлять снимок настроек (сек)
+        settings_connect_retry: Пауза перед повторным подключением к Google Sheets (сек)
+        base_url: Адрес Bot API, если используется не api.telegram.org
+        exporter: SheetsExporter, который выгружает заявки в Google Sheets (запускается
+            после подключения settings_manager)
+        storage_backend: Хранилище заявок рабочих процессов (STORAGE_BACKEND) - из него
+            читает exporter
+        storage_options: Параметры database.open_storage для storage_backend
+    """
+    stop_event = stop_event_on_signals()
+    if exporter is not None:
+        # Заявки и отметки выгрузки - в том же хранилище, куда их пишут рабочие процессы
+        await database.open_storage(storage_backend, **(storage_options or {}))
+    tasks = [asyncio.create_task(_watch_workers(front, stop_event))]
+
+    if settings_manager is not None:
+        async def refresh_settings():
+            # Подключение к Google Sheets не задерживает прием обновлений
+            if settings_manager.spreadsheet is None:
+                await settings_manager.connect_async(retry_interval=settings_connect_retry)
+            if exporter is not None:
+                exporter.start()
+            while True:
+                for worksheet_name in settings_worksheets:
+                    await settings_manager.reload_settings(worksheet_name)
+                await asyncio.sleep(settings_interval)
+        tasks.append(asyncio.create_task(refresh_settings()))
+    elif exporter is not None:
+        exporter.start()
+
+    bot_options = {'base_url': base_url} if base_url else {}
+    async with Bot(token, **bot_options) as bot:
+        webhook_server = None
+        if webhook_options:
+            options = dict(webhook_options)
+            url = options.pop('url')
+            max_connections = options.pop('max_connections', 40)
+            webhook_server = ClusterWebhookServer(front, **options)
+            await webhook_server.start()
+            await bot.set_webhook(
+                url=url,
+                secret_token=webhook_server.secret_token,
+                allowed_updates=allowed_updates,
+                max_connections=max_connections
+            )
+            logger.info(f"Вебхук кластера установлен: {url}")
+        else:
+            poll_task = asyncio.create_task(_poll_updates(bot, front, allowed_updates, stop_event))
+            # Без приема обновлений (например, WorkerDied) главному процессу работать незачем
+            poll_task.add_done_callback(lambda task: stop_event.set())
+            tasks.append(poll_task)
+
+        try:
+            await stop_event.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error(f"Ошибка главного процесса кластера: {result}")
+            if exporter is not None:
+                await exporter.stop()
+                await database.close_storage()
+            if webhook_server is not None:
+                await webhook_server.stop()
+
+    if front.error is not None:
+        raise front.error
+
+
+def run_cluster(token: str, workers: int, worker_entry, queue_size: int = 1000, **options):
+    """Синхронная точка входа главного процесса кластера"""
+    front = ClusterFront(workers, worker_entry, queue_size)
+    front.start()
+    try:
+        asyncio.run(serve_front(front, token, **options))
+    finally:
+        front.stop()
+
+
+async def serve_worker(application: Application, update_queue):
+    """
+    Работа рабочего процесса: обработка обновлений из очереди главного процесса
+
+    Args:
+        application: Приложение бота (без Updater)
+        update_queue: multiprocessing.Queue с обновлениями в формате JSON Bot API
+    """
+    loop = asyncio.get_running_loop()
+    # Главный процесс сам останавливает рабочие через STOP после обработки очереди
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: None)
+        except NotImplementedError:
+            pass
+
+    def next_update():
+        try:
+            return update_queue.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        while True:
+            data = await loop.run_in_executor(None, next_update)
+            if data is None:
+                continue
+            if data == STOP:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
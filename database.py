@@ -1,15 +1,113 @@
+import asyncio
+import json
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import logging
+import metrics
+import storage
 
 logger = logging.getLogger(__name__)
 
 DB_FILE = 'bot_analytics.db'
 
+# Настройки долгоживущих соединений: WAL позволяет читать во время записи,
+# synchronous=NORMAL в режиме WAL не делает fsync на каждый коммит
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000'
+)
+
+# Количество потоков для чтения (запись всегда идет через один поток)
+READER_THREADS = 2
+
+_executors = {}
+_executors_lock = threading.Lock()
+_local = threading.local()
+_connections = []
+
+# Коды типов действий (action_types); используются только в потоке записи
+_action_codes = {}
+
+
+def _get_connection():
+    """Постоянное соединение текущего потока БД"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        with _executors_lock:
+            _connections.append(conn)
+    return conn
+
+
+def _get_executor(kind):
+    """Пул потоков для записи ('write') или чтения ('read')"""
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            workers = 1 if kind == 'write' else READER_THREADS
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'db-{kind}')
+            _executors[kind] = executor
+        return executor
+
+
+def _call(func, *args):
+    """Выполнение функции с соединением потока, откат при ошибке"""
+    conn = _get_connection()
+    operation = func.__name__.lstrip('_')
+    try:
+        with metrics.DB_IN_FLIGHT.track_inprogress(), metrics.DB_QUERY_SECONDS.time(operation=operation):
+            return func(conn, *args)
+    except Exception:
+        metrics.ERRORS.inc(component='sqlite')
+        conn.rollback()
+        raise
+
+
+def _run_sync(kind, func, *args):
+    """Синхронный вызов функции БД через поток записи или чтения"""
+    return _get_executor(kind).submit(_call, func, *args).result()
+
+
+async def _run_async(kind, func, *args):
+    """Асинхронный вызов функции БД без блокировки event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(kind), _call, func, *args)
+
+
+def close_database():
+    """Остановка потоков БД и закрытие всех соединений"""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+    
+    with _executors_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        conn.close()
+    _action_codes.clear()
+    logger.info("Соединения с базой данных закрыты")
+
 
 def init_database():
     """Инициализация базы данных и создание таблиц"""
-    conn = sqlite3.connect(DB_FILE)
+    _run_sync('write', _init_database)
+
+
+def _init_database(conn):
+    """Создание таблиц (выполняется в потоке записи)"""
     cursor = conn.cursor()
     
     # Таблица пользователей
@@ -48,111 +146,402 @@ def init_database():
     ''')
     
     conn.commit()
-    conn.close()
+    _apply_migrations(conn)
     logger.info("База данных инициализирована")
 
 
-def save_user(user_id, username, first_name, last_name):
-    """Сохранение или обновление информации о пользователе"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def _database_size(conn):
+    """Размер основного файла БД в байтах"""
+    return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+
+def _enable_incremental_vacuum(conn):
+    """
+    Перевод БД в режим auto_vacuum=INCREMENTAL (однократная перестройка файла, выполняется в потоке записи)
+    
+    VACUUM переписывает весь файл и держит эксклюзивную блокировку, поэтому он нужен
+    только при включенной свертке действий (retention.py), а не при каждом запуске.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    # Режим меняется только вместе с VACUUM; если базу держит другой процесс - попробуем при следующем запуске
+    size_before = _database_size(conn)
+    logger.info(f"Перестройка базы данных для incremental vacuum ({size_before / 1024 / 1024:.1f} МБ)...")
+    started = time.monotonic()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    try:
+        conn.execute('VACUUM')
+        logger.info(
+            f"База данных перестроена для incremental vacuum за {time.monotonic() - started:.1f} с: "
+            f"{size_before / 1024 / 1024:.1f} -> {_database_size(conn) / 1024 / 1024:.1f} МБ"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Не удалось включить incremental vacuum: {e}")
+
+
+def _migration_rollups(conn):
+    """Миграция 1: индексы по actions и агрегаты для статистики"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_actions_user_id ON actions (user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_actions_action_type ON actions (action_type)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_actions_timestamp ON actions (timestamp)')
+    
+    # Количество действий по типам
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS action_counts (
+            action_type TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    ''')
+    
+    # Количество действий по пользователям
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_action_counts (
+            user_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_action_counts_count ON user_action_counts (count)')
+    
+    # Количество действий по дням и типам
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_action_counts (
+            day TEXT,
+            action_type TEXT,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, action_type)
+        )
+    ''')
+    
+    # Заполняем агрегаты по уже накопленным действиям
+    conn.execute('''
+        INSERT OR REPLACE INTO action_counts (action_type, count)
+        SELECT action_type, COUNT(*) FROM actions GROUP BY action_type
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO user_action_counts (user_id, count)
+        SELECT user_id, COUNT(*) FROM actions GROUP BY user_id
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO daily_action_counts (day, action_type, count)
+        SELECT date(timestamp), action_type, COUNT(*) FROM actions
+        GROUP BY date(timestamp), action_type
+    ''')
+
+
+def _migration_media_files(conn):
+    """Миграция 2: file_id загруженных в Telegram медиафайлов"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP
+        )
+    ''')
+
+
+def _migration_notifications(conn):
+    """Миграция 3: очередь уведомлений администратору (outbox)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            sent_at TIMESTAMP
+        )
+    ''')
+    # Поиск неотправленных уведомлений, время которых подошло
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_pending
+        ON notifications (next_attempt_at) WHERE sent_at IS NULL
+    ''')
+
+
+def _migration_export_state(conn):
+    """Миграция 4: отметки выгрузки в Google Sheets (последний выгруженный id или день)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP
+        )
+    ''')
+
+
+def _migration_compact_actions(conn):
+    """Миграция 5: компактная таблица actions - коды типов действий и время в секундах epoch"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS action_types (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    conn.execute('''
+        INSERT OR IGNORE INTO action_types (name)
+        SELECT DISTINCT action_type FROM actions WHERE action_type IS NOT NULL ORDER BY action_type
+    ''')
     
-    # Проверяем, есть ли пользователь в БД
-    cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-    existing_user = cursor.fetchone()
+    # Строки без пользователя, типа или времени не переносятся - считаем их, чтобы потеря была видна
+    skipped = conn.execute('''
+        SELECT COUNT(*) FROM actions
+        WHERE user_id IS NULL OR action_type IS NULL OR timestamp IS NULL
+    ''').fetchone()[0]
+    if skipped:
+        logger.warning(f"Миграция actions: {skipped} строк без user_id, action_type или timestamp не перенесены")
     
+    conn.execute('''
+        CREATE TABLE actions_compact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type_id INTEGER NOT NULL REFERENCES action_types (id),
+            ts INTEGER NOT NULL
+        )
+    ''')
+    # Время в старой таблице - локальное; id сохраняются, чтобы не путать строки в архивах и выгрузках
+    conn.execute('''
+        INSERT INTO actions_compact (id, user_id, type_id, ts)
+        SELECT a.id, a.user_id, t.id, CAST(strftime('%s', a.timestamp, 'utc') AS INTEGER)
+        FROM actions a
+        JOIN action_types t ON t.name = a.action_type
+        WHERE a.user_id IS NOT NULL AND a.timestamp IS NOT NULL
+    ''')
+    conn.execute('DROP TABLE actions')
+    conn.execute('ALTER TABLE actions_compact RENAME TO actions')
+    conn.execute('CREATE INDEX idx_actions_ts ON actions (ts)')
+    conn.execute('CREATE INDEX idx_actions_user_id ON actions (user_id)')
+
+
+def _migration_broadcasts(conn):
+    """Миграция 6: рассылки и статус доставки каждому получателю"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            text TEXT,
+            source_chat_id INTEGER,
+            source_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_broadcast_owner(conn):
+    """Миграция 7: процесс, который ведет рассылку, и срок его аренды"""
+    conn.execute('ALTER TABLE broadcasts ADD COLUMN owner TEXT')
+    conn.execute('ALTER TABLE broadcasts ADD COLUMN lease_until REAL')
+
+
+# Миграции схемы по порядку; номер последней примененной хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migration_rollups,
+    _migration_media_files,
+    _migration_notifications,
+    _migration_export_state,
+    _migration_compact_actions,
+    _migration_broadcasts,
+    _migration_broadcast_owner
+]
+
+
+def _apply_migrations(conn):
+    """Обновление схемы существующей БД до последней версии"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    for number, migration in enumerate(MIGRATIONS, 1):
+        if number <= version:
+            continue
+        
+        logger.info(f"Миграция схемы БД до версии {number}")
+        conn.execute('BEGIN')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def _update_rollups(conn, rows):
+    """Инкрементальное обновление агрегатов по новым действиям (в той же транзакции)"""
+    action_counts = Counter(action_type for _, action_type, _ in rows)
+    user_counts = Counter(user_id for user_id, _, _ in rows)
+    daily_counts = Counter((timestamp.date().isoformat(), action_type) for _, action_type, timestamp in rows)
+    
+    conn.executemany('''
+        INSERT INTO action_counts (action_type, count) VALUES (?, ?)
+        ON CONFLICT (action_type) DO UPDATE SET count = count + excluded.count
+    ''', action_counts.items())
+    conn.executemany('''
+        INSERT INTO user_action_counts (user_id, count) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET count = count + excluded.count
+    ''', user_counts.items())
+    conn.executemany('''
+        INSERT INTO daily_action_counts (day, action_type, count) VALUES (?, ?, ?)
+        ON CONFLICT (day, action_type) DO UPDATE SET count = count + excluded.count
+    ''', [(day, action_type, count) for (day, action_type), count in daily_counts.items()])
+
+
+def _save_user(conn, user_id, username, first_name, last_name):
+    """Сохранение пользователя (выполняется в потоке записи)"""
     current_time = datetime.now()
     
-    if existing_user:
-        # Обновляем last_seen
-        cursor.execute('''
-            UPDATE users 
-            SET username = ?, first_name = ?, last_name = ?, last_seen = ?
-            WHERE user_id = ?
-        ''', (username, first_name, last_name, current_time, user_id))
-    else:
-        # Добавляем нового пользователя
-        cursor.execute('''
-            INSERT INTO users (user_id, username, first_name, last_name, first_seen, last_seen)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, current_time, current_time))
-        logger.info(f"Новый пользователь: {user_id} ({first_name})")
+    # Один запрос: вставка нового пользователя или обновление существующего
+    cursor = conn.execute('''
+        INSERT INTO users (user_id, username, first_name, last_name, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            last_seen = excluded.last_seen
+        RETURNING first_seen = last_seen
+    ''', (user_id, username, first_name, last_name, current_time, current_time))
+    is_new = cursor.fetchone()[0]
     
     conn.commit()
-    conn.close()
+    if is_new:
+        logger.info(f"Новый пользователь: {user_id} ({first_name})")
 
 
-def log_action(user_id, action_type):
-    """Логирование действия пользователя"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def _action_type_codes(conn, names):
+    """
+    Коды типов действий; новые типы добавляются в action_types отдельным коммитом
     
-    cursor.execute('''
-        INSERT INTO actions (user_id, action_type, timestamp)
+    Коммит до записи действий нужен, чтобы откат пакета не оставил в кэше код,
+    которого нет в базе.
+    """
+    missing = set(names) - _action_codes.keys()
+    if missing:
+        conn.executemany(
+            'INSERT INTO action_types (name) VALUES (?) ON CONFLICT (name) DO NOTHING',
+            [(name,) for name in sorted(missing)]
+        )
+        conn.commit()
+        placeholders = ', '.join('?' * len(missing))
+        _action_codes.update(
+            (name, id_) for id_, name in
+            conn.execute(f'SELECT id, name FROM action_types WHERE name IN ({placeholders})', tuple(missing))
+        )
+    return _action_codes
+
+
+def _insert_actions(conn, rows):
+    """Запись действий (user_id, action_type, datetime) в компактном виде без коммита"""
+    codes = _action_type_codes(conn, {action_type for _, action_type, _ in rows})
+    conn.executemany('''
+        INSERT INTO actions (user_id, type_id, ts)
         VALUES (?, ?, ?)
-    ''', (user_id, action_type, datetime.now()))
-    
+    ''', [(user_id, codes[action_type], int(timestamp.timestamp())) for user_id, action_type, timestamp in rows])
+    _update_rollups(conn, rows)
+
+
+def _log_action(conn, user_id, action_type):
+    """Запись действия (выполняется в потоке записи)"""
+    _insert_actions(conn, [(user_id, action_type, datetime.now())])
     conn.commit()
-    conn.close()
     logger.info(f"Действие: {action_type} от пользователя {user_id}")
 
 
-def get_statistics():
-    """Получение статистики использования бота"""
-    conn = sqlite3.connect(DB_FILE)
+def _log_actions(conn, rows):
+    """Пакетная запись действий одной транзакцией (выполняется в потоке записи)"""
+    _insert_actions(conn, rows)
+    conn.commit()
+
+
+def _get_statistics(conn):
+    """Подсчет статистики (выполняется в потоке чтения)"""
     cursor = conn.cursor()
     
     # Общее количество пользователей
     cursor.execute('SELECT COUNT(*) FROM users')
     total_users = cursor.fetchone()[0]
     
-    # Количество действий по типам
+    # Количество действий по типам (из агрегатов)
     cursor.execute('''
-        SELECT action_type, COUNT(*) as count 
-        FROM actions 
-        GROUP BY action_type 
+        SELECT action_type, count
+        FROM action_counts
         ORDER BY count DESC
     ''')
     actions_stats = cursor.fetchall()
     
-    # Топ активных пользователей
+    # Топ активных пользователей (из агрегатов, по индексу на count)
     cursor.execute('''
-        SELECT u.user_id, u.first_name, u.username, COUNT(a.id) as action_count
-        FROM users u
-        LEFT JOIN actions a ON u.user_id = a.user_id
-        GROUP BY u.user_id
-        ORDER BY action_count DESC
+        SELECT u.user_id, u.first_name, u.username, c.count
+        FROM user_action_counts c
+        JOIN users u ON u.user_id = c.user_id
+        ORDER BY c.count DESC
         LIMIT 10
     ''')
     top_users = cursor.fetchall()
     
-    conn.close()
+    # Если активных меньше 10, дополняем пользователями без действий
+    if len(top_users) < 10:
+        cursor.execute('''
+            SELECT user_id, first_name, username, 0
+            FROM users
+            WHERE user_id NOT IN (SELECT user_id FROM user_action_counts)
+            LIMIT ?
+        ''', (10 - len(top_users),))
+        top_users += cursor.fetchall()
+    
+    # Действия по дням за последнюю неделю
+    cursor.execute('''
+        SELECT day, SUM(count)
+        FROM daily_action_counts
+        WHERE day >= date('now', 'localtime', '-6 days')
+        GROUP BY day
+        ORDER BY day
+    ''')
+    daily_stats = cursor.fetchall()
     
     return {
         'total_users': total_users,
         'actions_stats': actions_stats,
-        'top_users': top_users
+        'top_users': top_users,
+        'daily_stats': daily_stats
     }
 
 
-def save_application(user_id, phone_number):
-    """Сохранение заявки с номером телефона"""
-    conn = sqlite3.connect(DB_FILE)
+def _save_application(conn, user_id, phone_number, notification=None):
+    """Запись заявки и уведомления о ней одной транзакцией (выполняется в потоке записи)"""
     cursor = conn.cursor()
     
     cursor.execute('''
         INSERT INTO applications (user_id, phone_number, timestamp)
         VALUES (?, ?, ?)
     ''', (user_id, phone_number, datetime.now()))
+    if notification is not None:
+        _insert_notification(conn, *notification)
     
     conn.commit()
-    conn.close()
     logger.info(f"Новая заявка от пользователя {user_id}: {phone_number}")
 
 
-def get_user_info(user_id):
-    """Получение информации о пользователе"""
-    conn = sqlite3.connect(DB_FILE)
+def _get_user_info(conn, user_id):
+    """Чтение пользователя (выполняется в потоке чтения)"""
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -161,7 +550,922 @@ def get_user_info(user_id):
         WHERE user_id = ?
     ''', (user_id,))
     
-    user_info = cursor.fetchone()
-    conn.close()
+    return cursor.fetchone()
+
+
+def _get_media_file_id(conn, path, content_hash):
+    """Чтение file_id медиафайла с тем же содержимым (выполняется в потоке чтения)"""
+    row = conn.execute('''
+        SELECT file_id FROM media_files
+        WHERE path = ? AND content_hash = ?
+    ''', (path, content_hash)).fetchone()
+    return row[0] if row else None
+
+
+def _save_media_file_id(conn, path, content_hash, file_id):
+    """Запись file_id медиафайла (выполняется в потоке записи)"""
+    conn.execute('''
+        INSERT INTO media_files (path, content_hash, file_id, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            content_hash = excluded.content_hash,
+            file_id = excluded.file_id,
+            updated_at = excluded.updated_at
+    ''', (path, content_hash, file_id, datetime.now()))
+    conn.commit()
+
+
+def _delete_media_file_id(conn, path):
+    """Удаление file_id медиафайла (выполняется в потоке записи)"""
+    conn.execute('DELETE FROM media_files WHERE path = ?', (path,))
+    conn.commit()
+
+
+def _insert_notification(conn, chat_id, kind, payload):
+    """Добавление уведомления в очередь без коммита"""
+    conn.execute('''
+        INSERT INTO notifications (chat_id, kind, payload, created_at, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (chat_id, kind, json.dumps(payload, ensure_ascii=False), datetime.now(), time.time()))
+
+
+def _enqueue_notification(conn, chat_id, kind, payload):
+    """Добавление уведомления в очередь (выполняется в потоке записи)"""
+    _insert_notification(conn, chat_id, kind, payload)
+    conn.commit()
+
+
+def _claim_notifications(conn, now, lease, limit):
+    """
+    Захват уведомлений, время отправки которых подошло (выполняется в потоке записи)
+    
+    Захваченные уведомления откладываются на lease секунд, поэтому другой процесс
+    их не отправит, а после аварийной остановки отправка повторится.
+    """
+    rows = conn.execute('''
+        UPDATE notifications SET next_attempt_at = ?
+        WHERE id IN (
+            SELECT id FROM notifications
+            WHERE sent_at IS NULL AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+        )
+        RETURNING id, chat_id, kind, payload, attempts
+    ''', (now + lease, now, limit)).fetchall()
+    conn.commit()
+    rows.sort()
+    return [(id_, chat_id, kind, json.loads(payload), attempts) for id_, chat_id, kind, payload, attempts in rows]
+
+
+def _mark_notifications_sent(conn, ids):
+    """Отметка об отправке уведомлений (выполняется в потоке записи)"""
+    sent_at = datetime.now()
+    conn.executemany(
+        'UPDATE notifications SET sent_at = ?, last_error = NULL WHERE id = ?',
+        [(sent_at, id_) for id_ in ids]
+    )
+    conn.commit()
+
+
+def _reschedule_notifications(conn, ids, next_attempt_at, error, count_attempt):
+    """Перенос отправки уведомлений (выполняется в потоке записи)"""
+    conn.executemany('''
+        UPDATE notifications
+        SET next_attempt_at = ?, last_error = ?, attempts = attempts + ?
+        WHERE id = ?
+    ''', [(next_attempt_at, error, int(count_attempt), id_) for id_ in ids])
+    conn.commit()
+
+
+def _count_pending_notifications(conn):
+    """Количество неотправленных уведомлений (выполняется в потоке чтения)"""
+    return conn.execute('SELECT COUNT(*) FROM notifications WHERE sent_at IS NULL').fetchone()[0]
+
+
+def _get_export_state(conn, name):
+    """Чтение отметки выгрузки (выполняется в потоке чтения)"""
+    row = conn.execute('SELECT value FROM export_state WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_export_state(conn, name, value):
+    """Запись отметки выгрузки (выполняется в потоке записи)"""
+    conn.execute('''
+        INSERT INTO export_state (name, value, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    ''', (name, str(value), datetime.now()))
+    conn.commit()
+
+
+def _claim_export(conn, name, owner, lease_seconds):
+    """
+    Захват или продление аренды выгрузки (выполняется в потоке записи)
     
+    Аренда - строка export_state: value - владелец, updated_at - когда он ее продлил.
+    """
+    now = datetime.now()
+    cursor = conn.execute('''
+        INSERT INTO export_state (name, value, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        WHERE export_state.value = excluded.value OR export_state.updated_at < ?
+    ''', (name, owner, now, now - timedelta(seconds=lease_seconds)))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def _get_applications_after(conn, last_id, limit):
+    """Заявки с id больше last_id вместе с профилем пользователя (выполняется в потоке чтения)"""
+    return conn.execute('''
+        SELECT a.id, a.timestamp, a.user_id, u.username, u.first_name, u.last_name,
+               a.phone_number, a.status
+        FROM applications a
+        LEFT JOIN users u ON u.user_id = a.user_id
+        WHERE a.id > ?
+        ORDER BY a.id
+        LIMIT ?
+    ''', (last_id, limit)).fetchall()
+
+
+def _get_daily_rollups_between(conn, after_day, before_day, limit):
+    """Агрегаты действий за дни после after_day и до before_day (выполняется в потоке чтения)"""
+    return conn.execute('''
+        SELECT day, action_type, count
+        FROM daily_action_counts
+        WHERE day > ? AND day < ?
+        ORDER BY day, action_type
+        LIMIT ?
+    ''', (after_day, before_day, limit)).fetchall()
+
+
+def _count_users(conn):
+    """Количество пользователей (выполняется в потоке чтения)"""
+    return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+
+def _get_user_ids_after(conn, after_user_id, limit):
+    """Следующие пользователи по возрастанию user_id, без OFFSET (выполняется в потоке чтения)"""
+    return [row[0] for row in conn.execute(
+        'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+        (after_user_id, limit)
+    )]
+
+
+def _create_broadcast(conn, admin_chat_id, text, source_chat_id, source_message_id, total):
+    """Создание рассылки на total получателей (выполняется в потоке записи)"""
+    broadcast_id = conn.execute('''
+        INSERT INTO broadcasts (admin_chat_id, text, source_chat_id, source_message_id, total, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        RETURNING id
+    ''', (admin_chat_id, text, source_chat_id, source_message_id, total, datetime.now())).fetchone()[0]
+    conn.commit()
+    return broadcast_id
+
+
+def _get_broadcast(conn, broadcast_id=None):
+    """Рассылка по id или последняя созданная, словарем (выполняется в потоке чтения)"""
+    if broadcast_id is None:
+        cursor = conn.execute('SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1')
+    else:
+        cursor = conn.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+def _get_running_broadcast_ids(conn):
+    """Рассылки, прерванные остановкой бота (выполняется в потоке чтения)"""
+    return [row[0] for row in conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")]
+
+
+def _set_broadcast_status(conn, broadcast_id, status):
+    """Смена статуса рассылки: running, paused или done (выполняется в потоке записи)"""
+    finished_at = datetime.now() if status == 'done' else None
+    conn.execute(
+        'UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?',
+        (status, finished_at, broadcast_id)
+    )
+    conn.commit()
+
+
+def _claim_broadcast(conn, broadcast_id, owner, lease_seconds):
+    """
+    Захват или продление аренды рассылки (выполняется в потоке записи)
+    
+    Удается, если рассылка идет и ее никто не ведет, ведет этот же owner
+    или аренда другого процесса истекла. Возвращает True при успехе.
+    """
+    now = time.time()
+    cursor = conn.execute('''
+        UPDATE broadcasts SET owner = ?, lease_until = ?
+        WHERE id = ? AND status = 'running'
+          AND (owner IS NULL OR owner = ? OR lease_until < ?)
+    ''', (owner, now + lease_seconds, broadcast_id, owner, now))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def _release_broadcast(conn, broadcast_id, owner):
+    """Освобождение аренды рассылки, если ее держит owner (выполняется в потоке записи)"""
+    conn.execute(
+        'UPDATE broadcasts SET owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?',
+        (broadcast_id, owner)
+    )
+    conn.commit()
+
+
+def _filter_undelivered(conn, broadcast_id, user_ids):
+    """Пользователи из user_ids, которым рассылка еще не отправлялась (выполняется в потоке чтения)"""
+    placeholders = ', '.join('?' * len(user_ids))
+    delivered = {row[0] for row in conn.execute(
+        f'SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id IN ({placeholders})',
+        (broadcast_id, *user_ids)
+    )}
+    return [user_id for user_id in user_ids if user_id not in delivered]
+
+
+def _record_broadcast_deliveries(conn, broadcast_id, results, last_user_id):
+    """
+    Запись результатов доставки и продвижение курсора одной транзакцией (выполняется в потоке записи)
+    
+    results - список (user_id, status, error); last_user_id=None оставляет курсор на месте
+    (например, если пакет прерван на середине).
+    """
+    updated_at = datetime.now()
+    conn.executemany('''
+        INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, user_id, status, error, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(broadcast_id, user_id, status, error, updated_at) for user_id, status, error in results])
+    counts = Counter(status for _, status, _ in results)
+    conn.execute('''
+        UPDATE broadcasts
+        SET sent = sent + ?, blocked = blocked + ?, failed = failed + ?,
+            last_user_id = MAX(last_user_id, ?)
+        WHERE id = ?
+    ''', (counts['sent'], counts['blocked'], counts['failed'], last_user_id or 0, broadcast_id))
+    conn.commit()
+
+
+def _get_oldest_action_day(conn, before_ts):
+    """Самый ранний день (локальный) с действиями старше before_ts (выполняется в потоке чтения)"""
+    return conn.execute('''
+        SELECT date(MIN(ts), 'unixepoch', 'localtime') FROM actions WHERE ts < ?
+    ''', (before_ts,)).fetchone()[0]
+
+
+def _attach_archive(conn, archive_path):
+    """Подключение файла архива действий с той же компактной схемой"""
+    conn.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.action_types (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.actions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            type_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_actions_ts ON actions (ts)')
+    conn.commit()
+
+
+def _detach_archive(conn):
+    """Отключение файла архива, если он подключен"""
+    if any(row[1] == 'archive' for row in conn.execute('PRAGMA database_list')):
+        conn.execute('DETACH DATABASE archive')
+
+
+def _compact_action_day(conn, day, archive_path):
+    """
+    Свертка действий за день в агрегаты и перенос в архив (выполняется в потоке записи)
+    
+    Агрегаты за день пересчитываются по сырым строкам, строки копируются в архив
+    (INSERT OR IGNORE - повтор после сбоя безопасен) и удаляются из основной базы.
+    
+    Returns:
+        Количество удаленных строк
+    """
+    start = datetime.fromisoformat(day)
+    bounds = (int(start.timestamp()), int((start + timedelta(days=1)).timestamp()))
+    try:
+        if archive_path:
+            _attach_archive(conn, archive_path)
+        conn.execute('''
+            INSERT INTO daily_action_counts (day, action_type, count)
+            SELECT ?, t.name, COUNT(*)
+            FROM actions a
+            JOIN action_types t ON t.id = a.type_id
+            WHERE a.ts >= ? AND a.ts < ?
+            GROUP BY t.name
+            ON CONFLICT (day, action_type) DO UPDATE SET count = excluded.count
+        ''', (day, *bounds))
+        if archive_path:
+            conn.execute('INSERT OR IGNORE INTO archive.action_types SELECT id, name FROM main.action_types')
+            conn.execute('''
+                INSERT OR IGNORE INTO archive.actions (id, user_id, type_id, ts)
+                SELECT id, user_id, type_id, ts FROM main.actions
+                WHERE ts >= ? AND ts < ?
+            ''', bounds)
+        deleted = conn.execute('DELETE FROM main.actions WHERE ts >= ? AND ts < ?', bounds).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if archive_path:
+            _detach_archive(conn)
+    return deleted
+
+
+def _incremental_vacuum(conn):
+    """
+    Возврат свободных страниц файлу БД и усечение WAL (выполняется в потоке записи)
+    
+    Returns:
+        Количество освобожденных страниц
+    """
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # executescript выполняет прагму до конца (execute освобождает одну страницу за шаг)
+    conn.executescript('PRAGMA incremental_vacuum;')
+    freed = free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return freed
+
+
+# Синхронные функции (прежний интерфейс). Блокируют вызывающий поток,
+# поэтому в обработчиках бота используйте асинхронные версии ниже.
+# Работают только с SQLite, независимо от выбранного хранилища.
+
+def save_user(user_id, username, first_name, last_name):
+    """Сохранение или обновление информации о пользователе"""
+    profile = (user_id, username, first_name, last_name)
+    if _user_cache.is_fresh(profile):
+        return
+    _run_sync('write', _save_user, *profile)
+    _user_cache.put(profile, written=True)
+
+
+def log_action(user_id, action_type):
+    """Логирование действия пользователя"""
+    return _run_sync('write', _log_action, user_id, action_type)
+
+
+def get_statistics():
+    """Получение статистики использования бота"""
+    return _run_sync('read', _get_statistics)
+
+
+def save_application(user_id, phone_number):
+    """Сохранение заявки с номером телефона"""
+    return _run_sync('write', _save_application, user_id, phone_number)
+
+
+def get_user_info(user_id):
+    """Получение информации о пользователе"""
+    user_info = _user_cache.get(user_id)
+    if user_info is None:
+        user_info = _run_sync('read', _get_user_info, user_id)
+        if user_info:
+            _user_cache.put(user_info)
+    return user_info
+
+
+# Асинхронные функции: пользователи, действия, заявки, статистика и отметки выгрузки -
+# в выбранном хранилище (см. open_storage), остальное - в SQLite в отдельных потоках
+
+async def save_user_async(user_id, username, first_name, last_name):
+    """Сохранение или обновление информации о пользователе без блокировки event loop"""
+    profile = (user_id, username, first_name, last_name)
+    if _user_cache.is_fresh(profile):
+        return
+    await _storage.save_user(*profile)
+    _user_cache.put(profile, written=True)
+
+
+async def log_action_async(user_id, action_type):
+    """Логирование действия пользователя без блокировки event loop"""
+    if _action_buffer is not None:
+        return await _action_buffer.put(user_id, action_type)
+    return await _storage.log_action(user_id, action_type)
+
+
+async def get_statistics_async():
+    """Получение статистики использования бота без блокировки event loop"""
+    # Сначала дописываем накопленные действия, чтобы статистика была актуальной
+    if _action_buffer is not None:
+        await _action_buffer.flush()
+    return await _storage.get_statistics()
+
+
+async def save_application_async(user_id, phone_number, notification=None):
+    """
+    Сохранение заявки с номером телефона без блокировки event loop
+    
+    notification - (chat_id, kind, payload): уведомление, которое попадает
+    в очередь notifications в одной транзакции с заявкой (если заявки хранятся
+    в SQLite; иначе уведомление ставится в очередь до фиксации заявки)
+    """
+    return await _storage.save_application(user_id, phone_number, notification)
+
+
+async def get_user_info_async(user_id):
+    """Получение информации о пользователе без блокировки event loop"""
+    user_info = _user_cache.get(user_id)
+    if user_info is None:
+        user_info = await _storage.get_user_info(user_id)
+        if user_info:
+            _user_cache.put(user_info)
     return user_info
+
+
+async def get_media_file_id_async(path, content_hash):
+    """Получение сохраненного file_id медиафайла без блокировки event loop"""
+    return await _run_async('read', _get_media_file_id, path, content_hash)
+
+
+async def save_media_file_id_async(path, content_hash, file_id):
+    """Сохранение file_id медиафайла без блокировки event loop"""
+    return await _run_async('write', _save_media_file_id, path, content_hash, file_id)
+
+
+async def delete_media_file_id_async(path):
+    """Удаление file_id медиафайла без блокировки event loop"""
+    return await _run_async('write', _delete_media_file_id, path)
+
+
+async def enqueue_notification_async(chat_id, kind, payload):
+    """Добавление уведомления в очередь без блокировки event loop"""
+    return await _run_async('write', _enqueue_notification, chat_id, kind, payload)
+
+
+async def claim_notifications_async(now, lease, limit):
+    """Захват уведомлений для отправки без блокировки event loop"""
+    return await _run_async('write', _claim_notifications, now, lease, limit)
+
+
+async def mark_notifications_sent_async(ids):
+    """Отметка об отправке уведомлений без блокировки event loop"""
+    return await _run_async('write', _mark_notifications_sent, ids)
+
+
+async def reschedule_notifications_async(ids, next_attempt_at, error, count_attempt=True):
+    """Перенос отправки уведомлений без блокировки event loop"""
+    return await _run_async('write', _reschedule_notifications, ids, next_attempt_at, error, count_attempt)
+
+
+async def count_pending_notifications_async():
+    """Количество неотправленных уведомлений без блокировки event loop"""
+    return await _run_async('read', _count_pending_notifications)
+
+
+async def get_export_state_async(name):
+    """Чтение отметки выгрузки без блокировки event loop"""
+    return await _storage.get_export_state(name)
+
+
+async def set_export_state_async(name, value):
+    """Запись отметки выгрузки без блокировки event loop"""
+    return await _storage.set_export_state(name, value)
+
+
+async def claim_export_async(name, owner, lease_seconds):
+    """Захват или продление аренды выгрузки без блокировки event loop"""
+    return await _storage.claim_export(name, owner, lease_seconds)
+
+
+async def get_applications_after_async(last_id, limit):
+    """Заявки после last_id без блокировки event loop"""
+    return await _storage.get_applications_after(last_id, limit)
+
+
+async def get_daily_rollups_between_async(after_day, before_day, limit):
+    """Агрегаты действий по дням без блокировки event loop"""
+    return await _storage.get_daily_rollups_between(after_day, before_day, limit)
+
+
+async def create_broadcast_async(admin_chat_id, text=None, source_chat_id=None, source_message_id=None):
+    """Создание рассылки без блокировки event loop"""
+    total = await _storage.count_users()
+    return await _run_async('write', _create_broadcast, admin_chat_id, text, source_chat_id, source_message_id, total)
+
+
+async def get_broadcast_async(broadcast_id=None):
+    """Рассылка по id (или последняя) без блокировки event loop"""
+    return await _run_async('read', _get_broadcast, broadcast_id)
+
+
+async def get_running_broadcast_ids_async():
+    """Прерванные рассылки без блокировки event loop"""
+    return await _run_async('read', _get_running_broadcast_ids)
+
+
+async def set_broadcast_status_async(broadcast_id, status):
+    """Смена статуса рассылки без блокировки event loop"""
+    return await _run_async('write', _set_broadcast_status, broadcast_id, status)
+
+
+async def claim_broadcast_async(broadcast_id, owner, lease_seconds):
+    """Захват или продление аренды рассылки без блокировки event loop"""
+    return await _run_async('write', _claim_broadcast, broadcast_id, owner, lease_seconds)
+
+
+async def release_broadcast_async(broadcast_id, owner):
+    """Освобождение аренды рассылки без блокировки event loop"""
+    return await _run_async('write', _release_broadcast, broadcast_id, owner)
+
+
+async def get_broadcast_recipients_async(broadcast_id, after_user_id, limit):
+    """
+    Следующие получатели рассылки без блокировки event loop
+    
+    Пользователи читаются из хранилища постранично по ключу, уже получившие
+    рассылку пропускаются (отметки доставки - в SQLite).
+    """
+    while True:
+        user_ids = await _storage.get_user_ids_after(after_user_id, limit)
+        if not user_ids:
+            return []
+        recipients = await _run_async('read', _filter_undelivered, broadcast_id, user_ids)
+        if recipients:
+            return recipients
+        after_user_id = user_ids[-1]
+
+
+async def record_broadcast_deliveries_async(broadcast_id, results, last_user_id=None):
+    """Запись результатов доставки рассылки без блокировки event loop"""
+    return await _run_async('write', _record_broadcast_deliveries, broadcast_id, results, last_user_id)
+
+
+async def get_oldest_action_day_async(before_ts):
+    """Самый ранний день с действиями старше before_ts без блокировки event loop"""
+    return await _run_async('read', _get_oldest_action_day, before_ts)
+
+
+async def compact_action_day_async(day, archive_path=None):
+    """Свертка и архивация действий за день без блокировки event loop"""
+    return await _run_async('write', _compact_action_day, day, archive_path)
+
+
+async def enable_incremental_vacuum_async():
+    """Однократный перевод БД в режим incremental vacuum без блокировки event loop"""
+    return await _run_async('write', _enable_incremental_vacuum)
+
+
+async def incremental_vacuum_async():
+    """Возврат свободного места файлу БД без блокировки event loop"""
+    return await _run_async('write', _incremental_vacuum)
+
+
+class SQLiteStorage(storage.Storage):
+    """Хранилище в файле SQLite (DB_FILE): запись через один поток, чтение - через пул потоков"""
+    
+    name = 'sqlite'
+    
+    async def save_user(self, user_id, username, first_name, last_name):
+        await _run_async('write', _save_user, user_id, username, first_name, last_name)
+    
+    async def get_user_info(self, user_id):
+        return await _run_async('read', _get_user_info, user_id)
+    
+    async def count_users(self):
+        return await _run_async('read', _count_users)
+    
+    async def get_user_ids_after(self, after_user_id, limit):
+        return await _run_async('read', _get_user_ids_after, after_user_id, limit)
+    
+    async def log_action(self, user_id, action_type):
+        await _run_async('write', _log_action, user_id, action_type)
+    
+    async def log_actions(self, rows):
+        await _run_async('write', _log_actions, rows)
+    
+    async def save_application(self, user_id, phone_number, notification=None):
+        """Запись заявки; notification попадает в очередь уведомлений той же транзакцией"""
+        await _run_async('write', _save_application, user_id, phone_number, notification)
+    
+    async def get_statistics(self):
+        return await _run_async('read', _get_statistics)
+    
+    async def get_applications_after(self, last_id, limit):
+        return await _run_async('read', _get_applications_after, last_id, limit)
+    
+    async def get_daily_rollups_between(self, after_day, before_day, limit):
+        return await _run_async('read', _get_daily_rollups_between, after_day, before_day, limit)
+    
+    async def get_export_state(self, name):
+        return await _run_async('read', _get_export_state, name)
+    
+    async def set_export_state(self, name, value):
+        await _run_async('write', _set_export_state, name, value)
+    
+    async def claim_export(self, name, owner, lease_seconds):
+        return await _run_async('write', _claim_export, name, owner, lease_seconds)
+
+
+# Текущее хранилище пользователей, действий и заявок
+_storage = SQLiteStorage()
+
+async def open_storage(backend: str = 'sqlite', **options) -> storage.Storage:
+    """
+    Выбор и подключение хранилища пользователей, действий и заявок
+    
+    Args:
+        backend: sqlite или postgres
+        **options: Параметры PostgresStorage (dsn, размер пула и т.д.)
+    """
+    global _storage
+    if backend == 'sqlite':
+        selected = SQLiteStorage()
+    elif backend == 'postgres':
+        # asyncpg нужен только для PostgreSQL
+        import postgres_storage
+        # Очередь уведомлений остается в SQLite
+        selected = postgres_storage.PostgresStorage(enqueue_notification=enqueue_notification_async, **options)
+    else:
+        raise ValueError(f"Неизвестное хранилище: {backend}")
+    await selected.open()
+    _storage = selected
+    logger.info(f"Хранилище данных: {selected.name}")
+    return selected
+
+async def close_storage():
+    """Закрытие хранилища; дальше используется SQLite"""
+    global _storage
+    current, _storage = _storage, SQLiteStorage()
+    await current.close()
+
+def get_storage() -> storage.Storage:
+    """Получение текущего хранилища"""
+    return _storage
+
+
+class UserCache:
+    """LRU-кэш профилей пользователей для пропуска повторных записей"""
+    
+    def __init__(self, max_size: int = 10000, debounce: float = 300.0):
+        """
+        Инициализация кэша пользователей
+        
+        Args:
+            max_size: Максимальное количество профилей в кэше
+            debounce: Не обновлять last_seen чаще, чем раз в столько секунд
+        """
+        self.max_size = max_size
+        self.debounce = debounce
+        
+        # user_id -> (профиль, время последней записи в БД или None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'skipped_writes': 0,
+            'evictions': 0
+        }
+    
+    def get(self, user_id):
+        """Профиль (user_id, username, first_name, last_name) или None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.stats['hits'] += 1
+            return entry[0]
+    
+    def is_fresh(self, profile) -> bool:
+        """Профиль не изменился и last_seen недавно записан - запись можно пропустить"""
+        with self._lock:
+            entry = self._entries.get(profile[0])
+            if entry is None:
+                return False
+            cached_profile, written_at = entry
+            if (cached_profile == profile and written_at is not None
+                    and time.monotonic() - written_at < self.debounce):
+                self._entries.move_to_end(profile[0])
+                self.stats['skipped_writes'] += 1
+                return True
+            return False
+    
+    def put(self, profile, written: bool = False):
+        """
+        Сохранение профиля в кэше
+        
+        Args:
+            profile: Кортеж (user_id, username, first_name, last_name)
+            written: Профиль только что записан в БД вместе с last_seen
+        """
+        with self._lock:
+            user_id = profile[0]
+            written_at = time.monotonic() if written else None
+            if not written and user_id in self._entries:
+                written_at = self._entries[user_id][1]
+            self._entries[user_id] = (tuple(profile), written_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+    
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков кэша
+        
+        Returns:
+            Словарь с попаданиями, промахами и пропущенными записями
+        """
+        with self._lock:
+            cache_stats = dict(self.stats)
+            cache_stats['size'] = len(self._entries)
+        return cache_stats
+
+
+# Глобальный кэш пользователей
+_user_cache = UserCache()
+
+def init_user_cache(max_size: int = 10000, debounce: float = 300.0) -> UserCache:
+    """Настройка глобального кэша пользователей"""
+    global _user_cache
+    _user_cache = UserCache(max_size, debounce)
+    return _user_cache
+
+def get_user_cache() -> UserCache:
+    """Получение глобального кэша пользователей"""
+    return _user_cache
+
+
+class ActionBuffer:
+    """Буфер действий пользователей с пакетной записью в БД"""
+    
+    # Что делать при переполнении очереди
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_new', 'block')
+    
+    def __init__(self, batch_size: int = 100, flush_interval: float = 2.0,
+                 max_size: int = 10000, overflow_policy: str = 'drop_oldest'):
+        """
+        Инициализация буфера действий
+        
+        Args:
+            batch_size: Сколько действий записывать одной транзакцией
+            flush_interval: Максимальная задержка записи (сек)
+            max_size: Максимальный размер очереди
+            overflow_policy: drop_oldest - вытеснять старые действия,
+                drop_new - отбрасывать новые, block - ждать места в очереди
+        """
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения: {overflow_policy}")
+        
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        
+        self.queue = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stopping = False
+        
+        # Метрики очереди и записи
+        self.stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'flushed': 0,
+            'batches': 0,
+            'flush_errors': 0,
+            'last_flush_seconds': 0.0,
+            'max_flush_seconds': 0.0,
+            'total_flush_seconds': 0.0
+        }
+    
+    def start(self):
+        """Запуск фоновой записи (нужен работающий event loop)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        """Остановка фоновой записи и сброс оставшихся действий в БД"""
+        if self._task is not None:
+            # Не отменяем задачу: отмена посреди записи пакета потеряла бы его
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+    
+    async def put(self, user_id, action_type):
+        """Добавление действия в очередь"""
+        while len(self.queue) >= self.max_size:
+            if self.overflow_policy == 'drop_new':
+                self.stats['dropped'] += 1
+                return
+            if self.overflow_policy == 'drop_oldest':
+                self.queue.popleft()
+                self.stats['dropped'] += 1
+                break
+            # block: будим запись и ждем, пока очередь освободится
+            self._space.clear()
+            self._wakeup.set()
+            await self._space.wait()
+        
+        self.queue.append((user_id, action_type, datetime.now()))
+        self.stats['enqueued'] += 1
+        if len(self.queue) >= self.batch_size:
+            self._wakeup.set()
+    
+    async def flush(self):
+        """Запись всех накопленных действий пакетами"""
+        async with self._flush_lock:
+            while self.queue:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self._space.set()
+                
+                started = time.monotonic()
+                try:
+                    await _storage.log_actions(batch)
+                except asyncio.CancelledError:
+                    # Пакет мог не записаться - возвращаем его, stop() допишет
+                    self._requeue(batch)
+                    raise
+                except Exception as e:
+                    # Возвращаем пакет в начало очереди, попробуем в следующий раз
+                    self.stats['flush_errors'] += 1
+                    logger.error(f"Ошибка записи действий в БД: {e}")
+                    self._requeue(batch)
+                    return
+                elapsed = time.monotonic() - started
+                
+                self.stats['flushed'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['last_flush_seconds'] = elapsed
+                self.stats['max_flush_seconds'] = max(self.stats['max_flush_seconds'], elapsed)
+                self.stats['total_flush_seconds'] += elapsed
+                logger.debug(f"Записано действий: {len(batch)} за {elapsed:.3f} с")
+    
+    def _requeue(self, batch):
+        """Возврат незаписанного пакета в начало очереди с учетом политики переполнения"""
+        self.queue.extendleft(reversed(batch))
+        overflow = len(self.queue) - self.max_size
+        if overflow <= 0 or self.overflow_policy == 'block':
+            # block: добавляющие ждут, пока очередь не станет меньше max_size
+            return
+        for _ in range(overflow):
+            if self.overflow_policy == 'drop_oldest':
+                self.queue.popleft()
+            else:
+                self.queue.pop()
+        self.stats['dropped'] += overflow
+        logger.warning(f"Очередь действий переполнена после ошибки записи, потеряно: {overflow}")
+    
+    async def _run(self):
+        """Фоновая запись по размеру пакета или по таймеру"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    def get_stats(self) -> dict:
+        """
+        Получение метрик буфера
+        
+        Returns:
+            Словарь с глубиной очереди и временем записи
+        """
+        buffer_stats = dict(self.stats)
+        buffer_stats['queue_depth'] = len(self.queue)
+        batches = buffer_stats['batches']
+        buffer_stats['avg_flush_seconds'] = (
+            buffer_stats['total_flush_seconds'] / batches if batches else 0.0
+        )
+        return buffer_stats
+
+
+# Глобальный буфер действий
+_action_buffer = None
+
+def start_action_buffer(**options) -> ActionBuffer:
+    """Запуск глобального буфера действий"""
+    global _action_buffer
+    _action_buffer = ActionBuffer(**options)
+    _action_buffer.start()
+    return _action_buffer
+
+async def stop_action_buffer():
+    """Остановка глобального буфера действий с записью остатка"""
+    global _action_buffer
+    if _action_buffer is not None:
+        buffer = _action_buffer
+        _action_buffer = None
+        await buffer.stop()
+
+def get_action_buffer() -> ActionBuffer:
+    """Получение глобального буфера действий"""
+    return _action_buffer
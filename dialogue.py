@@ -0,0 +1,289 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Грубая оценка: в русском тексте на токен приходится около 3 символов
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка количества токенов в тексте без токенизатора"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class _Exchange:
+    """Вопрос пользователя и ответ AI"""
+    __slots__ = ('question', 'answer', 'tokens')
+
+    def __init__(self, question: str, answer: str):
+        self.question = question
+        self.answer = answer
+        self.tokens = estimate_tokens(question) + estimate_tokens(answer)
+
+
+class _Dialogue:
+    """История диалога одного пользователя"""
+    __slots__ = ('exchanges', 'tokens', 'updated_at')
+
+    def __init__(self, updated_at: float):
+        self.exchanges = deque()
+        self.tokens = 0
+        self.updated_at = updated_at
+
+
+class DialogueMemory:
+    """Память диалогов: LRU по пользователям с бюджетом токенов и выгрузкой в SQLite"""
+
+    def __init__(self, history_tokens: int = 1500, max_turns: int = 10, max_users: int = 5000,
+                 max_total_tokens: int = 2_000_000, idle_ttl: float = 1800.0,
+                 spill_path: str = None, spill_ttl: float = 7 * 24 * 3600.0):
+        """
+        Инициализация памяти диалогов
+
+        Args:
+            history_tokens: Сколько токенов истории отправлять в Grok вместе с вопросом
+            max_turns: Максимум пар вопрос-ответ в истории пользователя
+            max_users: Максимум диалогов в памяти
+            max_total_tokens: Максимум токенов во всех диалогах в памяти
+            idle_ttl: Через сколько секунд бездействия диалог уходит из памяти
+            spill_path: SQLite файл для вытесненных диалогов (если не задан - они удаляются)
+            spill_ttl: Сколько секунд хранить вытесненный диалог в файле
+        """
+        self.history_tokens = history_tokens
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.max_total_tokens = max_total_tokens
+        self.idle_ttl = idle_ttl
+        self.spill_path = spill_path
+        self.spill_ttl = spill_ttl
+
+        # user_id -> _Dialogue; в начале - давно не активные
+        self._dialogues = OrderedDict()
+        self._tokens = 0
+
+        self._conn = None
+        self._conn_lock = threading.Lock()
+
+        self.stats = {
+            'evicted_idle': 0,
+            'evicted_capacity': 0,
+            'trimmed': 0,
+            'spilled': 0,
+            'restored': 0
+        }
+
+    def load(self):
+        """Открытие файла выгруженных диалогов (блокирующий вызов)"""
+        if not self.spill_path:
+            return
+
+        with self._conn_lock:
+            self._conn = sqlite3.connect(self.spill_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS dialogues (
+                    user_id INTEGER PRIMARY KEY,
+                    exchanges TEXT,
+                    updated_at REAL
+                )
+            ''')
+            self._conn.execute('DELETE FROM dialogues WHERE updated_at < ?', (time.time() - self.spill_ttl,))
+            self._conn.commit()
+
+    def close(self):
+        """Выгрузка диалогов из памяти и закрытие файла (блокирующий вызов)"""
+        if self._conn is not None and self._dialogues:
+            self._spill(list(self._dialogues.items()))
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def history(self, user_id: int) -> list:
+        """
+        История диалога для запроса к Grok
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            Сообщения user/assistant в пределах бюджета токенов, от старых к новым
+        """
+        dialogue = self._dialogues.get(user_id)
+        if dialogue is None and self._conn is not None:
+            dialogue = await asyncio.to_thread(self._restore, user_id)
+            if dialogue is not None and user_id not in self._dialogues:
+                self._insert(user_id, dialogue)
+        if dialogue is None:
+            return []
+
+        self._dialogues.move_to_end(user_id)
+        messages = []
+        for exchange in dialogue.exchanges:
+            messages.append({"role": "user", "content": exchange.question})
+            messages.append({"role": "assistant", "content": exchange.answer})
+        return messages
+
+    async def append(self, user_id: int, question: str, answer: str):
+        """
+        Добавление вопроса и ответа в историю пользователя
+
+        Args:
+            user_id: ID пользователя
+            question: Вопрос пользователя
+            answer: Ответ AI
+        """
+        now = time.time()
+        dialogue = self._dialogues.get(user_id)
+        if dialogue is None:
+            dialogue = _Dialogue(now)
+            self._insert(user_id, dialogue)
+        else:
+            self._dialogues.move_to_end(user_id)
+            dialogue.updated_at = now
+
+        exchange = _Exchange(question, answer)
+        dialogue.exchanges.append(exchange)
+        dialogue.tokens += exchange.tokens
+        self._tokens += exchange.tokens
+
+        # Старые реплики, которые не поместятся в запрос, хранить незачем
+        while dialogue.exchanges and (dialogue.tokens > self.history_tokens
+                                      or len(dialogue.exchanges) > self.max_turns):
+            dropped = dialogue.exchanges.popleft()
+            dialogue.tokens -= dropped.tokens
+            self._tokens -= dropped.tokens
+            self.stats['trimmed'] += 1
+        if not dialogue.exchanges:
+            self._remove(user_id)
+
+        evicted = self._evict(now)
+        if evicted and self._conn is not None:
+            await asyncio.to_thread(self._spill, evicted)
+
+    async def clear(self, user_id: int):
+        """Удаление истории пользователя (начало нового диалога)"""
+        if user_id in self._dialogues:
+            self._remove(user_id)
+        if self._conn is not None:
+            await asyncio.to_thread(self._delete, user_id)
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков памяти диалогов
+
+        Returns:
+            Словарь с количеством диалогов, токенов и вытеснений
+        """
+        memory_stats = dict(self.stats)
+        memory_stats['users'] = len(self._dialogues)
+        memory_stats['tokens'] = self._tokens
+        return memory_stats
+
+    def _insert(self, user_id, dialogue):
+        """Добавление диалога в конец LRU"""
+        self._dialogues[user_id] = dialogue
+        self._tokens += dialogue.tokens
+
+    def _remove(self, user_id):
+        """Удаление диалога из памяти"""
+        dialogue = self._dialogues.pop(user_id)
+        self._tokens -= dialogue.tokens
+        return dialogue
+
+    def _evict(self, now) -> list:
+        """Вытеснение неактивных диалогов и диалогов сверх лимитов памяти"""
+        evicted = []
+        while self._dialogues:
+            user_id, dialogue = next(iter(self._dialogues.items()))
+            if now - dialogue.updated_at > self.idle_ttl:
+                self.stats['evicted_idle'] += 1
+            elif len(self._dialogues) > self.max_users or self._tokens > self.max_total_tokens:
+                self.stats['evicted_capacity'] += 1
+            else:
+                break
+            evicted.append((user_id, self._remove(user_id)))
+        return evicted
+
+    def _spill(self, dialogues):
+        """Запись вытесненных диалогов в файл (выполняется в отдельном потоке)"""
+        rows = [
+            (user_id, json.dumps([[e.question, e.answer] for e in dialogue.exchanges], ensure_ascii=False),
+             dialogue.updated_at)
+            for user_id, dialogue in dialogues
+        ]
+        with self._conn_lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.executemany('''
+                    INSERT OR REPLACE INTO dialogues (user_id, exchanges, updated_at)
+                    VALUES (?, ?, ?)
+                ''', rows)
+                self._conn.commit()
+                self.stats['spilled'] += len(rows)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка выгрузки диалогов: {e}")
+
+    def _restore(self, user_id):
+        """Загрузка выгруженного диалога из файла (выполняется в отдельном потоке)"""
+        with self._conn_lock:
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute(
+                    'SELECT exchanges, updated_at FROM dialogues WHERE user_id = ?', (user_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                self._conn.execute('DELETE FROM dialogues WHERE user_id = ?', (user_id,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка загрузки диалога пользователя {user_id}: {e}")
+                return None
+
+        exchanges, updated_at = row
+        if time.time() - updated_at > self.spill_ttl:
+            return None
+
+        dialogue = _Dialogue(updated_at)
+        for question, answer in json.loads(exchanges):
+            exchange = _Exchange(question, answer)
+            dialogue.exchanges.append(exchange)
+            dialogue.tokens += exchange.tokens
+        self.stats['restored'] += 1
+        return dialogue
+
+    def _delete(self, user_id):
+        """Удаление выгруженного диалога из файла (выполняется в отдельном потоке)"""
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM dialogues WHERE user_id = ?', (user_id,))
+                self._conn.commit()
+
+
+# Глобальная память диалогов
+_dialogue_memory = None
+
+def init_dialogue_memory(**options) -> DialogueMemory:
+    """Инициализация глобальной памяти диалогов (без открытия файла)"""
+    global _dialogue_memory
+    _dialogue_memory = DialogueMemory(**options)
+    return _dialogue_memory
+
+def close_dialogue_memory():
+    """Выгрузка и закрытие глобальной памяти диалогов"""
+    global _dialogue_memory
+    if _dialogue_memory is not None:
+        _dialogue_memory.close()
+        _dialogue_memory = None
+
+def get_dialogue_memory() -> DialogueMemory:
+    """Получение глобальной памяти диалогов"""
+    return _dialogue_memory
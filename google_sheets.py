@@ -1,7 +1,9 @@
-import gspread
-from google.oauth2.service_account import Credentials
+import asyncio
+import json
 import os
 import logging
+import time
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -10,28 +12,75 @@ SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets.readonly'
 ]
 
+# Область доступа с правом записи (нужна для выгрузки заявок, см. sheets_export.py)
+WRITE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets'
+]
+
+# Значения по умолчанию, если в таблице нет настроек
+DEFAULT_SYSTEM_PROMPT = "Ты helpful AI-ассистент. Отвечай на русском языке кратко и по делу."
+DEFAULT_AI_PARAMS = {
+    'model': 'grok-beta',
+    'temperature': 0.7,
+    'max_tokens': 1000
+}
+
+# Пауза перед повторной загрузкой листа после ошибки (сек), дальше удваивается до REFRESH_MAX_BACKOFF
+REFRESH_BACKOFF = 5.0
+REFRESH_MAX_BACKOFF = 300.0
+
+# Колонки листов, в которых больше двух колонок (остальные читаются как A:B)
+SHEET_COLUMNS = {
+    'Меню': 'A:E'
+}
+
 class GoogleSheetsManager:
     """Менеджер для работы с Google Sheets"""
     
-    def __init__(self, credentials_file: str, spreadsheet_id: str):
+    def __init__(self, credentials_file: str, spreadsheet_id: str, settings_ttl: float = 60.0,
+                 snapshot_path: str = None, scopes: list = None):
         """
         Инициализация менеджера Google Sheets
         
         Args:
             credentials_file: Путь к JSON файлу с credentials
             spreadsheet_id: ID таблицы Google Sheets
+            settings_ttl: Время жизни кэша настроек (сек)
+            snapshot_path: Файл, в который сохраняются загруженные листы
+                для других процессов бота (см. SharedSettingsReader)
+            scopes: Области доступа (по умолчанию только чтение)
         """
         self.credentials_file = credentials_file
+        self.scopes = scopes or SCOPES
         self.spreadsheet_id = spreadsheet_id
+        self.snapshot_path = snapshot_path
         self.client = None
         self.spreadsheet = None
         
+        # Кэш листов настроек: название листа -> (строки, время загрузки)
+        self.settings_ttl = settings_ttl
+        self._settings_cache = {}
+        self._refresh_tasks = {}
+        # Лист -> (когда можно повторить загрузку, текущая пауза) после ошибки
+        self._refresh_backoff = {}
+        self.cache_stats = {
+            'hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'last_refresh_seconds': 0.0,
+            'total_refresh_seconds': 0.0
+        }
+        
     def connect(self):
         """Подключение к Google Sheets API"""
         try:
+            # gspread и google-auth импортируются долго - только когда таблица действительно нужна
+            import gspread
+            from google.oauth2.service_account import Credentials
             creds = Credentials.from_service_account_file(
                 self.credentials_file,
-                scopes=SCOPES
+                scopes=self.scopes
             )
             self.client = gspread.authorize(creds)
             self.spreadsheet = self.client.open_by_key(self.spreadsheet_id)
@@ -41,6 +90,177 @@ class GoogleSheetsManager:
             logger.error(f"Ошибка подключения к Google Sheets: {e}")
             return False
     
+    async def connect_async(self, retry_interval: float = None, max_retry_interval: float = 600.0) -> bool:
+        """
+        Подключение к Google Sheets API без блокировки event loop
+        
+        Args:
+            retry_interval: Пауза перед повтором после ошибки (сек), дальше удваивается;
+                None - без повторов
+            max_retry_interval: Максимальная пауза между повторами (сек)
+            
+        Returns:
+            True, если подключение установлено
+        """
+        while not await asyncio.to_thread(self.connect):
+            if retry_interval is None:
+                return False
+            logger.info(f"Повторное подключение к Google Sheets через {retry_interval:.0f} с")
+            await asyncio.sleep(retry_interval)
+            retry_interval = min(max_retry_interval, retry_interval * 2)
+        return True
+    
+    def _fetch_settings(self, worksheet_name: str) -> list:
+        """
+        Чтение листа настроек одним запросом к API и обновление кэша
+        
+        Args:
+            worksheet_name: Название листа в таблице
+            
+        Returns:
+            Строки листа (колонки A и B или из SHEET_COLUMNS)
+        """
+        started = time.monotonic()
+        try:
+            columns = SHEET_COLUMNS.get(worksheet_name, 'A:B')
+            response = self.spreadsheet.values_get(f"'{worksheet_name}'!{columns}")
+        except Exception:
+            self.cache_stats['refresh_errors'] += 1
+            metrics.ERRORS.inc(component='sheets')
+            metrics.SHEETS_READ_SECONDS.observe(
+                time.monotonic() - started, worksheet=worksheet_name, status='error')
+            raise
+        elapsed = time.monotonic() - started
+        metrics.SHEETS_READ_SECONDS.observe(elapsed, worksheet=worksheet_name, status='ok')
+        
+        values = response.get('values', [])
+        self._settings_cache[worksheet_name] = (values, time.monotonic())
+        if self.snapshot_path:
+            self._write_snapshot()
+        self.cache_stats['refreshes'] += 1
+        self.cache_stats['last_refresh_seconds'] = elapsed
+        self.cache_stats['total_refresh_seconds'] += elapsed
+        logger.info(f"Лист '{worksheet_name}' загружен из Google Sheets за {elapsed:.2f} с")
+        return values
+    
+    def _get_settings_values(self, worksheet_name: str) -> list:
+        """
+        Получение строк листа настроек из кэша
+        
+        Устаревшие данные отдаются сразу, а обновление запускается в фоне.
+        Если лист еще не загружен, возвращается пустой список (значения по умолчанию):
+        обработчик не ждет Google Sheets.
+        
+        Args:
+            worksheet_name: Название листа в таблице
+            
+        Returns:
+            Строки листа (колонки A и B или из SHEET_COLUMNS)
+        """
+        cached = self._settings_cache.get(worksheet_name)
+        if cached is None:
+            self.cache_stats['misses'] += 1
+            self._schedule_refresh(worksheet_name)
+            # Без event loop лист уже загружен синхронно
+            cached = self._settings_cache.get(worksheet_name)
+            return cached[0] if cached else []
+        
+        values, loaded_at = cached
+        self.cache_stats['hits'] += 1
+        if time.monotonic() - loaded_at > self.settings_ttl:
+            self._schedule_refresh(worksheet_name)
+        return values
+    
+    def get_cached_values(self, worksheet_name: str):
+        """
+        Строки листа из кэша без синхронного обращения к Google Sheets
+        
+        Args:
+            worksheet_name: Название листа в таблице
+            
+        Returns:
+            Строки листа или None, если лист еще не загружен
+        """
+        cached = self._settings_cache.get(worksheet_name)
+        if cached is None:
+            return None
+        
+        values, loaded_at = cached
+        if time.monotonic() - loaded_at > self.settings_ttl:
+            self._schedule_refresh(worksheet_name)
+        return values
+    
+    def _schedule_refresh(self, worksheet_name: str):
+        """Запуск фонового обновления листа настроек (не более одного на лист, после ошибки - с паузой)"""
+        if worksheet_name in self._refresh_tasks:
+            return
+        backoff = self._refresh_backoff.get(worksheet_name)
+        if backoff and time.monotonic() < backoff[0]:
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Нет event loop (например, скрипт stats.py) - обновляем синхронно
+            try:
+                self._fetch_settings(worksheet_name)
+            except Exception as e:
+                logger.error(f"Ошибка обновления настроек из Google Sheets: {e}")
+            return
+        
+        task = loop.create_task(self.reload_settings(worksheet_name))
+        self._refresh_tasks[worksheet_name] = task
+        task.add_done_callback(lambda done: self._refresh_done(worksheet_name, done))
+    
+    def _refresh_done(self, worksheet_name: str, task):
+        """Завершение фонового обновления: после ошибки следующая попытка - через паузу"""
+        self._refresh_tasks.pop(worksheet_name, None)
+        if not task.cancelled() and task.result():
+            self._refresh_backoff.pop(worksheet_name, None)
+            return
+        previous = self._refresh_backoff.get(worksheet_name)
+        delay = min(REFRESH_MAX_BACKOFF, previous[1] * 2) if previous else REFRESH_BACKOFF
+        self._refresh_backoff[worksheet_name] = (time.monotonic() + delay, delay)
+    
+    async def reload_settings(self, worksheet_name: str = "Настройки") -> bool:
+        """
+        Принудительная перезагрузка листа настроек без блокировки event loop
+        
+        Args:
+            worksheet_name: Название листа в таблице
+            
+        Returns:
+            True, если настройки обновлены
+        """
+        try:
+            await asyncio.to_thread(self._fetch_settings, worksheet_name)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления настроек из Google Sheets: {e}")
+            return False
+    
+    def _write_snapshot(self):
+        """Атомарная запись всех загруженных листов в файл снимка"""
+        snapshot = {name: values for name, (values, _) in self._settings_cache.items()}
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+    
+    def get_cache_stats(self) -> dict:
+        """
+        Получение счетчиков кэша настроек
+        
+        Returns:
+            Словарь с попаданиями, промахами и временем обновления
+        """
+        cache_stats = dict(self.cache_stats)
+        refreshes = cache_stats['refreshes']
+        cache_stats['avg_refresh_seconds'] = (
+            cache_stats['total_refresh_seconds'] / refreshes if refreshes else 0.0
+        )
+        return cache_stats
+    
     def get_system_prompt(self, worksheet_name: str = "Настройки") -> str:
         """
         Получение системного промпта из таблицы
@@ -52,22 +272,24 @@ class GoogleSheetsManager:
             Текст системного промпта
         """
         try:
-            worksheet = self.spreadsheet.worksheet(worksheet_name)
+            values = self._get_settings_values(worksheet_name)
+            if not values:
+                # Лист еще не загружен - это не ошибка настройки
+                return DEFAULT_SYSTEM_PROMPT
             
-            # Ожидается, что промпт находится в ячейке B2
+            # Ожидается, что промпт находится в ячейке B1
             # A1: "System Prompt", B1: значение
-            prompt = worksheet.acell('B1').value
+            prompt = values[0][1] if values and len(values[0]) >= 2 else None
             
             if prompt:
-                logger.info("Системный промпт успешно загружен из Google Sheets")
                 return prompt
             else:
                 logger.warning("Промпт пуст, используется значение по умолчанию")
-                return "Ты helpful AI-ассистент. Отвечай на русском языке кратко и по делу."
+                return DEFAULT_SYSTEM_PROMPT
                 
         except Exception as e:
             logger.error(f"Ошибка при чтении промпта из Google Sheets: {e}")
-            return "Ты helpful AI-ассистент. Отвечай на русском языке кратко и по делу."
+            return DEFAULT_SYSTEM_PROMPT
     
     def get_bot_settings(self, worksheet_name: str = "Настройки") -> dict:
         """
@@ -80,18 +302,14 @@ class GoogleSheetsManager:
             Словарь с настройками
         """
         try:
-            worksheet = self.spreadsheet.worksheet(worksheet_name)
-            
-            # Читаем все данные из первых двух колонок
             # Формат: A - название параметра, B - значение
-            values = worksheet.get_all_values()
+            values = self._get_settings_values(worksheet_name)
             
             settings = {}
             for row in values:
                 if len(row) >= 2 and row[0] and row[1]:
                     settings[row[0]] = row[1]
             
-            logger.info(f"Загружено настроек из Google Sheets: {len(settings)}")
             return settings
             
         except Exception as e:
@@ -111,13 +329,6 @@ class GoogleSheetsManager:
         try:
             settings = self.get_bot_settings(worksheet_name)
             
-            # Параметры по умолчанию
-            default_params = {
-                'model': 'grok-beta',
-                'temperature': 0.7,
-                'max_tokens': 1000
-            }
-            
             # Обновляем параметры из таблицы, если они есть
             ai_params = {}
             if 'AI_Model' in settings:
@@ -134,28 +345,123 @@ class GoogleSheetsManager:
                     pass
             
             # Объединяем с defaults
-            return {**default_params, **ai_params}
+            return {**DEFAULT_AI_PARAMS, **ai_params}
             
         except Exception as e:
             logger.error(f"Ошибка при чтении параметров AI: {e}")
-            return {
-                'model': 'grok-beta',
-                'temperature': 0.7,
-                'max_tokens': 1000
-            }
+            return dict(DEFAULT_AI_PARAMS)
+
+
+class SharedSettingsReader(GoogleSheetsManager):
+    """
+    Настройки из файла снимка, который пишет GoogleSheetsManager другого процесса
+    
+    Используется рабочими процессами кластера: к Google Sheets обращается
+    только главный процесс, а рабочие читают общий снимок.
+    """
+    
+    def __init__(self, snapshot_path: str, check_interval: float = 1.0):
+        """
+        Инициализация чтения снимка настроек
+        
+        Args:
+            snapshot_path: Путь к файлу снимка
+            check_interval: Как часто проверять, обновился ли файл (сек)
+        """
+        super().__init__('', '', settings_ttl=check_interval)
+        self.reader_path = snapshot_path
+        self._snapshot = {}
+        self._snapshot_mtime = None
+        self._checked_at = 0.0
+    
+    def connect(self):
+        """Подключение к Google Sheets не требуется - читаем снимок"""
+        try:
+            self._load_snapshot()
+        except (OSError, ValueError) as e:
+            # Снимок появится, когда главный процесс загрузит настройки
+            logger.warning(f"Снимок настроек пока недоступен: {e}")
+        return True
+    
+    def _load_snapshot(self):
+        """Перечитывание файла снимка, если он изменился"""
+        self._checked_at = time.monotonic()
+        mtime = os.path.getmtime(self.reader_path)
+        if mtime == self._snapshot_mtime:
+            return
+        
+        started = time.monotonic()
+        with open(self.reader_path, encoding='utf-8') as f:
+            self._snapshot = json.load(f)
+        self._snapshot_mtime = mtime
+        elapsed = time.monotonic() - started
+        self.cache_stats['refreshes'] += 1
+        self.cache_stats['last_refresh_seconds'] = elapsed
+        self.cache_stats['total_refresh_seconds'] += elapsed
+    
+    def _check_snapshot(self):
+        """Проверка обновления снимка не чаще check_interval"""
+        if time.monotonic() - self._checked_at > self.settings_ttl:
+            try:
+                self._load_snapshot()
+            except FileNotFoundError:
+                # Главный процесс еще не загрузил настройки
+                pass
+            except (OSError, ValueError) as e:
+                self.cache_stats['refresh_errors'] += 1
+                logger.error(f"Ошибка чтения снимка настроек {self.reader_path}: {e}")
+    
+    def _get_settings_values(self, worksheet_name: str) -> list:
+        """Строки листа из снимка; пока главный процесс его не записал - пусто (значения по умолчанию)"""
+        self._check_snapshot()
+        if worksheet_name not in self._snapshot:
+            self.cache_stats['misses'] += 1
+            return []
+        self.cache_stats['hits'] += 1
+        return self._snapshot[worksheet_name]
+    
+    def get_cached_values(self, worksheet_name: str):
+        """Строки листа из снимка или None, если листа в снимке нет"""
+        self._check_snapshot()
+        return self._snapshot.get(worksheet_name)
+    
+    async def reload_settings(self, worksheet_name: str = "Настройки") -> bool:
+        """Перечитывание снимка (сам снимок обновляет главный процесс)"""
+        try:
+            self._snapshot_mtime = None
+            await asyncio.to_thread(self._load_snapshot)
+            return True
+        except (OSError, ValueError) as e:
+            self.cache_stats['refresh_errors'] += 1
+            logger.error(f"Ошибка чтения снимка настроек {self.reader_path}: {e}")
+            return False
 
 
 # Глобальный экземпляр менеджера
 _sheets_manager = None
 
-def init_sheets_manager(credentials_file: str, spreadsheet_id: str) -> GoogleSheetsManager:
+def init_sheets_manager(credentials_file: str, spreadsheet_id: str, settings_ttl: float = 60.0,
+                        snapshot_path: str = None, scopes: list = None) -> GoogleSheetsManager:
     """Инициализация глобального менеджера Google Sheets"""
     global _sheets_manager
-    _sheets_manager = GoogleSheetsManager(credentials_file, spreadsheet_id)
+    _sheets_manager = GoogleSheetsManager(credentials_file, spreadsheet_id, settings_ttl, snapshot_path, scopes)
     if _sheets_manager.connect():
         return _sheets_manager
     return None
 
+def init_shared_settings_reader(snapshot_path: str) -> GoogleSheetsManager:
+    """Инициализация глобального менеджера, читающего общий снимок настроек"""
+    global _sheets_manager
+    _sheets_manager = SharedSettingsReader(snapshot_path)
+    if _sheets_manager.connect():
+        return _sheets_manager
+    return None
+
+def set_sheets_manager(sheets_manager: GoogleSheetsManager):
+    """Назначение глобального менеджера (например, после подключения в фоне)"""
+    global _sheets_manager
+    _sheets_manager = sheets_manager
+
 def get_sheets_manager() -> GoogleSheetsManager:
     """Получение глобального менеджера Google Sheets"""
     return _sheets_manager
@@ -0,0 +1,502 @@
+import asyncio
+import contextlib
+import importlib.util
+import itertools
+import json
+import logging
+import random
+import time
+from collections import deque
+import httpx
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Адрес Grok API
+GROK_API_URL = "https://api.x.ai/v1/chat/completions"
+
+# Ошибки соединения, после которых запрос безопасно повторить: он не дошел до модели
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+# Сколько последних успешных запросов учитывается в p95 для дублирующих запросов
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """Код ответа, после которого запрос можно повторить (перегрузка или сбой Grok)"""
+    return status_code == 429 or status_code >= 500
+
+
+def parse_retry_after(value) -> float:
+    """Задержка из заголовка Retry-After в секундах (None, если не число)"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class GrokAPIError(Exception):
+    """Ошибка ответа Grok API (код ответа не 200)"""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"Grok API error: {status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class GrokCircuitOpen(GrokAPIError):
+    """Запрос не отправлен: выключатель открыт после серии ошибок Grok API"""
+
+    def __init__(self, retry_in: float):
+        super().__init__(503, f"circuit open, retry in {retry_in:.0f} s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель: после серии ошибок запросы сразу отклоняются,
+    через recovery_time один пробный запрос проверяет, восстановился ли сервис
+    """
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    # Значения для метрики состояния
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold: int = 5, recovery_time: float = 30.0):
+        """
+        Инициализация выключателя
+
+        Args:
+            failure_threshold: Сколько ошибок подряд открывают выключатель (0 - выключен)
+            recovery_time: Через сколько секунд пропустить пробный запрос
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started = None
+        self.stats = {'opened': 0, 'rejected': 0}
+        metrics.GROK_CIRCUIT_STATE.set(0)
+
+    def _set_state(self, state: str):
+        """Переход в новое состояние"""
+        if state != self.state:
+            logger.warning(f"Grok: выключатель {self.state} -> {state}")
+            self.state = state
+            metrics.GROK_CIRCUIT_STATE.set(self.STATE_VALUES[state])
+
+    @property
+    def is_open(self) -> bool:
+        """Запросы сейчас отклоняются"""
+        return self.state == self.OPEN
+
+    def retry_in(self) -> float:
+        """Через сколько секунд будет пробный запрос"""
+        return max(0.0, self.opened_at + self.recovery_time - time.monotonic())
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now < self.opened_at + self.recovery_time:
+                self.stats['rejected'] += 1
+                return False
+            self._set_state(self.HALF_OPEN)
+        # Полуоткрыт: один пробный запрос; если он пропал без результата (отменен),
+        # через recovery_time пропускаем следующий
+        if self._probe_started is None or now - self._probe_started > self.recovery_time:
+            self._probe_started = now
+            return True
+        self.stats['rejected'] += 1
+        return False
+
+    def record_success(self):
+        """Сервис ответил"""
+        self.failures = 0
+        self._probe_started = None
+        self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        """Ошибка сервиса"""
+        self.failures += 1
+        self._probe_started = None
+        if self.state == self.HALF_OPEN or (
+                self.failure_threshold and self.failures >= self.failure_threshold):
+            if self.state != self.OPEN:
+                self.stats['opened'] += 1
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+
+class GrokClient:
+    """Клиент Grok API с постоянным пулом соединений"""
+
+    def __init__(self, api_key: str, max_connections: int = 20,
+                 max_keepalive_connections: int = 10, keepalive_expiry: float = 30.0,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 write_timeout: float = 10.0, pool_timeout: float = 5.0,
+                 http2: bool = False, max_retries: int = 2, retry_base: float = 0.5,
+                 retry_max_delay: float = 5.0, hedge: bool = False, hedge_min_delay: float = 1.0,
+                 breaker_threshold: int = 5, breaker_recovery: float = 30.0):
+        """
+        Инициализация клиента Grok
+
+        Args:
+            api_key: API ключ x.ai
+            max_connections: Максимум одновременных соединений в пуле
+            max_keepalive_connections: Максимум простаивающих keep-alive соединений
+            keepalive_expiry: Сколько секунд держать простаивающее соединение
+            connect_timeout: Таймаут установки соединения (сек)
+            read_timeout: Таймаут чтения ответа (сек)
+            write_timeout: Таймаут отправки запроса (сек)
+            pool_timeout: Таймаут ожидания свободного соединения в пуле (сек)
+            http2: Использовать HTTP/2 (нужен пакет h2)
+            max_retries: Сколько раз повторять запрос после 429/5xx или ошибки соединения
+            retry_base: Базовая задержка повтора (сек), удваивается с каждой попыткой
+            retry_max_delay: Максимальная задержка повтора (сек); если Retry-After
+                больше, запрос не повторяется
+            hedge: Отправлять дублирующий запрос, если ответа нет дольше p95
+            hedge_min_delay: Минимальная задержка дублирующего запроса (сек)
+            breaker_threshold: Сколько ошибок подряд открывают выключатель (0 - выключен)
+            breaker_recovery: Через сколько секунд после открытия пробовать снова
+        """
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=write_timeout,
+            pool=pool_timeout
+        )
+
+        # HTTP/2 включаем только если установлен h2, иначе httpx упадет при создании клиента
+        if http2 and importlib.util.find_spec('h2') is None:
+            logger.warning("HTTP/2 запрошен, но пакет h2 не установлен - используется HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max_delay = retry_max_delay
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_recovery)
+        # Длительность последних успешных запросов для оценки p95
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+
+        self.client = None
+
+        # Счетчики использования пула
+        self.stats = {
+            'requests': 0,
+            'in_flight': 0,
+            'peak_in_flight': 0,
+            'errors': 0,
+            'pool_timeouts': 0,
+            'retries': 0,
+            'hedged': 0,
+            'hedge_wins': 0
+        }
+
+    def start(self):
+        """Создание HTTP клиента (один на все время жизни приложения)"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=self.http2,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {self.api_key}"
+                }
+            )
+            logger.info(
+                f"Grok клиент создан: пул {self.limits.max_connections} соединений, "
+                f"HTTP/2 {'включен' if self.http2 else 'выключен'}"
+            )
+
+    async def close(self):
+        """Закрытие HTTP клиента и всех соединений пула"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("Grok клиент закрыт")
+
+    async def chat_completion(self, payload: dict) -> httpx.Response:
+        """
+        Отправка запроса к chat completions
+
+        Args:
+            payload: Тело запроса (messages, model, temperature и т.д.)
+
+        Returns:
+            Ответ Grok API
+        """
+        if self.client is None:
+            self.start()
+        self._check_breaker()
+
+        for attempt in itertools.count():
+            try:
+                response = await self._send_hedged(payload)
+            except httpx.TransportError as e:
+                delay = self._after_error(attempt, e)
+                if delay is None:
+                    raise
+                reason = type(e).__name__
+            else:
+                delay = self._after_response(attempt, response)
+                if delay is None:
+                    return response
+                reason = str(response.status_code)
+            await self._sleep_before_retry(delay, reason)
+
+    async def _post(self, payload: dict) -> httpx.Response:
+        """Одна попытка запроса chat completions"""
+        with self._track_request('complete') as call:
+            response = await self.client.post(GROK_API_URL, json=payload)
+            call['status'] = str(response.status_code)
+        if response.status_code == 200:
+            self._latencies.append(call['seconds'])
+        return response
+
+    def hedge_delay(self) -> float:
+        """Через сколько секунд отправить дублирующий запрос (None - не отправлять)"""
+        if (not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES
+                or self.breaker.state != CircuitBreaker.CLOSED):
+            return None
+        ordered = sorted(self._latencies)
+        return max(self.hedge_min_delay, ordered[int(0.95 * (len(ordered) - 1))])
+
+    async def _send_hedged(self, payload: dict) -> httpx.Response:
+        """
+        Запрос с дублированием: если ответа нет дольше p95, отправляется второй запрос
+        и используется первый успешный ответ, другой отменяется
+        """
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._post(payload)
+
+        primary = asyncio.ensure_future(self._post(payload))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+            self.stats['hedged'] += 1
+            hedge = asyncio.ensure_future(self._post(payload))
+            pending.add(hedge)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code == 200:
+                        break
+                else:
+                    continue
+                break
+            if task is hedge:
+                self.stats['hedge_wins'] += 1
+            metrics.GROK_HEDGED.inc(winner='hedge' if task is hedge else 'primary')
+            # Первый успешный ответ, а если оба запроса неудачны - результат последнего
+            return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _check_breaker(self):
+        """Отказ без запроса, если выключатель открыт"""
+        if not self.breaker.allow():
+            metrics.GROK_CIRCUIT_REJECTED.inc()
+            raise GrokCircuitOpen(self.breaker.retry_in())
+
+    def _backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка со случайным разбросом (full jitter)"""
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base * 2 ** attempt))
+
+    def _after_response(self, attempt: int, response: httpx.Response) -> float:
+        """
+        Учет ответа в выключателе и решение о повторе
+
+        Returns:
+            Задержка перед повтором или None, если ответ окончательный
+        """
+        if not is_retryable_status(response.status_code):
+            # Ошибки 4xx (кроме 429) означают, что сервис работает
+            self.breaker.record_success()
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.max_retries or self.breaker.is_open:
+            return None
+        delay = self._backoff(attempt)
+        retry_after = parse_retry_after(response.headers.get('retry-after'))
+        if retry_after is not None:
+            if retry_after > self.retry_max_delay:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def _after_error(self, attempt: int, error: Exception) -> float:
+        """
+        Учет ошибки соединения в выключателе и решение о повторе
+
+        Returns:
+            Задержка перед повтором или None, если ошибку нужно пробросить
+        """
+        if isinstance(error, httpx.PoolTimeout):
+            # Нет свободного соединения в своем пуле - Grok тут ни при чем
+            return None
+        self.breaker.record_failure()
+        if (not isinstance(error, RETRYABLE_ERRORS) or attempt >= self.max_retries
+                or self.breaker.is_open):
+            return None
+        return self._backoff(attempt)
+
+    async def _sleep_before_retry(self, delay: float, reason: str):
+        """Ожидание перед повтором с учетом в метриках"""
+        self.stats['retries'] += 1
+        metrics.GROK_RETRIES.inc(reason=reason)
+        logger.warning(f"Grok: повтор запроса через {delay:.2f} с ({reason})")
+        await asyncio.sleep(delay)
+
+    async def stream_chat_completion(self, payload: dict):
+        """
+        Потоковый запрос к chat completions (SSE)
+
+        Args:
+            payload: Тело запроса (messages, model, temperature и т.д.)
+
+        Yields:
+            Фрагменты текста ответа по мере генерации
+        """
+        if self.client is None:
+            self.start()
+        self._check_breaker()
+
+        # Повтор возможен, только пока пользователю ничего не отдано;
+        # дублирующие запросы для потока не отправляются
+        for attempt in itertools.count():
+            yielded = False
+            delay = None
+            try:
+                with self._track_request('stream') as call:
+                    async with self.client.stream("POST", GROK_API_URL, json={**payload, "stream": True}) as response:
+                        call['status'] = str(response.status_code)
+                        delay = self._after_response(attempt, response)
+                        if response.status_code != 200:
+                            body = await response.aread()
+                            if delay is None:
+                                raise GrokAPIError(response.status_code, body.decode('utf-8', errors='replace'))
+                        else:
+                            # Формат SSE: строки "data: {...}", поток завершается "data: [DONE]"
+                            async for line in response.aiter_lines():
+                                if not line.startswith('data:'):
+                                    continue
+                                data = line[len('data:'):].strip()
+                                if data == '[DONE]':
+                                    break
+                                choices = json.loads(data).get('choices') or []
+                                if choices:
+                                    content = (choices[0].get('delta') or {}).get('content')
+                                    if content:
+                                        yielded = True
+                                        yield content
+            except httpx.TransportError as e:
+                if yielded:
+                    raise
+                delay = self._after_error(attempt, e)
+                if delay is None:
+                    raise
+                await self._sleep_before_retry(delay, type(e).__name__)
+                continue
+
+            if delay is None:
+                return
+            await self._sleep_before_retry(delay, str(response.status_code))
+
+    @contextlib.contextmanager
+    def _track_request(self, mode: str):
+        """Учет запроса в счетчиках пула и метриках; в call['status'] записывается код ответа"""
+        self.stats['requests'] += 1
+        self.stats['in_flight'] += 1
+        self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], self.stats['in_flight'])
+        metrics.GROK_IN_FLIGHT.inc()
+        call = {'status': 'error'}
+        started = time.perf_counter()
+        try:
+            yield call
+        except asyncio.CancelledError:
+            # Проигравший дублирующий запрос или отмена обработчика - не ошибка Grok
+            call['status'] = 'cancelled'
+            raise
+        except httpx.PoolTimeout:
+            self.stats['pool_timeouts'] += 1
+            self.stats['errors'] += 1
+            call['status'] = 'pool_timeout'
+            metrics.ERRORS.inc(component='grok')
+            raise
+        except Exception:
+            self.stats['errors'] += 1
+            metrics.ERRORS.inc(component='grok')
+            raise
+        finally:
+            self.stats['in_flight'] -= 1
+            metrics.GROK_IN_FLIGHT.dec()
+            call['seconds'] = time.perf_counter() - started
+            metrics.GROK_REQUEST_SECONDS.observe(call['seconds'], mode=mode, status=call['status'])
+
+    def get_pool_stats(self) -> dict:
+        """
+        Получение счетчиков использования пула
+
+        Returns:
+            Словарь со счетчиками запросов и соединений
+        """
+        pool_stats = dict(self.stats)
+        pool_stats['max_connections'] = self.limits.max_connections
+        pool_stats['breaker_state'] = self.breaker.state
+        pool_stats['breaker_opened'] = self.breaker.stats['opened']
+        pool_stats['breaker_rejected'] = self.breaker.stats['rejected']
+        pool_stats['hedge_delay'] = self.hedge_delay()
+
+        # Состояние соединений берем из транспорта httpx, если он его отдает
+        connections = []
+        if self.client is not None:
+            pool = getattr(self.client._transport, '_pool', None)
+            connections = list(getattr(pool, 'connections', []))
+        pool_stats['open_connections'] = len(connections)
+        pool_stats['idle_connections'] = sum(1 for conn in connections if conn.is_idle())
+
+        return pool_stats
+
+
+# Глобальный экземпляр клиента
+_grok_client = None
+
+def init_grok_client(api_key: str, **options) -> GrokClient:
+    """Инициализация глобального клиента Grok"""
+    global _grok_client
+    _grok_client = GrokClient(api_key, **options)
+    _grok_client.start()
+    return _grok_client
+
+async def close_grok_client():
+    """Закрытие глобального клиента Grok"""
+    global _grok_client
+    if _grok_client is not None:
+        await _grok_client.close()
+        _grok_client = None
+
+def get_grok_client() -> GrokClient:
+    """Получение глобального клиента Grok"""
+    return _grok_client
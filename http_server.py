@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Тексты статусов, которые отдает сервер
+STATUS_TEXTS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable'
+}
+
+
+class Request:
+    """Входящий HTTP запрос"""
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method: str, path: str, query: dict, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Тело запроса как JSON"""
+        return json.loads(self.body)
+
+
+class Response:
+    """Ответ HTTP сервера"""
+    __slots__ = ('status', 'body', 'content_type', 'headers')
+
+    def __init__(self, status: int = 200, body: bytes = b'',
+                 content_type: str = 'text/plain; charset=utf-8', headers: dict = None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data, status: int = 200) -> 'Response':
+        """Ответ с JSON телом"""
+        return cls(status, json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    @classmethod
+    def text(cls, text: str, status: int = 200) -> 'Response':
+        """Ответ с текстовым телом"""
+        return cls(status, text.encode('utf-8'))
+
+
+class HTTPServer:
+    """Минимальный асинхронный HTTP/1.1 сервер на asyncio с keep-alive"""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = 8080,
+                 max_body_size: int = 1024 * 1024, idle_timeout: float = 60.0):
+        """
+        Инициализация HTTP сервера
+
+        Args:
+            host: Адрес для прослушивания
+            port: Порт для прослушивания (0 - выбрать свободный)
+            max_body_size: Максимальный размер тела запроса (байт)
+            idle_timeout: Сколько секунд держать простаивающее соединение
+        """
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.idle_timeout = idle_timeout
+        self._routes = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler):
+        """
+        Регистрация обработчика
+
+        Args:
+            method: HTTP метод (GET, POST)
+            path: Путь запроса
+            handler: async функция (Request) -> Response
+        """
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        """Запуск сервера"""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обработка запросов одного соединения, пока клиент держит keep-alive"""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError as e:
+                    await self._write_response(writer, Response.text(str(e), 400), keep_alive=False)
+                    break
+                if request is None:
+                    break
+
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """Чтение одного запроса; None - клиент закрыл соединение"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ValueError("Malformed request line")
+        method, target, _ = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', '0') or 0)
+        if length > self.max_body_size:
+            raise ValueError("Request body too large")
+        body = await reader.readexactly(length) if length else b''
+
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return Request(method.upper(), url.path, query, headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        """Вызов обработчика маршрута"""
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response.text('Method Not Allowed', 405)
+            return Response.text('Not Found', 404)
+
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Ошибка обработки HTTP запроса {request.method} {request.path}: {e}")
+            return Response.text('Internal Server Error', 500)
+
+    async def _write_response(self, writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+        """Отправка ответа клиенту"""
+        status_text = STATUS_TEXTS.get(response.status, 'Unknown')
+        head = [
+            f"HTTP/1.1 {response.status} {status_text}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"
+        ]
+        head.extend(f"{name}: {value}" for name, value in response.headers.items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+        await writer.drain()
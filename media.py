@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import logging
+import os
+from telegram import Message
+from telegram.error import BadRequest
+import database
+
+logger = logging.getLogger(__name__)
+
+# Способ отправки медиа по типу: метод Message и извлечение file_id из ответа
+MEDIA_KINDS = {
+    'photo': ('reply_photo', lambda message: message.photo[-1].file_id),
+    'document': ('reply_document', lambda message: message.document.file_id),
+    'video': ('reply_video', lambda message: message.video.file_id),
+    'animation': ('reply_animation', lambda message: message.animation.file_id)
+}
+
+
+def _read_file(path: str):
+    """Содержимое файла и его SHA-256"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+class MediaRegistry:
+    """Реестр загруженных в Telegram файлов: каждый файл загружается один раз"""
+
+    def __init__(self):
+        # path -> (mtime, размер, хэш содержимого, file_id)
+        self._entries = {}
+        self._locks = {}
+        self.stats = {
+            'cached': 0,
+            'uploads': 0,
+            'rejected': 0
+        }
+
+    async def reply(self, message: Message, path: str, kind: str = 'photo', **kwargs) -> Message:
+        """
+        Отправка медиафайла в ответ на сообщение
+
+        Повторные отправки используют сохраненный file_id без чтения файла.
+        Если файл изменился или Telegram не принял file_id, файл загружается заново.
+
+        Args:
+            message: Сообщение, на которое отвечаем
+            path: Путь к файлу
+            kind: Тип медиа (photo, document, video, animation)
+            **kwargs: Параметры отправки (caption, parse_mode, reply_markup)
+
+        Returns:
+            Отправленное сообщение
+
+        Raises:
+            FileNotFoundError: Файл отсутствует
+        """
+        method, _ = MEDIA_KINDS[kind]
+        stat = await asyncio.to_thread(os.stat, path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._entries.get(path)
+        if entry is None or entry[:2] != version:
+            # Файл еще не отправляли или он изменился - ищем file_id по содержимому
+            async with self._locks.setdefault(path, asyncio.Lock()):
+                entry = self._entries.get(path)
+                if entry is None or entry[:2] != version:
+                    return await self._upload(message, path, kind, version, **kwargs)
+
+        try:
+            sent = await getattr(message, method)(entry[3], **kwargs)
+        except BadRequest as e:
+            # Ошибки разметки подписи к file_id отношения не имеют
+            if 'file' not in str(e).lower():
+                raise
+            logger.warning(f"Telegram не принял file_id для {path}: {e}")
+            self.stats['rejected'] += 1
+            self._entries.pop(path, None)
+            await database.delete_media_file_id_async(path)
+            return await self._upload(message, path, kind, version, **kwargs)
+
+        self.stats['cached'] += 1
+        return sent
+
+    async def _upload(self, message, path, kind, version, **kwargs) -> Message:
+        """Отправка по file_id из БД или загрузка файла в Telegram"""
+        method, extract_file_id = MEDIA_KINDS[kind]
+        data, content_hash = await asyncio.to_thread(_read_file, path)
+
+        file_id = await database.get_media_file_id_async(path, content_hash)
+        if file_id is not None:
+            try:
+                sent = await getattr(message, method)(file_id, **kwargs)
+                self._entries[path] = (*version, content_hash, file_id)
+                self.stats['cached'] += 1
+                return sent
+            except BadRequest as e:
+                if 'file' not in str(e).lower():
+                    raise
+                logger.warning(f"Telegram не принял сохраненный file_id для {path}: {e}")
+                self.stats['rejected'] += 1
+
+        sent = await getattr(message, method)(data, filename=os.path.basename(path), **kwargs)
+        file_id = extract_file_id(sent)
+        self._entries[path] = (*version, content_hash, file_id)
+        await database.save_media_file_id_async(path, content_hash, file_id)
+        self.stats['uploads'] += 1
+        logger.info(f"Файл {path} загружен в Telegram")
+        return sent
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков реестра медиа
+
+        Returns:
+            Словарь с количеством отправок по file_id, загрузок и отклоненных file_id
+        """
+        media_stats = dict(self.stats)
+        media_stats['files'] = len(self._entries)
+        return media_stats
+
+
+# Глобальный реестр медиафайлов
+_media_registry = MediaRegistry()
+
+def get_media_registry() -> MediaRegistry:
+    """Получение глобального реестра медиафайлов"""
+    return _media_registry
@@ -0,0 +1,190 @@
+import logging
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+import google_sheets
+
+logger = logging.getLogger(__name__)
+
+# Лист с кнопками меню. Колонки: A - текст кнопки, B - ответ (Markdown),
+# C - клавиатура после ответа, D - тип действия для статистики, E - путь к фото
+MENU_WORKSHEET = "Меню"
+
+# Строка листа, задающая клавиатуру, начинается с @, например "@главное"
+KEYBOARD_PREFIX = '@'
+MAIN_KEYBOARD = 'главное'
+
+# Меню по умолчанию, если лист "Меню" не заполнен или Google Sheets недоступен
+DEFAULT_MENU_ROWS = [
+    ['@главное', '', 'О нас | Кейсы\n👤 Руководитель | 📞 Номер телефона'],
+    [
+        'О нас',
+        "📌 *О нас*\n\n"
+        "Мы - команда профессионалов, которая занимается разработкой "
+        "инновационных решений для вашего бизнеса.\n\n"
+        "Наша миссия - делать мир лучше с помощью технологий!",
+        '',
+        'button_about'
+    ],
+    [
+        'Кейсы',
+        "💼 *Наши кейсы*\n\n"
+        "1 Разработка мобильного приложения для доставки\n"
+        "2 Создание CRM-системы для автоматизации продаж\n"
+        "3 Внедрение AI-чатбота для службы поддержки\n\n"
+        "Более 100 успешных проектов реализовано!\n\n"
+        "🎁 *Хотите получить наш продукт?*\n"
+        "Оставьте заявку, и мы свяжемся с вами!",
+        '📞 Оставить заявку\n⬅️ Назад в меню',
+        'button_cases'
+    ],
+    [
+        '👤 Руководитель',
+        "👤 *Наш руководитель*\n\n"
+        "*Иван Иванов*\n"
+        "Генеральный директор\n\n"
+        "• 15+ лет опыта в IT-индустрии\n"
+        "• Управляет командой из 50+ специалистов\n"
+        "• Реализовал более 200 успешных проектов\n\n"
+        "_\"Наша цель - создавать решения, которые меняют бизнес к лучшему!\"_",
+        '',
+        'button_director',
+        'director.jpg'
+    ],
+    [
+        '📞 Номер телефона',
+        "📞 *Наш контактный номер телефона:*\n\n"
+        "`88005553535351312`\n\n"
+        "Звоните в любое время! Мы работаем 24/7 🕐",
+        '',
+        'button_phone'
+    ],
+    ['⬅️ Назад в меню', 'Главное меню:', '@главное']
+]
+
+
+class MenuItem(NamedTuple):
+    """Ответ на нажатие кнопки"""
+    text: str
+    reply: str
+    reply_markup: Optional[ReplyKeyboardMarkup]
+    action: Optional[str]
+    photo: Optional[str]
+
+
+class Menu:
+    """Скомпилированное меню: поиск ответа по тексту кнопки и готовые клавиатуры"""
+    __slots__ = ('items', 'keyboards', 'source')
+
+    def __init__(self, items: dict, keyboards: dict, source):
+        self.items = MappingProxyType(items)
+        self.keyboards = MappingProxyType(keyboards)
+        # Строки листа, из которых собрано меню (для проверки, изменился ли лист)
+        self.source = source
+
+    def lookup(self, text: str) -> Optional[MenuItem]:
+        """Ответ на кнопку или None, если текст - не кнопка меню"""
+        return self.items.get(text)
+
+    @property
+    def main_keyboard(self) -> ReplyKeyboardMarkup:
+        """Клавиатура главного меню"""
+        return self.keyboards[MAIN_KEYBOARD]
+
+
+def _cell(row: list, index: int) -> str:
+    """Значение ячейки строки (в конце строк Sheets API пустые ячейки не возвращает)"""
+    return row[index].strip() if len(row) > index else ''
+
+
+def _build_keyboard(layout: str) -> Optional[ReplyKeyboardMarkup]:
+    """Клавиатура из описания: ряды кнопок на отдельных строках, кнопки разделены |"""
+    keyboard = [
+        [KeyboardButton(button.strip()) for button in line.split('|') if button.strip()]
+        for line in layout.splitlines() if line.strip()
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True) if keyboard else None
+
+
+def compile_menu(rows: list, defaults: Menu = None) -> Menu:
+    """
+    Компиляция строк листа "Меню" в таблицу ответов
+
+    Args:
+        rows: Строки листа (колонки A-E)
+        defaults: Меню, клавиатуры которого используются, если лист их не задает
+
+    Returns:
+        Неизменяемое меню с готовыми объектами клавиатур
+    """
+    keyboards = dict(defaults.keyboards) if defaults else {}
+    entries = []
+    for row in rows:
+        text = _cell(row, 0)
+        if not text or text == 'Кнопка':
+            # Пустые строки и заголовок таблицы
+            continue
+        if text.startswith(KEYBOARD_PREFIX):
+            keyboard = _build_keyboard(_cell(row, 2))
+            if keyboard is not None:
+                keyboards[text[len(KEYBOARD_PREFIX):]] = keyboard
+            continue
+        entries.append(row)
+
+    if MAIN_KEYBOARD not in keyboards:
+        raise ValueError(f"В меню нет клавиатуры {KEYBOARD_PREFIX}{MAIN_KEYBOARD}")
+
+    items = {}
+    for row in entries:
+        text = _cell(row, 0)
+        layout = _cell(row, 2)
+        if layout.startswith(KEYBOARD_PREFIX):
+            reply_markup = keyboards.get(layout[len(KEYBOARD_PREFIX):])
+            if reply_markup is None:
+                logger.warning(f"Меню: кнопка '{text}' ссылается на неизвестную клавиатуру {layout}")
+        else:
+            reply_markup = _build_keyboard(layout)
+        items[text] = MenuItem(
+            text=text,
+            reply=_cell(row, 1),
+            reply_markup=reply_markup,
+            action=_cell(row, 3) or None,
+            photo=_cell(row, 4) or None
+        )
+    return Menu(items, keyboards, rows)
+
+
+# Меню по умолчанию и текущее меню
+_default_menu = compile_menu(DEFAULT_MENU_ROWS)
+_menu = _default_menu
+# Строки листа, которые не удалось скомпилировать (чтобы не повторять попытку)
+_rejected_source = None
+
+def get_menu() -> Menu:
+    """
+    Получение текущего меню
+
+    Если лист "Меню" в кэше Google Sheets изменился, меню компилируется заново.
+    Обращений к Google Sheets при этом не происходит: лист загружается при запуске,
+    по /reload и в фоне по истечении SHEETS_SETTINGS_TTL.
+    """
+    global _menu, _rejected_source
+    sheets_manager = google_sheets.get_sheets_manager()
+    if not sheets_manager:
+        return _menu
+
+    rows = sheets_manager.get_cached_values(MENU_WORKSHEET)
+    if not rows:
+        # Лист не создан или пуст
+        _menu = _default_menu
+        return _menu
+    if rows is _menu.source or rows is _rejected_source:
+        return _menu
+
+    try:
+        _menu = compile_menu(rows, _default_menu)
+        logger.info(f"Меню скомпилировано: кнопок {len(_menu.items)}, клавиатур {len(_menu.keyboards)}")
+    except Exception as e:
+        _rejected_source = rows
+        logger.error(f"Ошибка в листе '{MENU_WORKSHEET}', используется прежнее меню: {e}")
+    return _menu
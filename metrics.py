@@ -0,0 +1,317 @@
+import contextlib
+import functools
+import logging
+import threading
+import time
+from telegram.request import HTTPXRequest
+from http_server import HTTPServer, Response
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек (сек)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Квантили для /perf
+QUANTILES = (0.5, 0.95, 0.99)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    """Экранирование значения метки для текстового формата Prometheus"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    """Метки в формате {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """Общая часть метрик: имя, описание и значения по наборам меток"""
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        """Значения меток в порядке labelnames"""
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> list:
+        """Строки метрики в текстовом формате Prometheus"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    """Счетчик, который только растет"""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Увеличение счетчика"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение (например, количество запросов в работе)"""
+    kind = 'gauge'
+
+    def inc(self, amount: float = 1, **labels):
+        """Увеличение значения"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """Уменьшение значения"""
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        """Установка значения"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        """Текущее значение"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    @contextlib.contextmanager
+    def track_inprogress(self, **labels):
+        """Учет операции, пока выполняется блок"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Гистограмма задержек с корзинами Prometheus и оценкой квантилей"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """Учет одного измерения"""
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # [количество по корзинам (последняя - +Inf), сумма, количество, максимум]
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+                self._values[key] = series
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+            series[3] = max(series[3], value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Измерение длительности блока; при исключении метка status = error"""
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            if 'status' in self.labelnames:
+                labels['status'] = status
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _quantile(self, q: float, counts: list, total: int, maximum: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return min(lower + (bound - lower) * (rank - cumulative) / count, maximum)
+            cumulative += count
+            lower = bound
+        return maximum
+
+    def summary(self) -> list:
+        """
+        Сводка по наборам меток
+
+        Returns:
+            Список словарей с метками, количеством, средним, квантилями и максимумом
+        """
+        with self._lock:
+            items = [(key, list(series[0]), series[1], series[2], series[3])
+                     for key, series in self._values.items()]
+
+        result = []
+        for key, counts, total_sum, total, maximum in items:
+            entry = {
+                'labels': dict(zip(self.labelnames, key)),
+                'count': total,
+                'avg': total_sum / total if total else 0.0,
+                'max': maximum
+            }
+            for q in QUANTILES:
+                entry[f'p{int(q * 100)}'] = self._quantile(q, counts, total, maximum)
+            result.append(entry)
+        result.sort(key=lambda entry: entry['count'], reverse=True)
+        return result
+
+    def render(self) -> list:
+        """Строки гистограммы в текстовом формате Prometheus"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, list(series[0]), series[1], series[2])
+                           for key, series in self._values.items())
+        for key, counts, total_sum, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {total}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total_sum}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+# Все зарегистрированные метрики
+_registry = []
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    """Регистрация счетчика"""
+    metric = Counter(name, documentation, labelnames)
+    _registry.append(metric)
+    return metric
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    """Регистрация текущего значения"""
+    metric = Gauge(name, documentation, labelnames)
+    _registry.append(metric)
+    return metric
+
+def histogram(name: str, documentation: str, labelnames: tuple = (),
+              buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    """Регистрация гистограммы"""
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _registry.append(metric)
+    return metric
+
+def render_prometheus() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Метрики внешних зависимостей бота
+GROK_REQUEST_SECONDS = histogram(
+    'bot_grok_request_seconds', 'Длительность запросов к Grok API', ('mode', 'status'))
+GROK_IN_FLIGHT = gauge('bot_grok_requests_in_flight', 'Запросы к Grok API в работе')
+GROK_RETRIES = counter('bot_grok_retries_total', 'Повторы запросов к Grok API', ('reason',))
+GROK_HEDGED = counter('bot_grok_hedged_requests_total', 'Дублирующие запросы к Grok API', ('winner',))
+GROK_CIRCUIT_STATE = gauge(
+    'bot_grok_circuit_state', 'Автоматический выключатель Grok API: 0 - закрыт, 1 - полуоткрыт, 2 - открыт')
+GROK_CIRCUIT_REJECTED = counter(
+    'bot_grok_circuit_rejected_total', 'Запросы к Grok API, отклоненные открытым выключателем')
+SHEETS_READ_SECONDS = histogram(
+    'bot_sheets_read_seconds', 'Длительность чтения листов Google Sheets', ('worksheet', 'status'))
+SHEETS_WRITE_SECONDS = histogram(
+    'bot_sheets_write_seconds', 'Длительность выгрузки строк в Google Sheets', ('worksheet', 'status'))
+DB_QUERY_SECONDS = histogram(
+    'bot_db_query_seconds', 'Длительность операций SQLite', ('operation', 'status'))
+DB_IN_FLIGHT = gauge('bot_db_queries_in_flight', 'Операции SQLite в работе')
+HANDLER_SECONDS = histogram(
+    'bot_handler_seconds', 'Длительность обработчиков Telegram', ('handler', 'status'))
+HANDLERS_IN_FLIGHT = gauge('bot_handlers_in_flight', 'Обработчики Telegram в работе')
+TELEGRAM_REQUEST_SECONDS = histogram(
+    'bot_telegram_request_seconds', 'Длительность запросов к Telegram Bot API', ('method', 'status'))
+TELEGRAM_IN_FLIGHT = gauge('bot_telegram_requests_in_flight', 'Запросы к Telegram Bot API в работе')
+SCHEDULER_RUNNING = gauge('bot_scheduler_running', 'Запросы к Grok, получившие слот планировщика')
+SCHEDULER_QUEUED = gauge('bot_scheduler_queued', 'Запросы к Grok в очереди планировщика')
+SCHEDULER_WAIT_SECONDS = histogram(
+    'bot_scheduler_wait_seconds', 'Ожидание слота планировщика запросов к Grok')
+SCHEDULER_REJECTED = counter(
+    'bot_scheduler_rejected_total', 'Запросы, отклоненные планировщиком', ('reason',))
+ERRORS = counter('bot_errors_total', 'Ошибки внешних зависимостей', ('component',))
+STARTUP_SECONDS = gauge('bot_startup_phase_seconds', 'Длительность этапов запуска бота', ('phase',))
+
+
+def instrument_handler(func):
+    """Декоратор обработчика Telegram: длительность и количество выполняющихся"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with HANDLERS_IN_FLIGHT.track_inprogress(), HANDLER_SECONDS.time(handler=name):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTP транспорт Bot API с учетом длительности запросов по методам"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        TELEGRAM_IN_FLIGHT.inc()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        except Exception:
+            ERRORS.inc(component='telegram')
+            raise
+        finally:
+            TELEGRAM_IN_FLIGHT.dec()
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, method=api_method, status=status)
+
+
+# HTTP сервер метрик
+_metrics_server = None
+
+async def _handle_metrics(request) -> Response:
+    """Метрики для Prometheus"""
+    return Response(200, render_prometheus().encode('utf-8'), PROMETHEUS_CONTENT_TYPE)
+
+async def start_metrics_server(host: str = '0.0.0.0', port: int = 9090) -> HTTPServer:
+    """Запуск HTTP сервера с GET /metrics"""
+    global _metrics_server
+    _metrics_server = HTTPServer(host, port)
+    _metrics_server.route('GET', '/metrics', _handle_metrics)
+    await _metrics_server.start()
+    return _metrics_server
+
+async def stop_metrics_server():
+    """Остановка HTTP сервера метрик"""
+    global _metrics_server
+    if _metrics_server is not None:
+        await _metrics_server.stop()
+        _metrics_server = None
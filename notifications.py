@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import time
+from telegram.error import RetryAfter
+from telegram.helpers import escape_markdown
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину сообщения
+MAX_MESSAGE_LENGTH = 4096
+
+
+def _application_fields(payload: dict) -> tuple:
+    """Имя, username и телефон клиента с экранированием Markdown"""
+    full_name = escape_markdown(payload.get('full_name') or 'без имени')
+    username = payload.get('username')
+    username_str = escape_markdown(f"@{username}") if username else "без username"
+    # Телефон выводится как код: внутри него экранирование Markdown не работает
+    return full_name, username_str, payload['phone'].replace('`', '')
+
+
+def format_application(payload: dict) -> str:
+    """Уведомление об одной заявке"""
+    full_name, username_str, phone = _application_fields(payload)
+    return (
+        "🔔 *НОВАЯ ЗАЯВКА!*\n\n"
+        f"👤 Клиент: {full_name}\n"
+        f"🆔 Username: {username_str}\n"
+        f"🆔 User ID: {payload['user_id']}\n"
+        f"📞 Телефон: `{phone}`\n\n"
+        "Свяжитесь с клиентом как можно скорее!"
+    )
+
+
+def format_application_line(payload: dict) -> str:
+    """Заявка одной строкой для сводки"""
+    full_name, username_str, phone = _application_fields(payload)
+    return f"👤 {full_name} ({username_str}, ID {payload['user_id']}): `{phone}`"
+
+
+def format_application_digest(lines: list) -> str:
+    """Сводка нескольких заявок"""
+    return (
+        f"🔔 *НОВЫЕ ЗАЯВКИ: {len(lines)}*\n\n"
+        + "\n".join(lines)
+        + "\n\nСвяжитесь с клиентами как можно скорее!"
+    )
+
+
+# Форматирование по типу уведомления: (одно уведомление, строка сводки, сводка)
+FORMATTERS = {
+    'application': (format_application, format_application_line, format_application_digest)
+}
+
+
+class NotificationOutbox:
+    """Отправка уведомлений из очереди в БД с повторами и сводками"""
+
+    def __init__(self, bot, poll_interval: float = 5.0, digest_window: float = 1.0,
+                 max_digest: int = 20, batch_size: int = 100, retry_base: float = 5.0,
+                 retry_max: float = 600.0, lease: float = 60.0):
+        """
+        Инициализация очереди уведомлений
+
+        Args:
+            bot: Telegram Bot, через который отправляются уведомления
+            poll_interval: Как часто проверять очередь без явного сигнала (сек)
+            digest_window: Сколько ждать после новой заявки, чтобы собрать сводку (сек)
+            max_digest: Максимум уведомлений в одной сводке
+            batch_size: Сколько уведомлений захватывать из БД за раз
+            retry_base: Задержка первого повтора после ошибки (сек), дальше удваивается
+            retry_max: Максимальная задержка повтора (сек)
+            lease: На сколько захваченные уведомления скрываются от других процессов (сек)
+        """
+        self.bot = bot
+        self.poll_interval = poll_interval
+        self.digest_window = digest_window
+        self.max_digest = max_digest
+        self.batch_size = batch_size
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease
+
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+        # Метрики отправки
+        self.stats = {
+            'sent': 0,
+            'messages': 0,
+            'digests': 0,
+            'retries': 0,
+            'retry_after': 0,
+            'last_error': None
+        }
+
+    def start(self):
+        """Запуск фоновой отправки (нужен работающий event loop)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановка фоновой отправки; неотправленные уведомления остаются в БД"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Сигнал о новом уведомлении в очереди"""
+        self._wakeup.set()
+
+    async def enqueue(self, chat_id: int, kind: str, payload: dict):
+        """Добавление уведомления в очередь"""
+        await database.enqueue_notification_async(chat_id, kind, payload)
+        self.wake()
+
+    def _retry_delay(self, attempts: int) -> float:
+        """Экспоненциальная задержка повтора"""
+        return min(self.retry_max, self.retry_base * 2 ** attempts)
+
+    def _build_messages(self, rows: list) -> list:
+        """
+        Сообщения для отправки: уведомления одного получателя и типа объединяются в сводки
+
+        Returns:
+            Список (chat_id, текст, id уведомлений, максимум попыток)
+        """
+        groups = {}
+        for id_, chat_id, kind, payload, attempts in rows:
+            groups.setdefault((chat_id, kind), []).append((id_, payload, attempts))
+
+        messages = []
+        for (chat_id, kind), items in groups.items():
+            format_single, format_line, format_digest = FORMATTERS[kind]
+            # Делим на сводки с учетом ограничения длины сообщения
+            chunks = [[]]
+            length = 0
+            for id_, payload, attempts in items:
+                line = format_line(payload)
+                if chunks[-1] and (len(chunks[-1]) >= self.max_digest
+                                   or length + len(line) + 200 > MAX_MESSAGE_LENGTH):
+                    chunks.append([])
+                    length = 0
+                chunks[-1].append((id_, payload, attempts, line))
+                length += len(line) + 1
+
+            for chunk in chunks:
+                ids = [item[0] for item in chunk]
+                attempts = max(item[2] for item in chunk)
+                if len(chunk) == 1:
+                    text = format_single(chunk[0][1])
+                else:
+                    text = format_digest([item[3] for item in chunk])
+                messages.append((chat_id, text, ids, attempts))
+        return messages
+
+    async def deliver(self) -> int:
+        """
+        Отправка уведомлений, время которых подошло
+
+        Returns:
+            Количество отправленных уведомлений
+        """
+        async with self._lock:
+            rows = await database.claim_notifications_async(time.time(), self.lease, self.batch_size)
+            if not rows:
+                return 0
+
+            unknown = [row for row in rows if row[2] not in FORMATTERS]
+            if unknown:
+                # Не удаляем: уведомление отправит версия бота, которая знает этот тип
+                kinds = ', '.join(sorted({row[2] for row in unknown}))
+                logger.error(f"Неизвестный тип уведомлений: {kinds}")
+                await database.reschedule_notifications_async(
+                    [row[0] for row in unknown], time.time() + self.retry_max, f'unknown kind: {kinds}')
+                rows = [row for row in rows if row[2] in FORMATTERS]
+
+            messages = self._build_messages(rows)
+            sent = 0
+            for index, (chat_id, text, ids, attempts) in enumerate(messages):
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+                except RetryAfter as e:
+                    # Ограничение Telegram действует на весь бот - откладываем все оставшиеся
+                    self.stats['retry_after'] += 1
+                    logger.warning(f"Уведомления отложены на {e.retry_after} с по требованию Telegram")
+                    remaining = [id_ for message in messages[index:] for id_ in message[2]]
+                    await database.reschedule_notifications_async(
+                        remaining, time.time() + float(e.retry_after), str(e), count_attempt=False)
+                    break
+                except Exception as e:
+                    delay = self._retry_delay(attempts)
+                    self.stats['retries'] += 1
+                    self.stats['last_error'] = str(e)
+                    metrics.ERRORS.inc(component='notifications')
+                    logger.error(f"Ошибка отправки уведомления, повтор через {delay:.0f} с: {e}")
+                    await database.reschedule_notifications_async(ids, time.time() + delay, str(e))
+                    continue
+
+                await database.mark_notifications_sent_async(ids)
+                sent += len(ids)
+                self.stats['sent'] += len(ids)
+                self.stats['messages'] += 1
+                if len(ids) > 1:
+                    self.stats['digests'] += 1
+
+            if len(rows) >= self.batch_size:
+                # В очереди могут быть еще уведомления
+                self._wakeup.set()
+            return sent
+
+    async def _run(self):
+        """Фоновая отправка по сигналу или по таймеру"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                # Даем накопиться заявкам, пришедшим почти одновременно
+                await asyncio.sleep(self.digest_window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.deliver()
+            except Exception as e:
+                # Ошибка БД: уведомления остаются в очереди до следующей попытки
+                logger.error(f"Ошибка обработки очереди уведомлений: {e}")
+
+    def get_stats(self) -> dict:
+        """
+        Получение метрик отправки
+
+        Returns:
+            Словарь со счетчиками отправленных уведомлений, сводок и повторов
+        """
+        return dict(self.stats)
+
+
+# Глобальная очередь уведомлений
+_outbox = None
+
+def start_notification_outbox(bot, **options) -> NotificationOutbox:
+    """Запуск глобальной очереди уведомлений"""
+    global _outbox
+    _outbox = NotificationOutbox(bot, **options)
+    _outbox.start()
+    # Уведомления, оставшиеся с прошлого запуска
+    _outbox.wake()
+    return _outbox
+
+async def stop_notification_outbox():
+    """Остановка глобальной очереди уведомлений"""
+    global _outbox
+    if _outbox is not None:
+        outbox = _outbox
+        _outbox = None
+        await outbox.stop()
+
+def get_notification_outbox() -> NotificationOutbox:
+    """Получение глобальной очереди уведомлений"""
+    return _outbox
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class ActionRetention:
+    """Свертка старых действий в агрегаты по дням, архив по месяцам и возврат места файлу БД"""
+
+    def __init__(self, keep_days: int = 90, archive_dir: str = 'archive', interval: float = 21600.0):
+        """
+        Инициализация хранения действий
+
+        Args:
+            keep_days: Сколько последних дней хранить действия построчно
+            archive_dir: Каталог архивов actions-ГГГГ-ММ.db; пусто - старые строки только удаляются
+            interval: Как часто проверять устаревшие действия (сек)
+        """
+        self.keep_days = keep_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+
+        self._lock = asyncio.Lock()
+        self._task = None
+
+        # Счетчики свертки
+        self.stats = {
+            'days': 0,
+            'archived': 0,
+            'freed_pages': 0,
+            'errors': 0,
+            'last_error': None,
+            'last_run': None
+        }
+
+    def start(self):
+        """Запуск фоновой свертки (нужен работающий event loop)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановка фоновой свертки; начатый день дописывается в потоке записи"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def cutoff(self) -> datetime:
+        """Начало самого раннего дня, действия которого хранятся построчно"""
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return today - timedelta(days=self.keep_days)
+
+    def archive_path(self, day: str):
+        """Файл архива для месяца, к которому относится день"""
+        if not self.archive_dir:
+            return None
+        return os.path.join(self.archive_dir, f'actions-{day[:7]}.db')
+
+    async def compact(self) -> int:
+        """
+        Свертка всех дней старше keep_days, по одному дню за транзакцию
+
+        Returns:
+            Количество строк, убранных из основной базы
+        """
+        async with self._lock:
+            if self.archive_dir:
+                os.makedirs(self.archive_dir, exist_ok=True)
+            before_ts = int(self.cutoff().timestamp())
+            total = 0
+            while True:
+                day = await database.get_oldest_action_day_async(before_ts)
+                if day is None:
+                    break
+                deleted = await database.compact_action_day_async(day, self.archive_path(day))
+                if not deleted:
+                    logger.warning(f"Свертка действий за {day} не удалила строк, остановлена")
+                    break
+                total += deleted
+                self.stats['days'] += 1
+                self.stats['archived'] += deleted
+                logger.info(f"Действия за {day} свернуты в агрегаты: {deleted} строк")
+
+            if total:
+                self.stats['freed_pages'] += await database.incremental_vacuum_async()
+            self.stats['last_run'] = datetime.now()
+            return total
+
+    async def _run(self):
+        """Фоновая свертка по таймеру"""
+        try:
+            await database.enable_incremental_vacuum_async()
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.stats['last_error'] = str(e)
+            logger.error(f"Ошибка перевода базы в режим incremental vacuum: {e}")
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                self.stats['errors'] += 1
+                self.stats['last_error'] = str(e)
+                logger.error(f"Ошибка свертки старых действий: {e}")
+            await asyncio.sleep(self.interval)
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков свертки
+
+        Returns:
+            Словарь со свернутыми днями, строками и освобожденными страницами
+        """
+        return dict(self.stats)
+
+
+# Глобальная свертка действий
+_action_retention = None
+
+def start_action_retention(**options) -> ActionRetention:
+    """Запуск глобальной свертки старых действий"""
+    global _action_retention
+    _action_retention = ActionRetention(**options)
+    _action_retention.start()
+    return _action_retention
+
+async def stop_action_retention():
+    """Остановка глобальной свертки старых действий"""
+    global _action_retention
+    if _action_retention is not None:
+        retention = _action_retention
+        _action_retention = None
+        await retention.stop()
+
+def get_action_retention() -> ActionRetention:
+    """Получение глобальной свертки старых действий"""
+    return _action_retention
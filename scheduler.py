@@ -0,0 +1,251 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict, deque
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerBusy(Exception):
+    """Запрос отклонен планировщиком (лимит пользователя, переполнение или ожидание)"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Планировщик отклонил запрос: {reason}")
+        self.reason = reason
+
+
+class RequestScheduler:
+    """Планировщик запросов к Grok: общий лимит, честная очередь и лимиты пользователей"""
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 100, max_wait: float = 10.0,
+                 user_rate: float = 0.2, user_burst: int = 3):
+        """
+        Инициализация планировщика
+
+        Args:
+            max_concurrent: Максимум одновременных запросов к Grok
+            max_queue: Максимум запросов в очереди
+            max_wait: Сколько секунд запрос может ждать в очереди
+            user_rate: Сколько вопросов в секунду восстанавливается у пользователя
+            user_burst: Сколько вопросов пользователь может задать подряд
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+
+        self._running = 0
+        self._queued = 0
+        # user_id -> очередь ожидающих; порядок ключей задает очередность обхода
+        self._queues = OrderedDict()
+        # user_id -> [токены, время обновления]
+        self._buckets = OrderedDict()
+
+        self.stats = {
+            'admitted': 0,
+            'rejected_rate_limited': 0,
+            'rejected_queue_full': 0,
+            'rejected_timeout': 0,
+            'total_wait_seconds': 0.0,
+            'max_wait_seconds': 0.0
+        }
+
+    def try_take_token(self, user_id) -> bool:
+        """Списание токена из корзины пользователя; False - лимит исчерпан"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(user_id, (self.user_burst, now))
+        tokens = min(self.user_burst, tokens + (now - updated) * self.user_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.stats['rejected_rate_limited'] += 1
+            metrics.SCHEDULER_REJECTED.inc(reason='rate_limited')
+
+        # Полные корзины не храним - они равносильны отсутствующим
+        if tokens < self.user_burst:
+            self._buckets[user_id] = (tokens, now)
+        self._prune_buckets(now)
+        return allowed
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id):
+        """
+        Ожидание свободного слота для запроса к Grok
+
+        Raises:
+            SchedulerBusy: Очередь переполнена или ожидание превысило max_wait
+        """
+        await self._acquire(user_id)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def get_stats(self) -> dict:
+        """
+        Получение метрик планировщика
+
+        Returns:
+            Словарь с глубиной очереди, временем ожидания и отказами
+        """
+        scheduler_stats = dict(self.stats)
+        scheduler_stats['running'] = self._running
+        scheduler_stats['queued'] = self._queued
+        scheduler_stats['max_concurrent'] = self.max_concurrent
+        admitted = scheduler_stats['admitted']
+        scheduler_stats['avg_wait_seconds'] = (
+            scheduler_stats['total_wait_seconds'] / admitted if admitted else 0.0
+        )
+        return scheduler_stats
+
+    async def _acquire(self, user_id):
+        """Получение слота сразу или после ожидания в очереди"""
+        if self._running < self.max_concurrent and self._queued == 0:
+            self._running += 1
+            self._publish_depth()
+            self._record_wait(0.0)
+            return
+
+        if self._queued >= self.max_queue:
+            self.stats['rejected_queue_full'] += 1
+            metrics.SCHEDULER_REJECTED.inc(reason='queue_full')
+            raise SchedulerBusy('queue_full')
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._queued += 1
+        self._publish_depth()
+        started = time.monotonic()
+
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            if waiter.done():
+                # Слот уже выдан - возвращаем его
+                self._release()
+            else:
+                self._remove_waiter(user_id, waiter)
+            raise
+
+        if not waiter.done():
+            self._remove_waiter(user_id, waiter)
+            self.stats['rejected_timeout'] += 1
+            metrics.SCHEDULER_REJECTED.inc(reason='timeout')
+            raise SchedulerBusy('timeout')
+
+        self._record_wait(time.monotonic() - started)
+
+    def _release(self):
+        """Освобождение слота и передача его следующему пользователю по кругу"""
+        self._running -= 1
+        while self._running < self.max_concurrent and self._queues:
+            user_id, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self._queued -= 1
+            self._running += 1
+            waiter.set_result(None)
+        self._publish_depth()
+
+    def _remove_waiter(self, user_id, waiter):
+        """Удаление ожидающего из очереди пользователя"""
+        waiters = self._queues.get(user_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del self._queues[user_id]
+            self._publish_depth()
+
+    def _record_wait(self, waited):
+        """Учет времени ожидания слота"""
+        self.stats['admitted'] += 1
+        self.stats['total_wait_seconds'] += waited
+        self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], waited)
+        metrics.SCHEDULER_WAIT_SECONDS.observe(waited)
+
+    def _publish_depth(self):
+        """Слоты в работе и длина очереди - в метрики Prometheus"""
+        metrics.SCHEDULER_RUNNING.set(self._running)
+        metrics.SCHEDULER_QUEUED.set(self._queued)
+
+    def _prune_buckets(self, now):
+        """Удаление корзин, которые уже успели наполниться"""
+        refill_time = self.user_burst / self.user_rate if self.user_rate > 0 else float('inf')
+        while self._buckets:
+            user_id, (tokens, updated) = next(iter(self._buckets.items()))
+            if now - updated < refill_time:
+                break
+            del self._buckets[user_id]
+
+
+# Лимит, который получает BaseUpdateProcessor: его семафор фактически не ограничивает
+UNLIMITED_UPDATES = 2 ** 31 - 1
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей, последовательная - одного"""
+
+    def __init__(self, max_concurrent_updates: int):
+        """
+        Инициализация обработчика обновлений
+
+        Args:
+            max_concurrent_updates: Максимум обновлений в работе одновременно
+        """
+        # BaseUpdateProcessor.process_update (final) занимает свой семафор до очереди
+        # пользователя, и обновления, ждущие своего пользователя, держали бы слоты
+        # остальных. Поэтому его лимит снят, а общий слот берется в do_process_update
+        super().__init__(UNLIMITED_UPDATES)
+        self.max_updates = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # user_id -> [блокировка, количество обновлений в работе]
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        """Обработка обновления: сначала очередь пользователя, затем общий слот"""
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        # ConversationHandler рассчитывает, что обновления пользователя идут по одному
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
+
+    async def initialize(self) -> None:
+        """Ресурсы не требуются"""
+
+    async def shutdown(self) -> None:
+        """Ресурсы не требуются"""
+
+
+# Глобальный планировщик запросов к Grok
+_scheduler = None
+
+def init_scheduler(**options) -> RequestScheduler:
+    """Инициализация глобального планировщика"""
+    global _scheduler
+    _scheduler = RequestScheduler(**options)
+    return _scheduler
+
+def get_scheduler() -> RequestScheduler:
+    """Получение глобального планировщика"""
+    return _scheduler
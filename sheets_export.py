@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import date, datetime, timedelta
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Листы, в которые выгружаются заявки и агрегаты действий по дням
+APPLICATIONS_WORKSHEET = "Заявки"
+ROLLUPS_WORKSHEET = "Статистика по дням"
+APPLICATIONS_HEADER = ['ID', 'Дата', 'User ID', 'Username', 'Имя', 'Телефон', 'Статус']
+ROLLUPS_HEADER = ['День', 'Действие', 'Количество']
+
+# Отметки выгрузки в таблице export_state
+APPLICATIONS_STATE = 'sheets_applications_id'
+ROLLUPS_STATE = 'sheets_rollups_day'
+# Аренда выгрузки: с общим хранилищем (PostgreSQL) выгружает один экземпляр бота
+EXPORTER_STATE = 'sheets_exporter'
+
+# Пауза между запросами к Sheets API: лимит - 60 запросов записи в минуту
+MIN_REQUEST_INTERVAL = 1.1
+
+# День выгружается, когда он закончился и буферы действий успели записаться в БД
+ROLLUP_SETTLE = timedelta(minutes=5)
+
+# Лимит строк при выгрузке одного дня целиком (типов действий за день намного меньше)
+WHOLE_DAY_LIMIT = 2 ** 31
+
+
+def application_row(row) -> list:
+    """Строка листа "Заявки" из строки БД"""
+    id_, timestamp, user_id, username, first_name, last_name, phone, status = row
+    full_name = f"{first_name or ''} {last_name or ''}".strip()
+    return [id_, str(timestamp)[:19], user_id, f"@{username}" if username else '',
+            full_name, phone, status or 'new']
+
+
+class SheetsExporter:
+    """Выгрузка новых заявок и агрегатов по дням в Google Sheets пакетами по таймеру"""
+
+    def __init__(self, sheets_manager, interval: float = 60.0, batch_size: int = 500,
+                 export_rollups: bool = False, max_backoff: float = 900.0):
+        """
+        Инициализация выгрузки
+
+        Args:
+            sheets_manager: Подключенный GoogleSheetsManager с правом записи
+            interval: Как часто выгружать новые строки (сек)
+            batch_size: Сколько строк отправлять одним запросом append_rows
+            export_rollups: Выгружать ли агрегаты действий за завершившиеся дни
+            max_backoff: Максимальная пауза после ошибок Sheets API (сек)
+        """
+        self.sheets_manager = sheets_manager
+        self.interval = interval
+        self.batch_size = batch_size
+        self.export_rollups = export_rollups
+        self.max_backoff = max_backoff
+        # Аренда продлевается при каждой выгрузке; если экземпляр остановился,
+        # через lease_seconds выгрузку подхватит другой
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = max(3 * interval, 600.0)
+
+        self._worksheets = {}
+        self._reconciled = False
+        self._last_request = 0.0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+        # Счетчики выгрузки
+        self.stats = {
+            'applications': 0,
+            'rollups': 0,
+            'requests': 0,
+            'errors': 0,
+            'last_error': None,
+            'last_export': None
+        }
+
+    def start(self):
+        """Запуск фоновой выгрузки (нужен работающий event loop)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановка фоновой выгрузки; невыгруженные строки уйдут при следующем запуске"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _worksheet(self, name: str, header: list):
+        """Лист для выгрузки; если его нет - создается с заголовком (в отдельном потоке)"""
+        worksheet = self._worksheets.get(name)
+        if worksheet is None:
+            import gspread
+            spreadsheet = self.sheets_manager.spreadsheet
+            try:
+                worksheet = spreadsheet.worksheet(name)
+            except gspread.WorksheetNotFound:
+                worksheet = spreadsheet.add_worksheet(title=name, rows=1000, cols=len(header))
+                worksheet.append_row(header, value_input_option='RAW')
+                logger.info(f"Создан лист '{name}' для выгрузки")
+            self._worksheets[name] = worksheet
+        return worksheet
+
+    def _append(self, name: str, header: list, rows: list):
+        """Один запрос append_rows (в отдельном потоке)"""
+        started = time.monotonic()
+        try:
+            # RAW: телефон +7... не должен превратиться в формулу
+            self._worksheet(name, header).append_rows(rows, value_input_option='RAW')
+        except Exception:
+            # Лист могли удалить или переименовать - найдем заново
+            self._worksheets.pop(name, None)
+            metrics.ERRORS.inc(component='sheets')
+            metrics.SHEETS_WRITE_SECONDS.observe(time.monotonic() - started, worksheet=name, status='error')
+            raise
+        metrics.SHEETS_WRITE_SECONDS.observe(time.monotonic() - started, worksheet=name, status='ok')
+
+    def _last_id_in_sheet(self) -> int:
+        """Наибольший ID заявки в листе (в отдельном потоке)"""
+        values = self._worksheet(APPLICATIONS_WORKSHEET, APPLICATIONS_HEADER).col_values(1)
+        return max((int(value) for value in values if value.isdigit()), default=0)
+
+    async def _throttle(self):
+        """Соблюдение лимита запросов к Sheets API"""
+        delay = self._last_request + MIN_REQUEST_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._last_request = time.monotonic()
+        self.stats['requests'] += 1
+
+    async def export_applications(self) -> int:
+        """
+        Выгрузка одного пакета новых заявок
+
+        Returns:
+            Количество выгруженных заявок
+        """
+        last_id = int(await database.get_export_state_async(APPLICATIONS_STATE) or 0)
+        if not self._reconciled:
+            # Строки могли попасть в лист, а отметка - не сохраниться (остановка между ними)
+            await self._throttle()
+            sheet_id = await asyncio.to_thread(self._last_id_in_sheet)
+            self._reconciled = True
+            if sheet_id > last_id:
+                logger.warning(f"Отметка выгрузки заявок {last_id} отстает от листа ({sheet_id}), исправлена")
+                last_id = sheet_id
+                await database.set_export_state_async(APPLICATIONS_STATE, last_id)
+
+        rows = await database.get_applications_after_async(last_id, self.batch_size)
+        if not rows:
+            return 0
+
+        await self._throttle()
+        await asyncio.to_thread(
+            self._append, APPLICATIONS_WORKSHEET, APPLICATIONS_HEADER, [application_row(row) for row in rows])
+        await database.set_export_state_async(APPLICATIONS_STATE, rows[-1][0])
+        self.stats['applications'] += len(rows)
+        return len(rows)
+
+    async def export_daily_rollups(self) -> int:
+        """
+        Выгрузка агрегатов действий за завершившиеся дни (один пакет)
+
+        Returns:
+            Количество выгруженных строк
+        """
+        last_day = await database.get_export_state_async(ROLLUPS_STATE) or ''
+        before_day = (datetime.now() - ROLLUP_SETTLE).date().isoformat()
+        rows = await database.get_daily_rollups_between_async(last_day, before_day, self.batch_size)
+        if not rows:
+            return 0
+        if len(rows) == self.batch_size:
+            # Отметка - последний выгруженный день, поэтому день не разрываем между пакетами
+            complete = [row for row in rows if row[0] != rows[-1][0]]
+            if complete:
+                rows = complete
+            else:
+                # Весь пакет - один день: выгружаем этот день целиком, без ограничения пакета
+                day = rows[0][0]
+                next_day = (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+                rows = await database.get_daily_rollups_between_async(last_day, next_day, WHOLE_DAY_LIMIT)
+
+        await self._throttle()
+        await asyncio.to_thread(
+            self._append, ROLLUPS_WORKSHEET, ROLLUPS_HEADER, [list(row) for row in rows])
+        await database.set_export_state_async(ROLLUPS_STATE, rows[-1][0])
+        self.stats['rollups'] += len(rows)
+        return len(rows)
+
+    async def export(self) -> int:
+        """
+        Выгрузка всех новых строк пакетами
+
+        Returns:
+            Количество выгруженных строк
+        """
+        async with self._lock:
+            if not await database.claim_export_async(EXPORTER_STATE, self.owner, self.lease_seconds):
+                return 0
+            total = 0
+            while True:
+                count = await self.export_applications()
+                total += count
+                if count < self.batch_size:
+                    break
+            while self.export_rollups:
+                count = await self.export_daily_rollups()
+                total += count
+                if not count:
+                    break
+            self.stats['last_export'] = datetime.now()
+            if total:
+                logger.info(f"Выгружено в Google Sheets строк: {total}")
+            return total
+
+    async def _run(self):
+        """Фоновая выгрузка по таймеру, при ошибках - с увеличением паузы"""
+        failures = 0
+        while True:
+            try:
+                await self.export()
+                failures = 0
+                delay = self.interval
+            except Exception as e:
+                failures += 1
+                self.stats['errors'] += 1
+                self.stats['last_error'] = str(e)
+                delay = min(self.max_backoff, self.interval * 2 ** failures)
+                logger.error(f"Ошибка выгрузки в Google Sheets, повтор через {delay:.0f} с: {e}")
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> dict:
+        """
+        Получение счетчиков выгрузки
+
+        Returns:
+            Словарь с количеством выгруженных строк, запросов и ошибок
+        """
+        return dict(self.stats)
+
+
+# Глобальная выгрузка
+_sheets_exporter = None
+
+def start_sheets_exporter(sheets_manager, **options) -> SheetsExporter:
+    """Запуск глобальной выгрузки в Google Sheets"""
+    global _sheets_exporter
+    _sheets_exporter = SheetsExporter(sheets_manager, **options)
+    _sheets_exporter.start()
+    return _sheets_exporter
+
+async def stop_sheets_exporter():
+    """Остановка глобальной выгрузки в Google Sheets"""
+    global _sheets_exporter
+    if _sheets_exporter is not None:
+        exporter = _sheets_exporter
+        _sheets_exporter = None
+        await exporter.stop()
+
+def get_sheets_exporter() -> SheetsExporter:
+    """Получение глобальной выгрузки в Google Sheets"""
+    return _sheets_exporter
@@ -0,0 +1,96 @@
+import builtins
+import contextlib
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Время запуска бота по этапам и по импортируемым модулям"""
+
+    def __init__(self):
+        self.started = self._last_checkpoint = time.perf_counter()
+        self.phases = {}
+        self.imports = defaultdict(float)
+        self.ready_seconds = None
+        self._original_import = None
+        self._depth = 0
+
+    def track_imports(self):
+        """Начало учета времени импортов верхнего уровня (вложенные входят в родительский)"""
+        if self._original_import is not None:
+            return
+        self._original_import = original = builtins.__import__
+
+        def timed_import(name, *args, **kwargs):
+            if self._depth:
+                return original(name, *args, **kwargs)
+            self._depth += 1
+            started = time.perf_counter()
+            try:
+                return original(name, *args, **kwargs)
+            finally:
+                self._depth -= 1
+                self.imports[name.partition('.')[0]] += time.perf_counter() - started
+
+        builtins.__import__ = timed_import
+
+    def stop_tracking_imports(self):
+        """Окончание учета импортов; время от начала записывается как этап imports"""
+        if self._original_import is None:
+            return
+        builtins.__import__ = self._original_import
+        self._original_import = None
+        self.checkpoint('imports')
+
+    def checkpoint(self, name: str):
+        """Завершение этапа: время с предыдущей отметки записывается под именем name"""
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._last_checkpoint
+        self._last_checkpoint = now
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Замер этапа, идущего параллельно с остальными (можно использовать вокруг await)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def mark_ready(self):
+        """Бот начал принимать обновления"""
+        if self.ready_seconds is None:
+            self.ready_seconds = time.perf_counter() - self.started
+
+    def get_report(self, top_imports: int = 8) -> dict:
+        """
+        Отчет о запуске
+
+        Returns:
+            Словарь с временем до готовности, этапами и самыми долгими импортами
+        """
+        slowest = sorted(self.imports.items(), key=lambda item: item[1], reverse=True)[:top_imports]
+        return {
+            'ready_seconds': self.ready_seconds,
+            'phases': dict(self.phases),
+            'imports': dict(slowest)
+        }
+
+    def format_report(self) -> str:
+        """Отчет о запуске одной строкой для лога"""
+        report = self.get_report()
+        phases = ', '.join(f"{name} {seconds:.2f} с" for name, seconds in report['phases'].items())
+        imports = ', '.join(f"{name} {seconds:.2f} с" for name, seconds in report['imports'].items())
+        ready = f"{report['ready_seconds']:.2f} с" if report['ready_seconds'] is not None else "еще не готов"
+        return f"Запуск: {ready} ({phases}); импорты: {imports}"
+
+
+# Глобальный замер запуска (создается при первом импорте модуля)
+_startup_timer = StartupTimer()
+
+def get_startup_timer() -> StartupTimer:
+    """Получение глобального замера запуска"""
+    return _startup_timer
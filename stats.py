@@ -1,20 +1,231 @@
 """
 Скрипт для просмотра статистики использования бота
+
+    python stats.py                                   # общая сводка
+    python stats.py actions --from 2024-05-01 --to 2024-05-31 --action start --by day
+    python stats.py funnel --by hour --steps start,button_cases,application_submitted
+    python stats.py cohorts --period week --periods 8
+    python stats.py export actions --format jsonl --output actions.jsonl
+    python stats.py --db archive/actions-2024-01.db funnel   # архив действий за месяц
+
+Отчеты читают базу через соединение только для чтения, а с --snapshot - из копии,
+снятой через SQLite backup API, поэтому не мешают работающему боту. Строки
+выгрузки читаются из курсора по одной: память не зависит от размера базы.
 """
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 import database
-from datetime import datetime
 
+# Шаги воронки по умолчанию
+DEFAULT_FUNNEL = ('start', 'button_cases', 'application_submitted')
+
+# Длина префикса timestamp для группировки по дням и часам
+PERIOD_WIDTH = {'day': 10, 'hour': 13}
+
+# Начало когорты и длина периода удержания (дней)
+COHORT_PERIODS = {
+    'day': ("date(first_seen)", 1),
+    'week': ("date(first_seen, 'weekday 0', '-6 days')", 7),
+    'month': ("date(first_seen, 'start of month')", 30)
+}
+
+# Страниц базы, копируемых за один шаг backup (между шагами бот может писать)
+BACKUP_PAGES = 1024
+
+# Действия с названиями типов и локальным временем (в таблице - коды и секунды epoch)
+ACTIONS_FROM = 'actions a JOIN action_types t ON t.id = a.type_id'
+ACTION_TIME = "datetime(a.ts, 'unixepoch', 'localtime')"
+
+# Выгружаемые таблицы: запрос и колонка времени для фильтра по датам
+EXPORT_TABLES = {
+    'actions': (f'SELECT a.id, a.user_id, t.name AS action_type, {ACTION_TIME} AS timestamp FROM {ACTIONS_FROM}',
+                'a.ts'),
+    'applications': ('SELECT id, user_id, phone_number, timestamp, status FROM applications', 'timestamp'),
+    'users': ('SELECT user_id, username, first_name, last_name, first_seen, last_seen FROM users', 'first_seen')
+}
+
+
+def connect(db_file: str, snapshot: str = None) -> sqlite3.Connection:
+    """
+    Подключение к базе для отчетов
+
+    Args:
+        db_file: Файл базы бота
+        snapshot: Файл для копии базы; None - читать саму базу
+
+    Returns:
+        Соединение только для чтения или соединение с копией
+    """
+    if not os.path.exists(db_file):
+        raise FileNotFoundError(f"База {db_file} не найдена")
+    source = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    if snapshot is None:
+        source.execute('PRAGMA query_only = ON')
+        return source
+
+    # Копия снимается небольшими шагами, чтобы не держать блокировку долго
+    target = sqlite3.connect(snapshot)
+    try:
+        source.backup(target, pages=BACKUP_PAGES)
+    finally:
+        source.close()
+    target.execute('PRAGMA query_only = ON')
+    return target
+
+
+def _range_filter(column: str, date_from: str = None, date_to: str = None,
+                  actions: list = None) -> tuple:
+    """Условие WHERE по датам (включительно) и типам действий"""
+    def bound(day):
+        # a.ts хранится в секундах epoch, остальные колонки - строками локального времени
+        return int(datetime.combine(day, datetime.min.time()).timestamp()) if column == 'a.ts' else day.isoformat()
+
+    conditions, params = [], []
+    if date_from:
+        conditions.append(f'{column} >= ?')
+        params.append(bound(date.fromisoformat(date_from)))
+    if date_to:
+        # Дата без времени: включаем весь день
+        conditions.append(f'{column} < ?')
+        params.append(bound(date.fromisoformat(date_to) + timedelta(days=1)))
+    if actions:
+        conditions.append(f"t.name IN ({', '.join('?' * len(actions))})")
+        params.extend(actions)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+
+def iter_action_counts(conn, by: str = 'day', date_from: str = None, date_to: str = None,
+                       actions: list = None):
+    """Количество действий по периодам и типам"""
+    where, params = _range_filter('a.ts', date_from, date_to, actions)
+    cursor = conn.execute(f'''
+        SELECT substr({ACTION_TIME}, 1, {PERIOD_WIDTH[by]}) AS period, t.name, COUNT(*)
+        FROM {ACTIONS_FROM}{where}
+        GROUP BY period, t.name
+        ORDER BY period, t.name
+    ''', params)
+    yield from cursor
+
+
+def iter_funnel(conn, steps: tuple = DEFAULT_FUNNEL, by: str = 'day',
+                date_from: str = None, date_to: str = None):
+    """
+    Воронка по периодам: сколько пользователей прошли шаги по порядку
+
+    Пользователь относится к периоду, в котором сделал первый шаг. Действия читаются
+    из курсора по одному, в памяти только счетчики по периодам.
+
+    Yields:
+        (период, пользователей на шаге 1, ..., конверсия в последний шаг, %)
+    """
+    where, params = _range_filter('a.ts', date_from, date_to, list(steps))
+    cursor = conn.execute(f'''
+        SELECT a.user_id, t.name, {ACTION_TIME}
+        FROM {ACTIONS_FROM}{where}
+        ORDER BY a.user_id, a.ts, a.id
+    ''', params)
+
+    width = PERIOD_WIDTH[by]
+    counts = defaultdict(lambda: [0] * len(steps))
+    current_user = None
+    reached = 0
+    period = None
+    for user_id, action_type, timestamp in cursor:
+        if user_id != current_user:
+            current_user, reached, period = user_id, 0, None
+        if reached < len(steps) and action_type == steps[reached]:
+            if reached == 0:
+                period = str(timestamp)[:width]
+            counts[period][reached] += 1
+            reached += 1
+
+    for period in sorted(counts):
+        row = counts[period]
+        conversion = round(row[-1] / row[0] * 100, 1) if row[0] else 0.0
+        yield (period, *row, conversion)
+
+
+def iter_cohorts(conn, period: str = 'week', periods: int = 8,
+                 date_from: str = None, date_to: str = None):
+    """
+    Удержание когорт по first_seen/last_seen
+
+    Yields:
+        (начало когорты, пользователей, % активных спустя 1..periods периодов)
+    """
+    cohort_start, days = COHORT_PERIODS[period]
+    retained = ', '.join(
+        f'SUM(julianday(last_seen) - julianday(first_seen) >= {n * days})' for n in range(1, periods + 1)
+    )
+    where, params = _range_filter('first_seen', date_from, date_to)
+    cursor = conn.execute(f'''
+        SELECT {cohort_start} AS cohort, COUNT(*), {retained}
+        FROM users{where}
+        GROUP BY cohort
+        ORDER BY cohort
+    ''', params)
+    for cohort, users, *active in cursor:
+        yield (cohort, users, *(round(count / users * 100, 1) for count in active))
+
+
+def iter_export(conn, table: str, date_from: str = None, date_to: str = None,
+                actions: list = None):
+    """Строки таблицы для выгрузки прямо из курсора"""
+    query, column = EXPORT_TABLES[table]
+    where, params = _range_filter(column, date_from, date_to, actions if table == 'actions' else None)
+    cursor = conn.execute(f'{query}{where} ORDER BY 1', params)
+    yield [description[0] for description in cursor.description]
+    yield from cursor
 
-def print_statistics():
+
+def write_rows(rows, columns: list, fmt: str, output) -> int:
+    """
+    Вывод строк таблицей, в CSV или JSONL
+
+    Returns:
+        Количество выведенных строк
+    """
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif fmt == 'jsonl':
+        for row in rows:
+            output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n')
+            count += 1
+    else:
+        # Таблица для терминала (только для отчетов - строки нужны все сразу)
+        rows = [[str(value) for value in row] for row in rows]
+        widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+        output.write('  '.join(column.ljust(width) for column, width in zip(columns, widths)) + '\n')
+        output.write('  '.join('-' * width for width in widths) + '\n')
+        for row in rows:
+            output.write('  '.join(value.ljust(width) for value, width in zip(row, widths)) + '\n')
+        count = len(rows)
+    return count
+
+
+def print_statistics(stats: dict = None):
     """Вывод статистики в консоль"""
-    stats = database.get_statistics()
-    
+    if stats is None:
+        stats = database.get_statistics()
+
     print("\n" + "="*60)
     print("📊 СТАТИСТИКА TELEGRAM-БОТА")
     print("="*60)
-    
+
     print(f"\n👥 Всего пользователей: {stats['total_users']}")
-    
+
     print("\n📈 Статистика действий:")
     print("-" * 60)
     if stats['actions_stats']:
@@ -31,7 +242,7 @@ def print_statistics():
         print(f"\n  ✅ Всего действий: {total_actions}")
     else:
         print("  Пока нет записанных действий")
-    
+
     print("\n🏆 ТОП-10 активных пользователей:")
     print("-" * 60)
     if stats['top_users']:
@@ -41,15 +252,116 @@ def print_statistics():
             print(f"     ID: {user_id}, Действий: {action_count}")
     else:
         print("  Пока нет пользователей")
-    
+
+    print("\n📅 Действия за последние 7 дней:")
+    print("-" * 60)
+    if stats['daily_stats']:
+        for day, count in stats['daily_stats']:
+            print(f"  {day}: {count}")
+    else:
+        print("  Нет действий за последние 7 дней")
+
     print("\n" + "="*60)
     print(f"📅 Отчет сформирован: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}")
     print("="*60 + "\n")
 
 
-if __name__ == '__main__':
+def parse_args(argv=None):
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Статистика Telegram-бота")
+    # Общие параметры можно указывать и до, и после команды
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    for target in (parser, common):
+        target.add_argument('--db', help="Файл базы бота")
+        target.add_argument('--snapshot', action='store_true', help="Работать с копией базы во временном файле")
+        target.add_argument('--snapshot-file', metavar='FILE', help="Снять копию базы в этот файл и работать с ней")
+        target.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD', help="Начало периода")
+        target.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD', help="Конец периода (включительно)")
+        target.add_argument('--format', choices=('table', 'csv', 'jsonl'), help="Формат вывода")
+        target.add_argument('--output', '-o', help="Файл для вывода (по умолчанию - консоль)")
+    parser.set_defaults(db=database.DB_FILE, snapshot=False, snapshot_file=None, format='table')
+
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('summary', parents=[common], help="Общая сводка (по умолчанию)")
+
+    actions = commands.add_parser('actions', parents=[common], help="Действия по дням или часам")
+    actions.add_argument('--action', action='append', help="Тип действия (можно несколько раз)")
+    actions.add_argument('--by', choices=tuple(PERIOD_WIDTH), default='day')
+
+    funnel = commands.add_parser('funnel', parents=[common], help="Воронка по дням или часам")
+    funnel.add_argument('--steps', default=','.join(DEFAULT_FUNNEL), help="Шаги воронки через запятую")
+    funnel.add_argument('--by', choices=tuple(PERIOD_WIDTH), default='day')
+
+    cohorts = commands.add_parser('cohorts', parents=[common], help="Удержание когорт по first_seen")
+    cohorts.add_argument('--period', choices=tuple(COHORT_PERIODS), default='week')
+    cohorts.add_argument('--periods', type=int, default=8, help="Сколько периодов удержания показать")
+
+    export = commands.add_parser('export', parents=[common], help="Выгрузка таблицы в CSV или JSONL")
+    export.add_argument('table', choices=tuple(EXPORT_TABLES))
+    export.add_argument('--action', action='append', help="Тип действия (для actions)")
+    return parser.parse_args(argv)
+
+
+def run(args, output) -> int:
+    """Выполнение команды; возвращает количество выведенных строк"""
+    snapshot = args.snapshot_file
+    temp_snapshot = None
+    if snapshot is None and args.snapshot:
+        handle, temp_snapshot = tempfile.mkstemp(suffix='.db', prefix='bot-stats-')
+        os.close(handle)
+        snapshot = temp_snapshot
+    conn = connect(args.db, snapshot)
+    rows = None
     try:
-        print_statistics()
-    except Exception as e:
-        print(f"❌ Ошибка при получении статистики: {e}")
-        print("Убедитесь, что бот был запущен хотя бы один раз для создания БД.")
+        if args.command in (None, 'summary'):
+            print_statistics(database._get_statistics(conn))
+            return 0
+
+        if args.command == 'actions':
+            columns = ['period', 'action_type', 'count']
+            rows = iter_action_counts(conn, args.by, args.date_from, args.date_to, args.action)
+        elif args.command == 'funnel':
+            steps = tuple(step.strip() for step in args.steps.split(',') if step.strip())
+            columns = ['period', *steps, 'conversion_pct']
+            rows = iter_funnel(conn, steps, args.by, args.date_from, args.date_to)
+        elif args.command == 'cohorts':
+            columns = ['cohort', 'users', *(f'{args.period}_{n}_pct' for n in range(1, args.periods + 1))]
+            rows = iter_cohorts(conn, args.period, args.periods, args.date_from, args.date_to)
+        else:
+            rows = iter_export(conn, args.table, args.date_from, args.date_to, args.action)
+            columns = next(rows)
+            if args.format == 'table':
+                # Выгрузка может быть большой - таблицей не выводим
+                args.format = 'csv'
+        return write_rows(rows, columns, args.format, output)
+    finally:
+        if rows is not None:
+            rows.close()
+        conn.close()
+        if temp_snapshot:
+            os.unlink(temp_snapshot)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        count = run(args, output)
+    except BrokenPipeError:
+        # Вывод обрезан (например, через head) - это не ошибка
+        sys.stdout = None
+        return 0
+    except (OSError, sqlite3.Error) as e:
+        print(f"❌ Ошибка при получении статистики: {e}", file=sys.stderr)
+        print("Убедитесь, что бот был запущен хотя бы один раз для создания БД.", file=sys.stderr)
+        return 1
+    finally:
+        if args.output:
+            output.close()
+    if args.output:
+        print(f"Записано строк: {count} -> {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+from abc import ABC, abstractmethod
+
+
+class Storage(ABC):
+    """
+    Хранилище пользователей, действий, заявок и статистики
+
+    Реализации: SQLiteStorage (database.py, по умолчанию) и PostgresStorage
+    (postgres_storage.py). Строки возвращаются кортежами с одинаковым порядком
+    полей во всех реализациях; время - локальное, str() начинается с ГГГГ-ММ-ДД ЧЧ:ММ:СС
+    и может продолжаться микросекундами (как datetime.now()) - для даты и времени берите
+    первые 19 символов.
+    """
+
+    # Имя реализации для STORAGE_BACKEND и отчетов
+    name = None
+
+    async def open(self):
+        """Подключение и создание схемы"""
+
+    async def close(self):
+        """Закрытие соединений"""
+
+    @abstractmethod
+    async def save_user(self, user_id: int, username, first_name, last_name):
+        """Вставка пользователя или обновление профиля и last_seen"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_user_info(self, user_id: int):
+        """
+        Профиль пользователя
+
+        Returns:
+            (user_id, username, first_name, last_name) или None
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_users(self) -> int:
+        """Количество пользователей"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_user_ids_after(self, after_user_id: int, limit: int) -> list:
+        """Следующие limit пользователей по возрастанию user_id (постранично по ключу)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def log_action(self, user_id: int, action_type: str):
+        """Запись одного действия с текущим временем"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def log_actions(self, rows: list):
+        """
+        Пакетная запись действий вместе с агрегатами одной транзакцией
+
+        Args:
+            rows: Список (user_id, action_type, datetime)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_application(self, user_id: int, phone_number: str, notification=None):
+        """
+        Запись заявки
+
+        Args:
+            notification: (chat_id, kind, payload) - уведомление о заявке для очереди
+                notifications (она всегда в локальной SQLite)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_statistics(self) -> dict:
+        """
+        Статистика для /stats
+
+        Returns:
+            Словарь total_users, actions_stats [(тип, количество)],
+            top_users [(user_id, first_name, username, количество)], daily_stats [(день, количество)]
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_applications_after(self, last_id: int, limit: int) -> list:
+        """
+        Заявки с id больше last_id по возрастанию id
+
+        Выгрузка запоминает последний id, поэтому реализация должна делать заявки
+        видимыми строго в порядке id (заявка с меньшим id не появляется позже).
+
+        Returns:
+            Список (id, timestamp, user_id, username, first_name, last_name, phone_number, status)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_daily_rollups_between(self, after_day: str, before_day: str, limit: int) -> list:
+        """Агрегаты [(день ГГГГ-ММ-ДД, тип действия, количество)] за дни после after_day и до before_day"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_export_state(self, name: str):
+        """Отметка выгрузки в Google Sheets (строка) или None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_export_state(self, name: str, value):
+        """Запись отметки выгрузки"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def claim_export(self, name: str, owner: str, lease_seconds: float) -> bool:
+        """
+        Захват или продление аренды выгрузки: с общим хранилищем выгружает один экземпляр бота
+
+        Returns:
+            True, если аренда у owner (была свободна, истекла или уже принадлежала ему)
+        """
+        raise NotImplementedError
+
+    def get_stats(self) -> dict:
+        """
+        Получение сведений о хранилище
+
+        Returns:
+            Словарь с именем реализации (и состоянием пула соединений, если он есть)
+        """
+        return {'backend': self.name}
@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+import database
+from database import ActionBuffer
+
+
+class FakeStorage:
+    """Хранилище, которое запоминает записанные пакеты и умеет падать по требованию"""
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    async def log_actions(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('database is locked')
+        self.batches.append([action for _, action, _ in batch])
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    fake = FakeStorage()
+    monkeypatch.setattr(database, '_storage', fake)
+    return fake
+
+
+def _actions(buffer):
+    return [action for _, action, _ in buffer.queue]
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        ActionBuffer(overflow_policy='drop_all')
+
+
+def test_drop_oldest_evicts_head(storage):
+    async def scenario():
+        buffer = ActionBuffer(batch_size=10, max_size=3, overflow_policy='drop_oldest')
+        for number in range(5):
+            await buffer.put(1, f'a{number}')
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert _actions(buffer) == ['a2', 'a3', 'a4']
+    assert buffer.stats['dropped'] == 2
+    assert buffer.stats['enqueued'] == 5
+
+
+def test_drop_new_keeps_head(storage):
+    async def scenario():
+        buffer = ActionBuffer(batch_size=10, max_size=3, overflow_policy='drop_new')
+        for number in range(5):
+            await buffer.put(1, f'a{number}')
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert _actions(buffer) == ['a0', 'a1', 'a2']
+    assert buffer.stats['dropped'] == 2
+    assert buffer.stats['enqueued'] == 3
+
+
+def test_block_waits_for_flush(storage):
+    async def scenario():
+        buffer = ActionBuffer(batch_size=2, flush_interval=60, max_size=2, overflow_policy='block')
+        buffer.start()
+        await buffer.put(1, 'a0')
+        await buffer.put(1, 'a1')
+        # Очередь полна: put будит запись и продолжает, когда место освободилось
+        await asyncio.wait_for(buffer.put(1, 'a2'), 1)
+        await buffer.stop()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert storage.batches == [['a0', 'a1'], ['a2']]
+    assert buffer.stats['dropped'] == 0
+    assert buffer.stats['flushed'] == 3
+
+
+def test_failed_flush_requeues_in_order(storage):
+    storage.failures = 1
+
+    async def scenario():
+        buffer = ActionBuffer(batch_size=2, max_size=10)
+        for number in range(3):
+            await buffer.put(1, f'a{number}')
+        await buffer.flush()
+        failed = _actions(buffer)
+        await buffer.flush()
+        return buffer, failed
+
+    buffer, failed = asyncio.run(scenario())
+    assert failed == ['a0', 'a1', 'a2']
+    assert storage.batches == [['a0', 'a1'], ['a2']]
+    assert buffer.stats['flush_errors'] == 1
+    assert buffer.stats['flushed'] == 3
+    assert not buffer.queue
+
+
+@pytest.mark.parametrize('policy, expected, dropped', [
+    ('drop_oldest', ['a1', 'a2', 'a3'], 1),
+    ('drop_new', ['a0', 'a1', 'a2'], 1),
+    ('block', ['a0', 'a1', 'a2', 'a3'], 0),
+])
+def test_requeue_trims_overflow_by_policy(storage, policy, expected, dropped):
+    async def scenario():
+        buffer = ActionBuffer(batch_size=2, max_size=3, overflow_policy=policy)
+        for number in range(3):
+            await buffer.put(1, f'a{number}')
+
+        # Пока пакет пишется, в очередь успевает попасть еще одно действие
+        async def log_then_fail(batch):
+            await buffer.put(1, 'a3')
+            raise RuntimeError('database is locked')
+
+        storage.log_actions = log_then_fail
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert _actions(buffer) == expected
+    assert buffer.stats['dropped'] == dropped
+
+
+def test_stop_flushes_remaining(storage):
+    async def scenario():
+        buffer = ActionBuffer(batch_size=100, flush_interval=60)
+        buffer.start()
+        for number in range(3):
+            await buffer.put(1, f'a{number}')
+        await buffer.stop()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert storage.batches == [['a0', 'a1', 'a2']]
+    assert not buffer.queue
+    assert buffer.get_stats()['queue_depth'] == 0
@@ -0,0 +1,168 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from scheduler import PerUserUpdateProcessor, RequestScheduler, SchedulerBusy
+
+
+async def _hold(scheduler, user_id, order, release):
+    """Слот на время до release, порядок получения - в order"""
+    async with scheduler.slot(user_id):
+        order.append(user_id)
+        await release.wait()
+
+
+def test_free_slot_is_granted_immediately():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=2)
+        async with scheduler.slot(1):
+            async with scheduler.slot(2):
+                return scheduler.get_stats()
+
+    stats = asyncio.run(scenario())
+    assert stats['running'] == 2
+    assert stats['queued'] == 0
+    assert stats['admitted'] == 2
+
+
+def test_waiting_users_are_served_round_robin():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_wait=5)
+        order = []
+        gate = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, 0, order, gate))
+        await asyncio.sleep(0)
+
+        # Пользователь 1 поставил три запроса раньше пользователя 2
+        release = asyncio.Event()
+        release.set()
+        tasks = []
+        for user_id in (1, 1, 1, 2):
+            tasks.append(asyncio.create_task(_hold(scheduler, user_id, order, release)))
+            await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(holder, *tasks)
+        return order
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 1, 1]
+
+
+def test_queue_full_is_rejected():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_queue=1, max_wait=5)
+        gate = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, 0, [], gate))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(_hold(scheduler, 1, [], gate))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy) as error:
+            async with scheduler.slot(2):
+                pass
+        gate.set()
+        await asyncio.gather(holder, waiter)
+        return error.value.reason, scheduler.get_stats()
+
+    reason, stats = asyncio.run(scenario())
+    assert reason == 'queue_full'
+    assert stats['rejected_queue_full'] == 1
+    assert stats['running'] == 0
+
+
+def test_max_wait_timeout_removes_waiter():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_wait=0.05)
+        gate = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, 0, [], gate))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy) as error:
+            async with scheduler.slot(1):
+                pass
+        stats = scheduler.get_stats()
+        gate.set()
+        await holder
+        return error.value.reason, stats, scheduler.get_stats()
+
+    reason, during, after = asyncio.run(scenario())
+    assert reason == 'timeout'
+    assert during['queued'] == 0
+    assert during['rejected_timeout'] == 1
+    assert after['running'] == 0
+
+
+def test_cancel_after_grant_returns_slot():
+    async def scenario():
+        scheduler = RequestScheduler(max_concurrent=1, max_wait=5)
+        gate = asyncio.Event()
+        order = []
+        holder = asyncio.create_task(_hold(scheduler, 0, order, gate))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(_hold(scheduler, 1, order, asyncio.Event()))
+        await asyncio.sleep(0)
+        follower_release = asyncio.Event()
+        follower_release.set()
+        follower = asyncio.create_task(_hold(scheduler, 2, order, follower_release))
+        await asyncio.sleep(0)
+
+        # Слот передается ожидающему 1, но его отменяют раньше, чем он проснулся
+        gate.set()
+        await holder
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        await asyncio.wait_for(follower, 1)
+        return order, scheduler.get_stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order == [0, 2]
+    assert stats['running'] == 0
+    assert stats['queued'] == 0
+
+
+def test_user_token_bucket():
+    scheduler = RequestScheduler(user_rate=0.0001, user_burst=2)
+    assert [scheduler.try_take_token(1) for _ in range(3)] == [True, True, False]
+    assert scheduler.try_take_token(2)
+    assert scheduler.get_stats()['rejected_rate_limited'] == 1
+
+
+def _update(user_id):
+    """Обновление с пользователем (для PerUserUpdateProcessor важен только effective_user)"""
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_updates_of_one_user_are_sequential():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4)
+        events = []
+
+        async def handle(number):
+            events.append(('start', number))
+            await asyncio.sleep(0.01)
+            events.append(('end', number))
+
+        await asyncio.gather(*(processor.process_update(_update(1), handle(n)) for n in range(3)))
+        return events
+
+    events = asyncio.run(scenario())
+    assert events == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+
+
+def test_waiting_user_does_not_hold_slots_of_others():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        finished = []
+
+        async def handle(name, delay):
+            await asyncio.sleep(delay)
+            finished.append(name)
+
+        # Пять обновлений пользователя 1 ждут своей очереди; пользователь 2 не должен ждать их
+        flood = [processor.process_update(_update(1), handle(f'flood{n}', 0.05)) for n in range(5)]
+        tasks = [asyncio.create_task(coroutine) for coroutine in flood]
+        await asyncio.sleep(0)
+        await processor.process_update(_update(2), handle('other', 0.01))
+        position = finished.index('other')
+        await asyncio.gather(*tasks)
+        return position, processor._locks
+
+    position, locks = asyncio.run(scenario())
+    assert position == 0
+    assert locks == {}
@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+from ai_cache import SingleFlight
+
+
+def test_concurrent_calls_share_one_request():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def request():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 'answer'
+
+        results = await asyncio.gather(*(flight.do('key', request) for _ in range(5)))
+        return results, calls, flight.get_stats()
+
+    results, calls, stats = asyncio.run(scenario())
+    assert results == ['answer'] * 5
+    assert calls == 1
+    assert stats == {'leaders': 1, 'coalesced': 4, 'in_flight': 0}
+
+
+def test_exception_reaches_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def request():
+            await asyncio.sleep(0.01)
+            raise ValueError('api error')
+
+        return await asyncio.gather(*(flight.do('key', request) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request():
+    async def scenario():
+        flight = SingleFlight()
+        finished = asyncio.Event()
+
+        async def request():
+            await asyncio.sleep(0.05)
+            finished.set()
+            return 'answer'
+
+        first = asyncio.create_task(flight.do('key', request))
+        second = asyncio.create_task(flight.do('key', request))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        result = await second
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return result, finished.is_set()
+
+    assert asyncio.run(scenario()) == ('answer', True)
+
+
+def test_request_cancelled_when_last_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def request():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do('key', request)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return cancelled.is_set(), flight.get_stats()['in_flight']
+
+    assert asyncio.run(scenario()) == (True, 0)
+
+
+def test_new_call_after_cancelled_request_starts_fresh():
+    async def scenario():
+        flight = SingleFlight()
+        attempts = 0
+
+        async def request():
+            nonlocal attempts
+            attempts += 1
+            await asyncio.sleep(0.01 if attempts > 1 else 10)
+            return attempts
+
+        waiter = asyncio.create_task(flight.do('key', request))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.sleep(0)
+        return await flight.do('key', request)
+
+    assert asyncio.run(scenario()) == 2
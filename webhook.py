@@ -0,0 +1,170 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from telegram import Update
+from telegram.ext import Application
+from http_server import HTTPServer, Response
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секрет вебхука
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class WebhookServer:
+    """Прием обновлений Telegram через вебхук во встроенном HTTP сервере"""
+
+    def __init__(self, application: Application, listen: str = '0.0.0.0', port: int = 8080,
+                 path: str = '/telegram', secret_token: str = None):
+        """
+        Инициализация сервера вебхука
+
+        Args:
+            application: Приложение бота; его update_queue ограничивает очередь обновлений
+            listen: Адрес для прослушивания
+            port: Порт для прослушивания
+            path: Путь, на который Telegram присылает обновления
+            secret_token: Секрет для проверки запросов (если не задан - генерируется)
+        """
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+
+        self.server = HTTPServer(listen, port)
+        self.server.route('POST', path, self._handle_update)
+        self.server.route('GET', '/health', self._handle_health)
+
+        self.stats = {
+            'received': 0,
+            'rejected_secret': 0,
+            'rejected_queue_full': 0,
+            'invalid': 0
+        }
+
+    async def start(self):
+        """Запуск HTTP сервера"""
+        await self.server.start()
+
+    async def stop(self):
+        """Остановка HTTP сервера"""
+        await self.server.stop()
+
+    async def _handle_update(self, request) -> Response:
+        """Прием обновления от Telegram"""
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token, self.secret_token):
+            self.stats['rejected_secret'] += 1
+            return Response.text('Forbidden', 403)
+
+        try:
+            accepted = self.enqueue(request.json())
+        except Exception as e:
+            self.stats['invalid'] += 1
+            logger.warning(f"Некорректное обновление от Telegram: {e}")
+            return Response.text('Bad Request', 400)
+
+        # Очередь переполнена - Telegram повторит доставку позже
+        if not accepted:
+            self.stats['rejected_queue_full'] += 1
+            return Response.text('Service Unavailable', 503)
+
+        self.stats['received'] += 1
+        return Response.text('OK')
+
+    def enqueue(self, data: dict) -> bool:
+        """
+        Постановка обновления в очередь обработки
+
+        Args:
+            data: Обновление в формате JSON Bot API
+
+        Returns:
+            False, если очередь переполнена
+        """
+        update = Update.de_json(data, self.application.bot)
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def health(self) -> dict:
+        """Состояние для /health; ключ running определяет код ответа"""
+        return {
+            'running': self.application.running,
+            'queue': self.application.update_queue.qsize()
+        }
+
+    async def _handle_health(self, request) -> Response:
+        """Проверка работоспособности для балансировщика и мониторинга"""
+        health = self.health()
+        running = health.pop('running')
+        return Response.json({
+            'status': 'ok' if running else 'stopped',
+            **health,
+            **self.stats
+        }, status=200 if running else 503)
+
+
+def stop_event_on_signals() -> asyncio.Event:
+    """Событие, которое устанавливается по SIGINT/SIGTERM (нужен работающий event loop)"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows не поддерживает обработчики сигналов в event loop
+            pass
+    return stop_event
+
+
+async def serve_webhook(application: Application, url: str, listen: str = '0.0.0.0',
+                        port: int = 8080, path: str = '/telegram', secret_token: str = None,
+                        allowed_updates: list = None, max_connections: int = 40):
+    """
+    Запуск бота в режиме вебхука до получения SIGINT/SIGTERM
+
+    Args:
+        application: Приложение бота
+        url: Публичный адрес вебхука (https://host/path)
+        listen: Адрес для прослушивания
+        port: Порт для прослушивания
+        path: Путь, на который Telegram присылает обновления
+        secret_token: Секрет для проверки запросов
+        allowed_updates: Типы обновлений, которые нужны боту
+        max_connections: Максимум одновременных соединений от Telegram
+    """
+    webhook_server = WebhookServer(application, listen, port, path, secret_token)
+    stop_event = stop_event_on_signals()
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        await webhook_server.start()
+        await application.bot.set_webhook(
+            url=url,
+            secret_token=webhook_server.secret_token,
+            allowed_updates=allowed_updates,
+            max_connections=max_connections
+        )
+        logger.info(f"Вебхук установлен: {url}")
+
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка вебхука...")
+        await webhook_server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application, url: str, **options):
+    """Синхронная точка входа режима вебхука (аналог run_polling)"""
+    asyncio.run(serve_webhook(application, url, **options))